@@ -0,0 +1,5 @@
+@echo off
+rem Continuous WebJob: runs `flask worker` next to the site (image processing,
+rem file deletion). Without it, requests run the jobs they queue themselves.
+cd /d D:\home\site\wwwroot
+D:\home\python364x64\python.exe -m flask --app app worker
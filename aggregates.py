@@ -0,0 +1,181 @@
+from collections import Counter, defaultdict
+
+from sqlalchemy import delete, event, func, insert, inspect, literal, select, update
+
+from app import db
+from models import Aggregate, Category, Post, Tag, User, post_tags
+
+# Site-wide totals, stored with item_id 0
+POSTS_PUBLISHED = 'posts.published'
+POSTS_DRAFT = 'posts.draft'
+CATEGORIES = 'categories'
+TAGS = 'tags'
+USERS = 'users'
+
+# Models with a site-wide total, and the scope of their per-item post counts,
+# which are named '<scope>.published' and '<scope>.draft'
+_ENTITIES = {Category: (CATEGORIES, 'category'), Tag: (TAGS, 'tag'), User: (USERS, 'author')}
+
+# session.info key holding what the posts being flushed counted before
+_BEFORE_KEY = 'aggregates_before'
+
+# Rows written per INSERT batch
+BATCH_SIZE = 1000
+
+
+def _names(scope, published=None):
+    if published is None:
+        return [f'{scope}.published', f'{scope}.draft']
+    return [f'{scope}.published' if published else f'{scope}.draft']
+
+
+def totals():
+    """Site-wide totals, keyed by POSTS_PUBLISHED, POSTS_DRAFT, CATEGORIES, TAGS and USERS"""
+    names = (POSTS_PUBLISHED, POSTS_DRAFT, CATEGORIES, TAGS, USERS)
+    values = dict.fromkeys(names, 0)
+    values.update(db.session.execute(
+        select(Aggregate.name, Aggregate.value).where(Aggregate.name.in_(names), Aggregate.item_id == 0)).all())
+    return values
+
+
+def counts(scope, published=None):
+    """``{item id: post count}`` for a scope ('category', 'tag' or 'author')
+
+    Args:
+        published: True or False to count only published posts or drafts;
+            None counts both
+    """
+    result = defaultdict(int)
+    for item_id, value in db.session.execute(
+            select(Aggregate.item_id, Aggregate.value).where(Aggregate.name.in_(_names(scope, published)))):
+        result[item_id] += value
+    return dict(result)
+
+
+def count_join(scope, item_id, published=None):
+    """Join condition pairing ``item_id`` (e.g. ``Category.id``) with its count rows"""
+    return Aggregate.name.in_(_names(scope, published)) & (Aggregate.item_id == item_id)
+
+
+def _contributions(connection, post_ids):
+    """What the given posts add to each ``(name, item id)``, as stored now"""
+    contributions = Counter()
+    post_ids = list(post_ids)
+    for start in range(0, len(post_ids), 500):
+        chunk = post_ids[start:start + 500]
+        states = {}
+        for post_id, published, category_id, author_id in connection.execute(
+                select(Post.id, Post.published, Post.category_id, Post.author_id).where(Post.id.in_(chunk))):
+            state = 'published' if published else 'draft'
+            states[post_id] = state
+            contributions[(f'posts.{state}', 0)] += 1
+            if category_id is not None:
+                contributions[(f'category.{state}', category_id)] += 1
+            if author_id is not None:
+                contributions[(f'author.{state}', author_id)] += 1
+        for post_id, tag_id in connection.execute(
+                select(post_tags.c.post_id, post_tags.c.tag_id).where(post_tags.c.post_id.in_(chunk))):
+            if post_id in states:
+                contributions[(f'tag.{states[post_id]}', tag_id)] += 1
+    return contributions
+
+
+def _persistent_ids(objects, model):
+    return {inspect(obj).identity[0] for obj in objects
+            if isinstance(obj, model) and inspect(obj).identity is not None}
+
+
+def _inserted_ids(objects, model):
+    # New objects get their identity only after after_flush, but the INSERT
+    # has already filled in their primary key
+    return {inspect(obj).dict['id'] for obj in objects
+            if isinstance(obj, model) and inspect(obj).dict.get('id') is not None}
+
+
+@event.listens_for(db.session, 'before_flush')
+def _count_before_flush(session, flush_context, instances):
+    # Read what the changed posts count for from the database itself, so
+    # expired attributes and association rows need no special handling
+    post_ids = _persistent_ids(list(session.dirty) + list(session.deleted), Post)
+    before = _contributions(session.connection(), post_ids) if post_ids else Counter()
+    session.info[_BEFORE_KEY] = (post_ids, before)
+
+
+@event.listens_for(db.session, 'after_flush')
+def _count_after_flush(session, flush_context):
+    post_ids, before = session.info.pop(_BEFORE_KEY, (set(), Counter()))
+    post_ids |= _inserted_ids(session.new, Post)
+    connection = session.connection()
+    deltas = _contributions(connection, post_ids) if post_ids else Counter()
+    deltas.subtract(before)
+
+    removed = []
+    for obj in session.new:
+        if type(obj) in _ENTITIES:
+            deltas[(_ENTITIES[type(obj)][0], 0)] += 1
+    for obj in session.deleted:
+        if type(obj) in _ENTITIES:
+            total, scope = _ENTITIES[type(obj)]
+            deltas[(total, 0)] -= 1
+            removed.append((scope, inspect(obj).identity[0]))
+
+    for scope, item_id in removed:
+        for name in _names(scope):
+            deltas.pop((name, item_id), None)
+        connection.execute(delete(Aggregate).where(count_join(scope, item_id)))
+    _apply(connection, deltas)
+
+
+def _apply(connection, deltas):
+    """Add ``{(name, item id): delta}`` to the stored counts, in the flush's transaction"""
+    for (name, item_id), delta in sorted(deltas.items()):
+        if not delta:
+            continue
+        result = connection.execute(
+            update(Aggregate).where(Aggregate.name == name, Aggregate.item_id == item_id)
+            .values(value=Aggregate.value + delta))
+        if result.rowcount == 0:
+            connection.execute(insert(Aggregate).values(name=name, item_id=item_id, value=delta))
+
+
+def add_posts(post_ids):
+    """Count posts inserted with bulk SQL, which the flush hooks don't see (not committed)"""
+    connection = db.session.connection()
+    _apply(connection, _contributions(connection, post_ids))
+
+
+def rebuild():
+    """Recount every aggregate from the posts, categories, tags and users
+
+    The flush hooks keep the counts current for ORM writes; run this (``flask
+    aggregates-rebuild``) after bulk SQL that bypasses the session.
+
+    Returns:
+        The number of rows written
+    """
+    published = func.coalesce(Post.published, False)
+    values = Counter()
+
+    def add(scope, rows):
+        for is_published, item_id, value in rows:
+            if item_id is not None:
+                values[(_names(scope, bool(is_published))[0], item_id)] += value
+
+    add('posts', db.session.execute(select(published, literal(0), func.count()).group_by(published)))
+    add('category', db.session.execute(
+        select(published, Post.category_id, func.count()).group_by(published, Post.category_id)))
+    add('author', db.session.execute(
+        select(published, Post.author_id, func.count()).group_by(published, Post.author_id)))
+    add('tag', db.session.execute(
+        select(published, post_tags.c.tag_id, func.count())
+        .join_from(post_tags, Post, Post.id == post_tags.c.post_id)
+        .group_by(published, post_tags.c.tag_id)))
+    for model, (total, _) in _ENTITIES.items():
+        values[(total, 0)] = db.session.scalar(select(func.count()).select_from(model))
+
+    rows = [{'name': name, 'item_id': item_id, 'value': value} for (name, item_id), value in values.items()]
+    db.session.execute(delete(Aggregate))
+    for start in range(0, len(rows), BATCH_SIZE):
+        db.session.execute(insert(Aggregate), rows[start:start + BATCH_SIZE])
+    db.session.commit()
+    return len(rows)
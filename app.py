@@ -1,15 +1,19 @@
+import startup  # first, so that the imports below are timed
 import os
+import sys
 from datetime import datetime
-from flask import Flask, render_template, url_for, request
+import click
+from flask import Flask, render_template, url_for
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
-from flask_migrate import Migrate
 from dotenv import load_dotenv
-from sqlalchemy import func
-from flask_compress import Compress
-from werkzeug.utils import secure_filename
-import uuid
-import time
+import compression
+from db_profiles import default_profile, engine_options, install_pragmas
+import replicas
+import metrics
+import auth
+
+startup.mark('imports')
 
 # Load environment variables from .env file
 load_dotenv()
@@ -23,139 +27,130 @@ app = Flask(__name__,
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'default-dev-key')
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///blog.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Pool, driver and PRAGMA settings: sqlite-dev, sqlite-prod-wal, mssql or default (see db_profiles.py)
+app.config['DB_ENGINE_PROFILE'] = os.environ.get('DB_ENGINE_PROFILE') or default_profile(app.config['SQLALCHEMY_DATABASE_URI'])
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['DB_ENGINE_PROFILE'], app.config['SQLALCHEMY_DATABASE_URI'])
+# Optional read replica for public pages (see replicas.py)
+app.config['REPLICA_DATABASE_URL'] = os.environ.get('REPLICA_DATABASE_URL')
+app.config['REPLICA_STICKY_SECONDS'] = int(os.environ.get('REPLICA_STICKY_SECONDS', 10))  # read from the primary after a write
+if app.config['REPLICA_DATABASE_URL']:
+    app.config['SQLALCHEMY_BINDS'] = {replicas.REPLICA_BIND: {
+        'url': app.config['REPLICA_DATABASE_URL'],
+        **engine_options(app.config['DB_ENGINE_PROFILE'], app.config['REPLICA_DATABASE_URL']),
+    }}
+# Signed-in users and downstream caching of anonymous pages (see auth.py, http_cache.py)
+app.config['USER_CACHE_TTL'] = int(os.environ.get('USER_CACHE_TTL', 60))  # seconds a signed-in user is reused, 0 = off
+app.config['PUBLIC_CACHE_MAX_AGE'] = int(os.environ.get('PUBLIC_CACHE_MAX_AGE', 0))  # seconds shared caches may keep anonymous pages, 0 = off
+app.config['PUBLIC_CACHE_VARY_COOKIE'] = os.environ.get('PUBLIC_CACHE_VARY_COOKIE', 'True').lower() == 'true'  # False only if the CDN bypasses its cache for the session cookie
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max upload
+app.config['STATIC_CACHE_MAX_AGE'] = int(os.environ.get('STATIC_CACHE_MAX_AGE', 604800))  # seconds, for unversioned static URLs
+app.config['SEARCH_BACKEND'] = os.environ.get('SEARCH_BACKEND', 'auto')  # auto, fts5 or python
+app.config['SIDEBAR_CACHE_TTL'] = int(os.environ.get('SIDEBAR_CACHE_TTL', 300))  # seconds
+app.config['PAGINATION_SHALLOW_PAGES'] = int(os.environ.get('PAGINATION_SHALLOW_PAGES', 5))  # pages linked by number
+app.config['PAGINATION_COUNT_TTL'] = int(os.environ.get('PAGINATION_COUNT_TTL', 60))  # seconds, -1 skips counts
+app.config['RELATED_POSTS_STORED'] = int(os.environ.get('RELATED_POSTS_STORED', 6))  # precomputed related posts per post
 
-# Function to save uploaded images
-def save_image(file, image_type):
-    """
-    Save uploaded image to the appropriate directory
-    
-    Args:
-        file: The uploaded file object
-        image_type: Type of image ('featured' or 'content')
-    
-    Returns:
-        path: Relative path to the saved image (for storing in database)
-    """
-    # Generate unique filename using hex representation of uuid4 and timestamp
-    unique_filename = uuid.uuid4().hex[:16] + str(int(time.time()))[-6:]
-    
-    # Get file extension
-    _, file_extension = os.path.splitext(file.filename)
-    
-    # Create safe filename
-    filename = unique_filename + file_extension.lower()
-    
-    # Determine directory path based on image type
-    if image_type == 'featured':
-        directory = os.path.join('media', 'featured')
-    else:  # content
-        directory = os.path.join('media', 'content')
-    
-    # Ensure directory exists
-    full_directory = os.path.join(app.static_folder, directory)
-    if not os.path.exists(full_directory):
-        os.makedirs(full_directory)
-    
-    # Save the file
-    file_path = os.path.join(full_directory, filename)
-    file.save(file_path)
-    
-    # Return relative path for database storage
-    return os.path.join(directory, filename)
+# ASGI mode (asgi.py): public pages use an async engine, the rest runs on threads
+app.config['ASYNC_DATABASE_URL'] = os.environ.get('ASYNC_DATABASE_URL')  # defaults to the (replica) database via an async driver
+app.config['ASGI_SYNC_THREADS'] = int(os.environ.get('ASGI_SYNC_THREADS', 8))  # threads running the Flask app
+
+# Full-page cache for anonymous visitors (opt-in)
+app.config['PAGE_CACHE_ENABLED'] = os.environ.get('PAGE_CACHE_ENABLED', 'False').lower() == 'true'
+app.config['PAGE_CACHE_BACKEND'] = os.environ.get('PAGE_CACHE_BACKEND', 'memory')  # memory or disk
+app.config['PAGE_CACHE_DIR'] = os.environ.get('PAGE_CACHE_DIR')  # defaults to instance/page_cache
+app.config['PAGE_CACHE_TTL'] = int(os.environ.get('PAGE_CACHE_TTL', 300))  # seconds
+app.config['PAGE_CACHE_MAX_ENTRIES'] = int(os.environ.get('PAGE_CACHE_MAX_ENTRIES', 1000))
+
+# Streamed rendering of the home, post, category and tag pages (see streaming.py)
+app.config['STREAM_TEMPLATES'] = os.environ.get('STREAM_TEMPLATES', 'False').lower() == 'true'
+
+# Sitemap shards (post id ranges) are cached gzipped until their posts change
+app.config['SITEMAP_SHARD_SIZE'] = int(os.environ.get('SITEMAP_SHARD_SIZE', 50000))  # posts per shard, at most 50,000
+app.config['SITEMAP_CACHE_DIR'] = os.environ.get('SITEMAP_CACHE_DIR')  # defaults to instance/sitemaps
+
+# Static export of the public pages (`flask export-static`)
+app.config['STATIC_EXPORT_DIR'] = os.environ.get('STATIC_EXPORT_DIR')  # defaults to instance/export
+app.config['STATIC_EXPORT_BASE_URL'] = os.environ.get('STATIC_EXPORT_BASE_URL')  # e.g. https://example.com/
+
+# Bulk post import/export (`flask posts-import`, `flask posts-export` and /admin/api/posts)
+app.config['BULK_IMPORT_PROCESSES'] = int(os.environ.get('BULK_IMPORT_PROCESSES', 0))  # sanitizing processes, 0 = CPU count
+
+# Request metrics at /metrics and on the dashboard (see metrics.py)
+app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED', 'True').lower() == 'true'
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')  # bearer token for scrapers; admins can always read
+app.config['METRICS_DIR'] = os.environ.get('METRICS_DIR')  # shared by worker processes so totals cover all of them
+app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))  # share of requests profiled, 0 = off
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR')  # defaults to instance/profiles
+
+# Background jobs (image processing, file deletion); run them with `flask worker`
+app.config['TASK_QUEUE_EAGER'] = os.environ.get('TASK_QUEUE_EAGER', 'False').lower() == 'true'  # run jobs inline
+app.config['TASK_RETRY_DELAY'] = int(os.environ.get('TASK_RETRY_DELAY', 30))  # seconds, doubled per retry
+app.config['TASK_STALE_AFTER'] = int(os.environ.get('TASK_STALE_AFTER', 600))  # seconds before a running job is requeued
+app.config['TASK_WORKER_TIMEOUT'] = int(os.environ.get('TASK_WORKER_TIMEOUT', 30))  # seconds without a worker heartbeat before requests run their own jobs
+
+# Response compression (see compression.py); run `flask compress-static` on deploy
+app.config['COMPRESS_LEVELS'] = compression.parse_levels(os.environ.get('COMPRESS_LEVELS', ''))  # e.g. text/html=br:5,gzip:6;text/css=br:9
+app.config['COMPRESS_STATIC_PRECOMPRESSED'] = os.environ.get('COMPRESS_STATIC_PRECOMPRESSED', 'True').lower() == 'true'  # send .br/.gz siblings of static files
+
+# Print how long each startup phase took (see startup.py and `flask startup-report`)
+app.config['STARTUP_LOG'] = os.environ.get('STARTUP_LOG', 'False').lower() == 'true'
+
+startup.mark('config')
 
 # Add compression for faster page loads
-compress = Compress()
+compress = compression.TunedCompress()
 compress.init_app(app)
 
-# Add cache control headers for static assets
-@app.after_request
-def add_cache_control(response):
-    if request.path.startswith('/static'):
-        # Cache static files for 1 year (31536000 seconds)
-        if 'css' in request.path or 'js' in request.path:
-            response.cache_control.max_age = 31536000
-        # Cache images for 1 week (604800 seconds)
-        elif 'img' in request.path or 'uploads' in request.path:
-            response.cache_control.max_age = 604800
-    return response
-
 # Initialize extensions
-db = SQLAlchemy(app)
-migrate = Migrate(app, db)
+db = SQLAlchemy(app, session_options={'class_': replicas.RoutingSession})
+with app.app_context():
+    for engine in db.engines.values():
+        install_pragmas(engine, app.config['DB_ENGINE_PROFILE'])
+    metrics.init_app(app, db.engines.values())
+replicas.init_app(app)
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 login_manager.login_message_category = 'info'
+auth.init_app(app, login_manager)
+
+# Flask-Migrate (and alembic under it) only serves the `flask db` commands,
+# so web workers skip it; the flask CLI loads the app inside a click context
+if click.get_current_context(silent=True) is not None:
+    from flask_migrate import Migrate
+    migrate = Migrate(app, db)
+
+startup.mark('extensions')
 
 # Import routes after initializing db to avoid circular imports
 from routes import *
-from models import User, Post, Category, Tag
+from sidebar import DeferredSidebarItems
+
+startup.mark('views')
+
+import commands
+
+startup.mark('commands')
 
 # Global template variables
 @app.context_processor
 def inject_globals():
-    # Get all categories for the sidebar
-    categories = Category.query.all()
-    
-    # Get popular tags (those associated with most posts)
-    popular_tags = Tag.query.join(Tag.posts).group_by(Tag.id).order_by(func.count().desc()).limit(10).all()
-    
-    # Get recent posts for footer or sidebar
-    recent_posts = Post.query.filter_by(published=True).order_by(Post.created_at.desc()).limit(5).all()
+    # Sidebar data (categories, popular tags, recent posts) comes from a cached
+    # snapshot instead of three queries on every render, loaded only once a
+    # template uses it
     
     # Get the current year for copyright
     current_year = datetime.now().year
     
     # Return a dictionary of global variables
     return {
-        'categories': categories,
-        'popular_tags': popular_tags,
-        'recent_posts': recent_posts,
+        'categories': DeferredSidebarItems('categories'),
+        'popular_tags': DeferredSidebarItems('popular_tags'),
+        'recent_posts': DeferredSidebarItems('recent_posts'),
         'current_year': current_year
     }
 
-# Initialize database with admin user on first run
-@app.before_first_request
-def create_tables_and_admin():
-    db.create_all()
-    
-    # Check if there are any users
-    if not User.query.first():
-        from werkzeug.security import generate_password_hash
-        
-        # Create admin user
-        admin = User(
-            username='admin',
-            email='admin@example.com',
-            password_hash=generate_password_hash('admin123'),
-            is_admin=True
-        )
-        db.session.add(admin)
-        
-        # Create some initial categories
-        categories = [
-            Category(name='Technology', slug='technology'),
-            Category(name='Travel', slug='travel'),
-            Category(name='Food', slug='food'),
-            Category(name='Lifestyle', slug='lifestyle')
-        ]
-        for category in categories:
-            db.session.add(category)
-        
-        # Create some initial tags
-        tags = [
-            Tag(name='Python', slug='python'),
-            Tag(name='Flask', slug='flask'),
-            Tag(name='Web Development', slug='web-development'),
-            Tag(name='Tips', slug='tips')
-        ]
-        for tag in tags:
-            db.session.add(tag)
-        
-        db.session.commit()
-        
-        print('Admin user created! Username: admin, Password: admin123')
-        print('IMPORTANT: Change the admin password after first login!')
+if app.config['STARTUP_LOG']:
+    print(startup.report(), file=sys.stderr)
 
 if __name__ == '__main__':
     app.run(debug=os.environ.get('FLASK_DEBUG', 'True').lower() == 'true')
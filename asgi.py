@@ -0,0 +1,333 @@
+import asyncio
+import io
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import g, request, session
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from werkzeug.exceptions import HTTPException
+
+from app import app, db
+from db_profiles import engine_options, install_pragmas
+import metrics
+import page_cache
+import pages
+import queries
+import replicas
+
+# ASGI entry point for the public site. Anonymous GET/HEAD requests for the
+# home, post, category and tag pages run as coroutines: the pages in pages.py
+# (the same the Flask views serve) query through an async SQLAlchemy engine
+# and render with Jinja's async mode, so a slow query doesn't hold a worker.
+# Everything else (admin, forms, search, sitemaps, static files and logged-in
+# visitors) runs the regular Flask app on a thread pool, unchanged. Serve it
+# with an ASGI server, e.g.
+#
+#     uvicorn asgi:application --workers 4
+
+# Async drivers for database URLs that can be translated automatically
+ASYNC_DRIVERS = {'sqlite': 'sqlite+aiosqlite'}
+
+_sessions = None
+_engine = None
+_engine_lock = threading.Lock()
+_jinja_env = None
+_executor = ThreadPoolExecutor(max_workers=app.config['ASGI_SYNC_THREADS'], thread_name_prefix='wsgi')
+
+# Body chunks a pool thread may get ahead of the client by
+WSGI_QUEUED_CHUNKS = 8
+
+# Ends the items a pool thread hands to the event loop
+_DONE = object()
+
+
+def async_database_url():
+    """URL for the async engine: ``ASYNC_DATABASE_URL``, else the replica or
+    primary URL with its async driver, or None when there is no such driver"""
+    if app.config.get('ASYNC_DATABASE_URL'):
+        return app.config['ASYNC_DATABASE_URL']
+    with app.app_context():
+        # Flask-SQLAlchemy has already resolved relative SQLite paths here
+        url = (db.engines.get(replicas.REPLICA_BIND) or db.engine).url
+    driver = ASYNC_DRIVERS.get(url.get_backend_name())
+    return url.set(drivername=driver) if driver else None
+
+
+def get_sessions():
+    """The async session factory, or None if async views are unavailable"""
+    global _engine, _sessions
+    if _sessions is None and _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                url = async_database_url()
+                if url is None:
+                    app.logger.warning('No async driver for this database; set ASYNC_DATABASE_URL. '
+                                       'Serving every request through the WSGI app.')
+                    _engine = False
+                    return None
+                profile = app.config['DB_ENGINE_PROFILE']
+                options = engine_options(profile, str(url))
+                if 'pool_size' in options:
+                    # aiosqlite defaults to NullPool, which takes no pool sizes
+                    options.setdefault('poolclass', AsyncAdaptedQueuePool)
+                _engine = create_async_engine(url, **options)
+                install_pragmas(_engine.sync_engine, profile)
+                if app.config.get('METRICS_ENABLED', True):
+                    metrics.instrument_engine(_engine.sync_engine)
+                _sessions = async_sessionmaker(_engine, expire_on_commit=False)
+    return _sessions
+
+
+def _uses_replica():
+    return replicas.REPLICA_BIND in app.config.get('SQLALCHEMY_BINDS', {}) and not app.config.get('ASYNC_DATABASE_URL')
+
+
+async def render(template_name, **context):
+    """Async counterpart of ``render_template``"""
+    global _jinja_env
+    if _jinja_env is None:
+        # Shares the loader, globals and filters of the app's environment
+        _jinja_env = app.jinja_env.overlay(enable_async=True)
+    app.update_template_context(context)
+    template = _jinja_env.get_or_select_template(template_name)
+    return await template.render_async(context)
+
+
+async def _run(db_session, plan):
+    """Await the ``queries.Fetch`` requests of a page from pages.py on ``db_session``
+
+    Returns:
+        The generator's return value
+    """
+    try:
+        fetch = next(plan)
+        while True:
+            fetch = plan.send(queries.shaped(await db_session.execute(fetch.statement), fetch.shape))
+    except StopIteration as e:
+        return e.value
+    finally:
+        plan.close()
+
+
+async def _render_page(db_session, page):
+    """Run a page and render it like ``pages.serve``, but never streamed"""
+    rv = await _run(db_session, page)
+    if isinstance(rv, tuple):
+        template_name, context = rv
+        return await render(template_name, **context)
+    return rv
+
+
+# The pages served as coroutines; only anonymous visitors get here
+ASYNC_VIEWS = {'index': pages.index, 'post': pages.post, 'category': pages.category, 'tag': pages.tag}
+
+
+def _environ(scope, body):
+    """WSGI environ for an ASGI HTTP scope"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', ()):
+        name, value = name.decode('latin-1'), value.decode('latin-1')
+        if name == 'content-type':
+            key = 'CONTENT_TYPE'
+        elif name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+def _async_view(environ):
+    """The async view and its arguments for this request, if it has one"""
+    if environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+        return None
+    try:
+        endpoint, args = app.url_map.bind_to_environ(environ).match()
+    except HTTPException:
+        return None
+    view = ASYNC_VIEWS.get(endpoint)
+    return (view, args) if view is not None else None
+
+
+def _needs_sync():
+    """Requests the async views don't handle: signed-in (or remembered)
+    visitors, and reads that must see the primary right after a write"""
+    if session.get('_user_id') or request.cookies.get(app.config.get('REMEMBER_COOKIE_NAME', 'remember_token')):
+        return True
+    return _uses_replica() and (replicas.sticky() or replicas.recently_wrote())
+
+
+async def _serve_async(sessions, view, args, environ):
+    """Run an async view like Flask would, or return None to fall back"""
+    ctx = app.request_context(environ)
+    ctx.push()
+    error = None
+    started = None
+    try:
+        if _needs_sync():
+            return None
+        # The WSGI fallback is measured by the metrics middleware instead
+        if app.config.get('METRICS_ENABLED', True):
+            started = metrics.start()
+        try:
+            g.public_page = True  # as @cached_page marks the sync views
+            rv = app.preprocess_request()
+            if rv is None:
+                rv = page_cache.cached_response()
+            if rv is None:
+                async with sessions() as db_session:
+                    # Templates can't query here, so the sidebar is loaded up front
+                    await _run(db_session, pages.sidebar())
+                    rv = page_cache.store_response(app.make_response(await _render_page(db_session, view(**args))))
+        except HTTPException as e:
+            rv = app.handle_http_exception(e)
+        except Exception as e:
+            rv = app.handle_exception(e)
+        response = app.process_response(app.make_response(rv))
+        body = b''.join(response.get_app_iter(environ))
+        if started is not None:
+            metrics.finish(started, response.status_code, len(body))
+            started = None
+        return response.status_code, response.get_wsgi_headers(environ).to_wsgi_list(), body
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        if started is not None:
+            metrics.finish(started, 500, 0)
+        ctx.pop(error)
+
+
+def _call_wsgi(environ, loop, queue, cancelled):
+    """Run the Flask app on a pool thread, handing its status and headers,
+    then each body chunk, to the event loop as the app produces them"""
+    started = []
+
+    def start_response(status, headers, exc_info=None):
+        started[:] = [status, headers]
+
+    def put(item):
+        # Waits while the queue is full, so a slow client slows the app down
+        asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    try:
+        result = app.wsgi_app(environ, start_response)
+        try:
+            status, headers = started
+            put((int(status.split(' ', 1)[0]), headers))
+            for chunk in result:
+                if cancelled.is_set():
+                    break
+                if chunk:
+                    put(chunk)
+        finally:
+            # Ends the request context on this thread, also when the client left
+            if hasattr(result, 'close'):
+                result.close()
+    finally:
+        put(_DONE)
+
+
+async def _read_body(receive):
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+    return bytes(body)
+
+
+async def _send_response(send, status, headers, body):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _send_wsgi(send, environ):
+    """Serve a request with the Flask app, sending its body as it is produced"""
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=WSGI_QUEUED_CHUNKS)
+    cancelled = threading.Event()
+    job = loop.run_in_executor(_executor, _call_wsgi, environ, loop, queue, cancelled)
+    item = None
+    try:
+        item = await queue.get()
+        if item is _DONE:
+            # The app failed before starting its response
+            await job
+            return
+        status, headers = item
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+        })
+        while (item := await queue.get()) is not _DONE:
+            await send({'type': 'http.response.body', 'body': item, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        # On a failed send, unblock the thread and let it close the response
+        cancelled.set()
+        while item is not _DONE:
+            item = await queue.get()
+        await job
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            get_sessions()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if _engine:
+                await _engine.dispose()
+            _executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    sessions = get_sessions()
+    if sessions is not None:
+        environ = _environ(scope, b'')
+        matched = _async_view(environ)
+        if matched is not None:
+            result = await _serve_async(sessions, *matched, environ)
+            if result is not None:
+                return await _send_response(send, *result)
+
+    # Sync fallback: the Flask app on a thread pool, its response sent as it
+    # is produced (streamed pages, large exports)
+    await _send_wsgi(send, _environ(scope, await _read_body(receive)))
@@ -0,0 +1,109 @@
+import threading
+import time
+from collections import namedtuple
+
+from flask import current_app, g, request, session
+from flask.sessions import SecureCookieSession, SecureCookieSessionInterface
+from flask_login import UserMixin
+from sqlalchemy import select
+
+# Most principals kept per process; the oldest is dropped beyond this
+MAX_PRINCIPALS = 1024
+
+_lock = threading.Lock()
+_principals = {}  # user id -> (loaded at, UserPrincipal)
+
+
+class UserPrincipal(namedtuple('UserPrincipal', ['id', 'username', 'email', 'is_admin']), UserMixin):
+    """The signed-in user as ``current_user`` sees it
+
+    An immutable snapshot of the few columns requests need, so it can be
+    shared between requests instead of a ``User`` bound to one session.
+    Load the ``User`` row for anything else (e.g. ``user.posts``).
+    """
+    __slots__ = ()
+
+
+def _load_principal(user_id):
+    from app import db
+    from models import User
+
+    row = db.session.execute(
+        select(User.id, User.username, User.email, User.is_admin).where(User.id == user_id)).first()
+    return UserPrincipal(row.id, row.username, row.email, bool(row.is_admin)) if row else None
+
+
+def load_user(user_id):
+    """Flask-Login's user loader, served from a short-lived per-process cache
+
+    ``USER_CACHE_TTL`` seconds bound how long other workers keep a user's
+    old name or admin flag after ``forget_user``.
+    """
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return None
+    ttl = current_app.config.get('USER_CACHE_TTL', 60)
+    cached = _principals.get(user_id)
+    if cached is not None and ttl > 0 and time.monotonic() - cached[0] <= ttl:
+        return cached[1]
+
+    principal = _load_principal(user_id)
+    if principal is not None and ttl > 0:
+        with _lock:
+            _principals.pop(user_id, None)
+            _principals[user_id] = (time.monotonic(), principal)
+            while len(_principals) > MAX_PRINCIPALS:
+                _principals.pop(next(iter(_principals)))
+    return principal
+
+
+def forget_user(user_id):
+    """Drop a user's cached principal after it was edited or deleted
+
+    Only this process' cache is cleared; other workers reload the user when
+    their entry's TTL expires.
+    """
+    with _lock:
+        _principals.pop(user_id, None)
+
+
+class LazySession(SecureCookieSession):
+    """Session of a request that came without a session cookie
+
+    It starts out empty for every such visitor, so reading it doesn't mark it
+    accessed and the response gets no ``Vary: Cookie``. Writing to it (a
+    flash, a login) makes it a normal cookie session.
+    """
+
+    def __getitem__(self, key):
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        return dict.get(self, key, default)
+
+
+class LazySessionInterface(SecureCookieSessionInterface):
+    """The signed cookie session, skipped by anonymous visitors without a cookie"""
+
+    def open_session(self, app, request):
+        if app.secret_key and not request.cookies.get(self.get_cookie_name(app)):
+            return LazySession()
+        return super().open_session(app, request)
+
+
+def init_app(app, login_manager):
+    """Use the lazy session and the cached user loader on ``app``"""
+    app.session_interface = LazySessionInterface()
+    login_manager.user_loader(load_user)
+
+    def skip_anonymous_login():
+        # Visitors who aren't signed in (or remembered) are anonymous without
+        # asking Flask-Login, whose session protection would otherwise write
+        # to sessions that only hold a flash message
+        remember_cookie = app.config.get('REMEMBER_COOKIE_NAME', 'remember_token')
+        if '_user_id' not in session and not request.cookies.get(remember_cookie):
+            g._login_user = login_manager.anonymous_user()
+
+    # Ahead of every other before_request function, as they may use current_user
+    app.before_request_funcs.setdefault(None, []).insert(0, skip_anonymous_login)
@@ -0,0 +1,93 @@
+"""Compare the sync (gunicorn) and ASGI (uvicorn + asgi.py) deployments.
+
+Seeds a throwaway SQLite database, then serves it first with gunicorn sync
+workers and then with uvicorn running asgi.py, using the same number of
+worker processes. For each, many concurrent client threads request the home,
+post, category and tag pages. Prints throughput and p50/p99 latency.
+
+Needs the ASGI extras from requirements.txt (uvicorn, aiosqlite).
+
+Usage:
+    python benchmarks/asgi_benchmark.py [--workers 4] [--clients 128]
+        [--duration 20] [--posts 2000] [--profile sqlite-prod-wal]
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+from engine_benchmark import ROOT, client, free_port, percentile, wait_for
+
+SERVERS = {
+    'sync (gunicorn)': lambda workers, port: [
+        sys.executable, '-m', 'gunicorn', '-w', str(workers), '-b', f'127.0.0.1:{port}',
+        '--log-level', 'warning', 'app:app'],
+    'asgi (uvicorn)': lambda workers, port: [
+        sys.executable, '-m', 'uvicorn', 'asgi:application', '--workers', str(workers),
+        '--host', '127.0.0.1', '--port', str(port), '--log-level', 'warning', '--no-access-log'],
+}
+
+
+def run_server(name, env, args):
+    port = free_port()
+    server = subprocess.Popen(SERVERS[name](args.workers, port), env=env, cwd=ROOT)
+    try:
+        base = f'http://127.0.0.1:{port}'
+        wait_for(base + '/')
+        # Warm up each worker's caches before measuring
+        for _ in range(args.workers * 10):
+            urllib.request.urlopen(base + '/', timeout=30).read()
+        latencies, errors = [], []
+        deadline = time.monotonic() + args.duration
+        threads = [threading.Thread(target=client, args=(base, args.posts, deadline, latencies, errors))
+                   for _ in range(args.clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        server.terminate()
+        server.wait()
+    return {
+        'server': name,
+        'rps': len(latencies) / args.duration,
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99),
+        'errors': len(errors),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=4, help='worker processes per server')
+    parser.add_argument('--clients', type=int, default=128, help='concurrent client threads')
+    parser.add_argument('--duration', type=int, default=20, help='seconds per server')
+    parser.add_argument('--posts', type=int, default=2000)
+    parser.add_argument('--profile', default='sqlite-prod-wal', help='DB_ENGINE_PROFILE for both servers')
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.join(tmp, 'bench.db')}",
+               DB_ENGINE_PROFILE=args.profile, PAGE_CACHE_ENABLED='False')
+    results = []
+    try:
+        subprocess.run([sys.executable, os.path.join(ROOT, 'benchmarks', 'engine_benchmark.py'),
+                        '--seed', str(args.posts)], env=env, cwd=ROOT, check=True)
+        for name in SERVERS:
+            print(f'Running {name} ({args.workers} workers, {args.clients} clients, {args.duration}s) ...')
+            results.append(run_server(name, env, args))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    print(f"\n{'server':<18}{'req/s':>8}{'p50 ms':>9}{'p99 ms':>9}{'errors':>8}")
+    for r in results:
+        print(f"{r['server']:<18}{r['rps']:8.1f}{r['p50']:9.1f}{r['p99']:9.1f}{r['errors']:8d}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""Read, compare against and update benchmarks/baseline.json.
+
+The baseline holds one section per benchmark (``routes``, ``load``), each
+with the dataset it was measured on and its results, plus the thresholds a
+result may exceed its baseline by before it counts as a regression: it
+regresses when ``value > baseline * ratio + slack``. Query counts and
+response sizes are machine-independent and use tight thresholds; latencies
+vary between machines, so record the baseline on the machine that runs the
+check (``--save``) and keep their thresholds loose.
+"""
+import json
+import os
+import platform
+
+PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# Used for metrics the baseline file has no threshold for
+DEFAULT_THRESHOLDS = {
+    'p50_ms': {'ratio': 1.5, 'slack': 2.0},
+    'p99_ms': {'ratio': 3.0, 'slack': 10.0},
+    'queries': {'ratio': 1.0, 'slack': 0},
+    'queries_per_request': {'ratio': 1.0, 'slack': 0.5},
+    'bytes': {'ratio': 1.1, 'slack': 512},
+    'bytes_per_response': {'ratio': 1.1, 'slack': 512},
+    'errors': {'ratio': 1.0, 'slack': 0},
+}
+
+
+def load(path=PATH):
+    if not os.path.exists(path):
+        return {'thresholds': DEFAULT_THRESHOLDS}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save(section, dataset, results, path=PATH):
+    """Replace one section of the baseline file, keeping the others"""
+    baseline = load(path)
+    baseline.setdefault('thresholds', DEFAULT_THRESHOLDS)
+    baseline[section] = {
+        'dataset': dataset,
+        'machine': {'python': platform.python_version(), 'cpus': os.cpu_count()},
+        'results': results,
+    }
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def regressions(section, dataset, results, path=PATH):
+    """Messages for each result worse than its baseline beyond the thresholds
+
+    ``results`` maps a name (route, scenario) to ``{metric: value}``.
+    Metrics without a threshold (e.g. throughput) are reported but not checked.
+    """
+    baseline = load(path)
+    if section not in baseline:
+        return [f'{path} has no {section!r} baseline; record one with --save']
+    recorded = baseline[section]
+    if recorded['dataset'] != dataset:
+        return [f'The {section!r} baseline was recorded on dataset {recorded["dataset"]}, not {dataset}']
+    thresholds = dict(DEFAULT_THRESHOLDS, **baseline.get('thresholds', {}))
+    messages = []
+    for name, values in sorted(results.items()):
+        before = recorded['results'].get(name)
+        if before is None:
+            messages.append(f'{name}: not in the baseline')
+            continue
+        for metric, value in sorted(values.items()):
+            if metric not in thresholds or before.get(metric) is None or value is None:
+                continue
+            limit = before[metric] * thresholds[metric]['ratio'] + thresholds[metric]['slack']
+            if value > limit:
+                messages.append(f'{name}: {metric} {value:g} > {limit:g} (baseline {before[metric]:g})')
+    return messages
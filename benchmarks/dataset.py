@@ -0,0 +1,226 @@
+"""Seed a database with a synthetic newsroom for the benchmarks.
+
+Generates N posts, M tags and K categories written by a handful of authors.
+Post lengths follow a log-normal distribution (most posts are a few hundred
+words, a few are long reads), bodies mix paragraphs, headings, lists, quotes,
+code and images, and tag and category popularity follow a Zipf distribution,
+so a few tags are on many posts and most are on a handful.
+
+Posts go in through bulk.import_posts, the path `flask posts-import` takes,
+so their HTML is sanitized and the search index, post-count aggregates and
+related posts are filled in as they would be on a real site. The same seed
+always gives the same dataset.
+
+Usage:
+    python benchmarks/dataset.py --database sqlite:////tmp/bench.db
+        [--posts 2000] [--tags 300] [--categories 20] [--seed 42]
+    python benchmarks/dataset.py --jsonl posts.jsonl [...]  # records only
+"""
+import argparse
+import io
+import json
+import math
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Default dataset, the one benchmarks/baseline.json was recorded with
+POSTS = 2000
+TAGS = 300
+CATEGORIES = 20
+SEED = 42
+AUTHORS = 8
+
+# Admin account created by seed(); the benchmarks sign in as it
+ADMIN_USERNAME = 'admin'
+ADMIN_PASSWORD = 'benchmark'
+
+# Post length in words: log-normal around the median, clipped
+MEDIAN_WORDS = 650
+WORDS_SIGMA = 0.6
+MIN_WORDS, MAX_WORDS = 80, 6000
+
+# Tags per post: weights for 0, 1, 2, ... tags
+TAGS_PER_POST = (3, 10, 22, 25, 18, 10, 6, 4, 2)
+
+# Zipf exponents of tag and category popularity
+TAG_SKEW = 1.1
+CATEGORY_SKEW = 0.8
+
+PUBLISHED_SHARE = 0.9
+YEARS = 3
+
+WORDS = (
+    'the of and to in a is that for it as was with be by on not he this are or his from at which but have an '
+    'they you were their one all we can her has there been if more when will would who so no city council '
+    'budget report market energy water school health police court election vote policy housing transport '
+    'climate storm river bridge museum festival season team coach match league players club stadium fans '
+    'company shares profit workers union contract deal research study scientists data model network software '
+    'release update security privacy users service platform mobile launch price growth region minister '
+    'officials statement interview residents neighbourhood project plan proposal funding community local '
+    'national international week year month morning evening record history future analysis opinion review'
+).split()
+
+TOPICS = (
+    'Politics', 'Business', 'Technology', 'Science', 'Health', 'Sport', 'Culture', 'Travel', 'Food',
+    'Education', 'Environment', 'Opinion', 'Local', 'World', 'Money', 'Property', 'Motoring', 'Books',
+    'Music', 'Film', 'Television', 'Fashion', 'Weather', 'Obituaries', 'Letters', 'Investigations',
+)
+
+SUBJECTS = (
+    'Elections', 'Budget', 'Housing', 'Transport', 'Climate', 'Energy', 'Schools', 'Hospitals', 'Police',
+    'Courts', 'Football', 'Cricket', 'Tennis', 'Rugby', 'Markets', 'Startups', 'AI', 'Security', 'Space',
+    'Medicine', 'Theatre', 'Art', 'Festivals', 'Restaurants', 'Recipes', 'Gardening', 'Cycling', 'Rail',
+    'Airports', 'Universities', 'Jobs', 'Pensions', 'Tax', 'Water', 'Floods', 'Wildlife', 'Farming',
+    'Fishing', 'Tourism', 'Museums', 'Podcasts', 'Gaming', 'Smartphones', 'Cars', 'Crime', 'Immigration',
+)
+
+
+def _zipf_weights(n, skew):
+    return [1 / (rank ** skew) for rank in range(1, n + 1)]
+
+
+def _names(rng, count, first, second):
+    """``count`` distinct names built from two word lists"""
+    names = list(first) + [f'{a} {b}' for a in first for b in second]
+    rng.shuffle(names)
+    while len(names) < count:
+        names.append(f'{rng.choice(first)} {rng.choice(second)} {len(names)}')
+    return names[:count]
+
+
+def _sentence(rng, min_words=6, max_words=22):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words))]
+    return ' '.join(words).capitalize() + '.'
+
+
+def _body(rng, n_words, post_count):
+    """HTML of about ``n_words`` words, in the editor's usual markup"""
+    blocks, written = [], 0
+    while written < n_words:
+        kind = rng.random()
+        if blocks and kind < 0.10:
+            text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 7))).capitalize()
+            blocks.append(f'<h2>{text}</h2>')
+        elif kind < 0.15:
+            items = [_sentence(rng, 4, 10) for _ in range(rng.randint(3, 6))]
+            blocks.append('<ul>' + ''.join(f'<li>{item}</li>' for item in items) + '</ul>')
+            written += sum(len(item.split()) for item in items)
+        elif kind < 0.18:
+            quote = _sentence(rng, 10, 30)
+            blocks.append(f'<blockquote><p>{quote}</p></blockquote>')
+            written += len(quote.split())
+        elif kind < 0.19:
+            lines = '\n'.join(f'{rng.choice(WORDS)} = {rng.randint(0, 999)}' for _ in range(rng.randint(2, 8)))
+            blocks.append(f'<pre><code>{lines}</code></pre>')
+        elif kind < 0.22:
+            blocks.append(f'<p><img src="https://images.example.com/{rng.randint(1, 10 ** 6)}.jpg" '
+                          f'alt="{rng.choice(WORDS)}"></p>')
+        else:
+            sentences = [_sentence(rng) for _ in range(rng.randint(2, 6))]
+            if rng.random() < 0.2:
+                sentences[-1] = (f'{sentences[-1]} <a href="/post/post-{rng.randint(1, post_count)}">'
+                                 f'{rng.choice(WORDS)} {rng.choice(WORDS)}</a>.')
+            blocks.append('<p>' + ' '.join(sentences) + '</p>')
+            written += sum(len(sentence.split()) for sentence in sentences)
+    return '\n'.join(blocks)
+
+
+def taxonomy(n_tags=TAGS, n_categories=CATEGORIES, seed=SEED):
+    """``(tag names, category names, author usernames)`` of a dataset"""
+    rng = random.Random(seed)
+    categories = _names(rng, n_categories, TOPICS, SUBJECTS)
+    tags = _names(rng, n_tags, SUBJECTS, TOPICS)
+    authors = [f'reporter{i}' for i in range(1, AUTHORS + 1)]
+    return tags, categories, authors
+
+
+def generate(n_posts=POSTS, n_tags=TAGS, n_categories=CATEGORIES, seed=SEED):
+    """Yield import records (see bulk.FIELDS) for ``n_posts`` posts, oldest first"""
+    tags, categories, authors = taxonomy(n_tags, n_categories, seed)
+    rng = random.Random(seed)
+    tag_weights = _zipf_weights(len(tags), TAG_SKEW)
+    category_weights = _zipf_weights(len(categories), CATEGORY_SKEW)
+    start = datetime(2024, 1, 1)
+    step = timedelta(days=365 * YEARS) / max(n_posts, 1)
+    for i in range(1, n_posts + 1):
+        n_words = int(min(MAX_WORDS, max(MIN_WORDS, rng.lognormvariate(math.log(MEDIAN_WORDS), WORDS_SIGMA))))
+        created = start + step * i + timedelta(seconds=rng.randint(0, 3600))
+        updated = created + timedelta(hours=rng.randint(1, 72)) if rng.random() < 0.3 else created
+        n_post_tags = rng.choices(range(len(TAGS_PER_POST)), weights=TAGS_PER_POST)[0]
+        post_tags = set(rng.choices(tags, weights=tag_weights, k=n_post_tags)) if tags else set()
+        title = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(4, 10))).capitalize()
+        yield {
+            'title': title,
+            'slug': f'post-{i}',
+            'summary': _sentence(rng, 15, 35) if rng.random() < 0.7 else None,
+            'content': _body(rng, n_words, n_posts),
+            'category': rng.choices(categories, weights=category_weights)[0] if categories else None,
+            'tags': sorted(post_tags),
+            'author': rng.choice(authors),
+            'published': rng.random() < PUBLISHED_SHARE,
+            'created_at': created.isoformat(),
+            'updated_at': updated.isoformat(),
+            'meta_description': title[:160],
+        }
+
+
+def seed(n_posts=POSTS, n_tags=TAGS, n_categories=CATEGORIES, seed=SEED, log=None):
+    """Fill the configured (empty) database with the dataset
+
+    Call it with the app imported against the target DATABASE_URL.
+    """
+    sys.path.insert(0, ROOT)
+    from slugify import slugify
+    from werkzeug.security import generate_password_hash
+    from app import app, db
+    from models import Category, Tag, User
+    import bulk
+
+    tags, categories, authors = taxonomy(n_tags, n_categories, seed)
+    with app.app_context():
+        db.create_all()
+        admin = User(username=ADMIN_USERNAME, email='admin@example.com',
+                     password_hash=generate_password_hash(ADMIN_PASSWORD), is_admin=True)
+        db.session.add(admin)
+        db.session.add_all(User(username=name, email=f'{name}@example.com',
+                                password_hash=generate_password_hash(ADMIN_PASSWORD)) for name in authors)
+        # Created up front so that unused tags and categories exist too
+        db.session.add_all(Category(name=name, slug=slugify(name)) for name in categories)
+        db.session.add_all(Tag(name=name, slug=slugify(name)) for name in tags)
+        db.session.commit()
+
+        records = io.StringIO(''.join(json.dumps(record) + '\n'
+                                      for record in generate(n_posts, n_tags, n_categories, seed)))
+        result = bulk.import_posts(records, 'jsonl', default_author_id=admin.id, log=log)
+        if result.skipped:
+            raise RuntimeError(f'{result.skipped} generated posts were rejected: {result.errors[:3]}')
+        return result.imported
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--database', help='URL of an empty database to seed')
+    target.add_argument('--jsonl', type=argparse.FileType('w', encoding='utf-8'),
+                        help='Write the import records here instead')
+    parser.add_argument('--posts', type=int, default=POSTS)
+    parser.add_argument('--tags', type=int, default=TAGS)
+    parser.add_argument('--categories', type=int, default=CATEGORIES)
+    parser.add_argument('--seed', type=int, default=SEED)
+    args = parser.parse_args()
+
+    if args.jsonl:
+        for record in generate(args.posts, args.tags, args.categories, args.seed):
+            args.jsonl.write(json.dumps(record) + '\n')
+        return
+    os.environ['DATABASE_URL'] = args.database
+    imported = seed(args.posts, args.tags, args.categories, args.seed, log=print)
+    print(f'Seeded {imported} posts, {args.tags} tags and {args.categories} categories')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+"""Load-test the database engine profiles (db_profiles.py) under gunicorn.
+
+For each profile this seeds a throwaway database and starts gunicorn with
+DB_ENGINE_PROFILE set. Client threads then request the home, post, category
+and tag pages, while writer processes commit small transactions (a post
+edit plus a queued job) the way admin saves and uploads do. It prints
+throughput, latency percentiles and errors for each profile.
+
+SQL Server is included only when --mssql-url points at an empty database
+that can be written to; it is seeded the same way through SQLAlchemy.
+
+Usage:
+    python benchmarks/engine_benchmark.py [--profiles sqlite-dev,sqlite-prod-wal]
+        [--mssql-url mssql+pyodbc://...] [--workers 4] [--clients 16]
+        [--writers 2] [--duration 20] [--posts 2000]
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CATEGORIES = 20
+TAGS = 300
+
+
+def seed(n_posts):
+    """Fill the configured database with synthetic posts (child process)
+
+    Ids are left to the database, so it must be empty for them to run 1..n.
+    """
+    sys.path.insert(0, ROOT)
+    from sqlalchemy import insert
+    from app import app, db
+    from models import Category, Post, Tag, User, post_tags
+
+    rng = random.Random(42)
+    now = datetime.utcnow()
+    body = '<p>' + 'Lorem ipsum dolor sit amet. ' * 80 + '</p>'
+    with app.app_context():
+        db.create_all()
+        db.session.execute(insert(User), [{'username': 'bench', 'email': 'bench@example.com',
+                                           'password_hash': 'x', 'is_admin': True}])
+        db.session.execute(insert(Category), [{'name': f'Category {i}', 'slug': f'category-{i}'}
+                                              for i in range(1, CATEGORIES + 1)])
+        db.session.execute(insert(Tag), [{'name': f'Tag {i}', 'slug': f'tag-{i}'}
+                                         for i in range(1, TAGS + 1)])
+        for start in range(1, n_posts + 1, 1000):
+            posts, links = [], []
+            for i in range(start, min(start + 1000, n_posts + 1)):
+                created = now - timedelta(minutes=rng.randint(0, 60 * 24 * 365 * 5))
+                posts.append({'title': f'Post {i}', 'slug': f'post-{i}', 'content': body,
+                              'excerpt': 'Lorem ipsum dolor sit amet.', 'word_count': 400,
+                              'published': True, 'created_at': created, 'updated_at': created,
+                              'author_id': 1, 'category_id': rng.randint(1, CATEGORIES)})
+                links.extend({'post_id': i, 'tag_id': tag_id}
+                             for tag_id in rng.sample(range(1, TAGS + 1), rng.randint(1, 5)))
+            db.session.execute(insert(Post), posts)
+            db.session.execute(insert(post_tags), links)
+        db.session.commit()
+
+
+def write_loop(duration, n_posts):
+    """Commit small write transactions until ``duration`` is up (child process)"""
+    sys.path.insert(0, ROOT)
+    from sqlalchemy import update
+    from sqlalchemy.exc import OperationalError
+    from app import app, db
+    from models import Job, Post
+
+    rng = random.Random()
+    commits = errors = 0
+    latencies = []
+    deadline = time.monotonic() + duration
+    with app.app_context():
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            try:
+                db.session.execute(update(Post).where(Post.id == rng.randint(1, n_posts))
+                                   .values(updated_at=datetime.utcnow()))
+                db.session.add(Job(kind='benchmark', payload='{}', status='done'))
+                db.session.commit()
+                commits += 1
+                latencies.append((time.perf_counter() - start) * 1000)
+            except OperationalError:
+                db.session.rollback()
+                errors += 1
+            time.sleep(0.01)
+    print(json.dumps({'commits': commits, 'errors': errors, 'latencies': latencies}))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=5).read()
+            return
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.2)
+    raise RuntimeError(f'The server did not answer {url} within {timeout}s')
+
+
+def client(base, n_posts, deadline, latencies, errors):
+    rng = random.Random()
+    paths = [
+        lambda: '/',
+        lambda: f'/?page={rng.randint(2, 5)}',
+        lambda: f'/post/post-{rng.randint(1, n_posts)}',
+        lambda: f'/category/category-{rng.randint(1, CATEGORIES)}',
+        lambda: f'/tag/tag-{rng.randint(1, TAGS)}',
+    ]
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            urllib.request.urlopen(base + rng.choice(paths)(), timeout=30).read()
+            latencies.append((time.perf_counter() - start) * 1000)
+        except (urllib.error.URLError, ConnectionError, TimeoutError):
+            errors.append(1)
+
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def run_profile(profile, url, args):
+    env = dict(os.environ, DATABASE_URL=url, DB_ENGINE_PROFILE=profile,
+               PAGE_CACHE_ENABLED='False', TASK_QUEUE_EAGER='False')
+    script = os.path.abspath(__file__)
+    subprocess.run([sys.executable, script, '--seed', str(args.posts)], env=env, cwd=ROOT, check=True)
+
+    port = free_port()
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-w', str(args.workers), '-b', f'127.0.0.1:{port}',
+         '--log-level', 'warning', 'app:app'],
+        env=env, cwd=ROOT)
+    try:
+        base = f'http://127.0.0.1:{port}'
+        wait_for(base + '/')
+        writers = [subprocess.Popen([sys.executable, script, '--write', str(args.duration), str(args.posts)],
+                                    env=env, cwd=ROOT, stdout=subprocess.PIPE, text=True)
+                   for _ in range(args.writers)]
+        latencies, errors = [], []
+        deadline = time.monotonic() + args.duration
+        threads = [threading.Thread(target=client, args=(base, args.posts, deadline, latencies, errors))
+                   for _ in range(args.clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        writes = [json.loads(w.communicate()[0].strip().splitlines()[-1]) for w in writers]
+    finally:
+        server.terminate()
+        server.wait()
+
+    write_latencies = [ms for w in writes for ms in w['latencies']]
+    return {
+        'profile': profile,
+        'rps': len(latencies) / args.duration,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'errors': len(errors),
+        'writes': sum(w['commits'] for w in writes) / args.duration,
+        'write_p95': percentile(write_latencies, 95),
+        'write_errors': sum(w['errors'] for w in writes),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--profiles', default='sqlite-dev,sqlite-prod-wal')
+    parser.add_argument('--mssql-url', help='Empty SQL Server database to benchmark the mssql profile on')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn worker processes')
+    parser.add_argument('--clients', type=int, default=16, help='concurrent client threads')
+    parser.add_argument('--writers', type=int, default=2, help='concurrent writer processes')
+    parser.add_argument('--duration', type=int, default=20, help='seconds per profile')
+    parser.add_argument('--posts', type=int, default=2000)
+    parser.add_argument('--seed', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--write', type=int, nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        return seed(args.seed)
+    if args.write is not None:
+        return write_loop(*args.write)
+
+    profiles = [p for p in args.profiles.split(',') if p]
+    if args.mssql_url and 'mssql' not in profiles:
+        profiles.append('mssql')
+
+    tmp = tempfile.mkdtemp()
+    results = []
+    try:
+        for profile in profiles:
+            if profile == 'mssql':
+                if not args.mssql_url:
+                    print('Skipping mssql: pass --mssql-url')
+                    continue
+                url = args.mssql_url
+            else:
+                url = f"sqlite:///{os.path.join(tmp, profile + '.db')}"
+            print(f'Running {profile} ({args.workers} workers, {args.clients} clients, '
+                  f'{args.writers} writers, {args.duration}s) ...')
+            results.append(run_profile(profile, url, args))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    print(f"\n{'profile':<18}{'req/s':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'errors':>8}"
+          f"{'writes/s':>10}{'write p95':>11}{'w errors':>10}")
+    for r in results:
+        print(f"{r['profile']:<18}{r['rps']:8.1f}{r['p50']:9.1f}{r['p95']:9.1f}{r['p99']:9.1f}{r['errors']:8d}"
+              f"{r['writes']:10.1f}{r['write_p95']:11.1f}{r['write_errors']:10d}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""Compare query plans and latency of the listing queries with and without
+the indexes added in migration f80d1195ac37.
+
+Seeds a throwaway SQLite database (100k posts by default), runs the queries
+behind the home, category and tag pages with the indexes dropped, then again
+with them created, and prints the plan and median latency of each.
+
+Usage:
+    python benchmarks/index_benchmark.py [--posts 100000] [--runs 5]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+INDEXES = {
+    'ix_post_published_created_at': 'post (published, created_at)',
+    'ix_post_category_id_published_created_at': 'post (category_id, published, created_at)',
+    'ix_post_tags_tag_id_post_id': 'post_tags (tag_id, post_id)',
+}
+
+
+def seed(path, n_posts, n_categories, n_tags):
+    """Fill the database with synthetic posts using plain sqlite3 executemany"""
+    rng = random.Random(42)
+    conn = sqlite3.connect(path)
+    now = datetime.utcnow()
+    conn.execute("INSERT INTO user (id, username, email, password_hash, is_admin) VALUES (1, 'bench', 'bench@example.com', 'x', 1)")
+    conn.executemany("INSERT INTO category (id, name, slug) VALUES (?, ?, ?)",
+                     [(i, f'Category {i}', f'category-{i}') for i in range(1, n_categories + 1)])
+    conn.executemany("INSERT INTO tag (id, name, slug) VALUES (?, ?, ?)",
+                     [(i, f'Tag {i}', f'tag-{i}') for i in range(1, n_tags + 1)])
+    body = '<p>' + 'Lorem ipsum dolor sit amet. ' * 80 + '</p>'
+    posts, links = [], []
+    for i in range(1, n_posts + 1):
+        created = now - timedelta(minutes=rng.randint(0, 60 * 24 * 365 * 5))
+        posts.append((i, f'Post {i}', f'post-{i}', 'Summary', body, rng.random() < 0.9,
+                      created, created, 1, rng.randint(1, n_categories)))
+        for tag_id in rng.sample(range(1, n_tags + 1), rng.randint(1, 5)):
+            links.append((i, tag_id))
+    conn.executemany(
+        "INSERT INTO post (id, title, slug, summary, content, published, created_at, updated_at, author_id, category_id) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", posts)
+    conn.executemany("INSERT INTO post_tags (post_id, tag_id) VALUES (?, ?)", links)
+    conn.commit()
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--posts', type=int, default=100000)
+    parser.add_argument('--categories', type=int, default=20)
+    parser.add_argument('--tags', type=int, default=300)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    os.environ['DATABASE_URL'] = f'sqlite:///{path}'
+    sys.path.insert(0, ROOT)
+    from app import app, db
+    from models import Category, Tag
+    import queries
+
+    with app.app_context():
+        db.create_all()
+        print(f'Seeding {args.posts} posts into {path} ...')
+        seed(path, args.posts, args.categories, args.tags)
+
+        cases = {
+            'home page 1': lambda: queries.index_posts().limit(6),
+            'home page 500 (offset)': lambda: queries.index_posts().offset(6 * 499).limit(6),
+            'home count': lambda: queries.index_posts().order_by(None),
+            'category page 1': lambda: queries.category_posts(db.session.get(Category, 1)).limit(6),
+            'tag page 1': lambda: queries.tag_posts(db.session.get(Tag, 1)).limit(6),
+        }
+
+        def run(label):
+            print(f'\n=== {label} ===')
+            for name, build in cases.items():
+                query = build()
+                sql = str(query.statement.compile(db.engine, compile_kwargs={'literal_binds': True}))
+                plan = db.session.execute(db.text('EXPLAIN QUERY PLAN ' + sql)).all()
+                timings = []
+                for _ in range(args.runs):
+                    start = time.perf_counter()
+                    query.count() if name.endswith('count') else query.all()
+                    timings.append((time.perf_counter() - start) * 1000)
+                    db.session.expunge_all()
+                print(f'{name:<28} median {statistics.median(timings):9.2f} ms')
+                for row in plan:
+                    print(f'    {row[-1]}')
+
+        for index in INDEXES:
+            db.session.execute(db.text(f'DROP INDEX IF EXISTS {index}'))
+        db.session.execute(db.text('ANALYZE'))
+        db.session.commit()
+        run('without indexes')
+
+        for index, definition in INDEXES.items():
+            db.session.execute(db.text(f'CREATE INDEX {index} ON {definition}'))
+        db.session.execute(db.text('ANALYZE'))
+        db.session.commit()
+        run('with indexes')
+
+
+if __name__ == '__main__':
+    main()
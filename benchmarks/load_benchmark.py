@@ -0,0 +1,206 @@
+"""Concurrent HTTP load test of the public pages, checked against a baseline.
+
+Seeds a throwaway database with benchmarks/dataset.py (or uses --database)
+and serves it with gunicorn. Client threads then replay a reader traffic mix
+(home and archive pages, posts, categories, tags and searches) for
+--duration seconds. It prints throughput, p50/p99 latency, errors, mean
+response size and SQL statements per request, the last read from the
+server's own /metrics, and compares them against benchmarks/baseline.json.
+
+Usage:
+    python benchmarks/load_benchmark.py [--workers 4] [--clients 16]
+        [--duration 20] [--posts 2000] [--tags 300] [--categories 20]
+        [--database sqlite:////tmp/bench.db] [--page-cache] [--check] [--save]
+
+--check exits with status 1 on a regression; --save records the results as
+the new baseline.
+"""
+import argparse
+import os
+import random
+import re
+import secrets
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import baseline
+import dataset
+from engine_benchmark import ROOT, free_port, percentile, wait_for
+
+# (weight, path); {post}, {category} and {tag} are drawn from the dataset
+# with the same Zipf skew as its tags, so popular pages get most traffic
+TRAFFIC = [
+    (25, '/'),
+    (8, '/?page={page}'),
+    (40, '/post/post-{post}'),
+    (10, '/category/{category}'),
+    (12, '/tag/{tag}'),
+    (5, '/search?q={word}'),
+]
+
+METRIC_LINE = re.compile(r'^(blog_\w+)\{endpoint="([^"]*)"\} (\S+)$')
+
+
+def paths(n_posts, n_tags, n_categories):
+    """An endless, reproducible stream of request paths"""
+    from slugify import slugify
+
+    tags, categories, _ = dataset.taxonomy(n_tags, n_categories)
+    tags = [slugify(name) for name in tags]
+    categories = [slugify(name) for name in categories]
+    tag_weights = dataset._zipf_weights(len(tags), dataset.TAG_SKEW)
+    category_weights = dataset._zipf_weights(len(categories), dataset.CATEGORY_SKEW)
+    post_weights = dataset._zipf_weights(n_posts, 1.0)[::-1]  # recent posts are read most
+    weights, templates = zip(*TRAFFIC)
+
+    def next_path(rng):
+        return rng.choices(templates, weights=weights)[0].format(
+            page=rng.randint(2, 5),  # the pages linked by number
+            post=rng.choices(range(1, n_posts + 1), weights=post_weights)[0],
+            category=rng.choices(categories, weights=category_weights)[0],
+            tag=rng.choices(tags, weights=tag_weights)[0],
+            word=rng.choice(dataset.WORDS[40:]),
+        )
+    return next_path
+
+
+def client(base, next_path, seed, deadline, samples, errors):
+    rng = random.Random(seed)
+    while time.monotonic() < deadline:
+        path = next_path(rng)
+        start = time.perf_counter()
+        try:
+            size = len(urllib.request.urlopen(base + path, timeout=30).read())
+            samples.append(((time.perf_counter() - start) * 1000, size))
+        except urllib.error.HTTPError as e:
+            # Drafts answer 404 like a missing post; anything else is a failure
+            if e.code != 404:
+                errors.append(f'{e.code} {path}')
+        except (urllib.error.URLError, ConnectionError, TimeoutError) as e:
+            errors.append(f'{e} {path}')
+
+
+def server_metrics(base, token):
+    """``{metric: {endpoint: value}}`` from the server's /metrics"""
+    request = urllib.request.Request(base + '/metrics', headers={'Authorization': f'Bearer {token}'})
+    values = {}
+    for line in urllib.request.urlopen(request, timeout=30).read().decode().splitlines():
+        match = METRIC_LINE.match(line)
+        if match:
+            name, endpoint, value = match.groups()
+            values.setdefault(name, {})[endpoint] = float(value)
+    return values
+
+
+def run(url, args):
+    metrics_dir = tempfile.mkdtemp()
+    token = secrets.token_hex(16)
+    env = dict(os.environ, DATABASE_URL=url, PAGE_CACHE_ENABLED=str(args.page_cache), TASK_QUEUE_EAGER='False',
+               METRICS_ENABLED='True', METRICS_DIR=metrics_dir, METRICS_TOKEN=token, PROFILE_SAMPLE_RATE='0')
+    port = free_port()
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-w', str(args.workers), '-b', f'127.0.0.1:{port}',
+         '--log-level', 'warning', 'app:app'],
+        env=env, cwd=ROOT)
+    try:
+        base = f'http://127.0.0.1:{port}'
+        wait_for(base + '/')
+        next_path = paths(args.posts, args.tags, args.categories)
+        # Warm up each worker's caches before measuring
+        warmup = random.Random(0)
+        for _ in range(args.workers * 20):
+            try:
+                urllib.request.urlopen(base + next_path(warmup), timeout=30).read()
+            except urllib.error.HTTPError:
+                pass
+        before = server_metrics(base, token)
+        samples, errors = [], []
+        deadline = time.monotonic() + args.duration
+        threads = [threading.Thread(target=client, args=(base, next_path, seed, deadline, samples, errors))
+                   for seed in range(args.clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Workers write their totals every few seconds; wait for the last ones
+        time.sleep(6)
+        after = server_metrics(base, token)
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+
+    def delta(metric):
+        return sum(value - before.get(metric, {}).get(endpoint, 0)
+                   for endpoint, value in after.get(metric, {}).items()
+                   if endpoint not in ('prometheus_metrics', 'static'))
+
+    latencies = [ms for ms, _ in samples]
+    requests = delta('blog_http_request_duration_seconds_count')
+    return {
+        'rps': round(len(samples) / args.duration, 1),
+        'p50_ms': round(percentile(latencies, 50), 2),
+        'p99_ms': round(percentile(latencies, 99), 2),
+        'errors': len(errors),
+        'bytes_per_response': round(sum(size for _, size in samples) / max(len(samples), 1)),
+        'queries_per_request': round(delta('blog_sql_statements_total') / requests, 2) if requests else None,
+    }, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn worker processes')
+    parser.add_argument('--clients', type=int, default=16, help='concurrent client threads')
+    parser.add_argument('--duration', type=int, default=20, help='seconds of load')
+    parser.add_argument('--posts', type=int, default=dataset.POSTS)
+    parser.add_argument('--tags', type=int, default=dataset.TAGS)
+    parser.add_argument('--categories', type=int, default=dataset.CATEGORIES)
+    parser.add_argument('--database', help='Database already seeded by benchmarks/dataset.py with these sizes')
+    parser.add_argument('--page-cache', action='store_true', help='Serve with PAGE_CACHE_ENABLED')
+    parser.add_argument('--check', action='store_true', help='Exit with status 1 on a regression')
+    parser.add_argument('--save', action='store_true', help='Record the results as the baseline')
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    try:
+        url = args.database or f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        if not args.database:
+            print(f'Seeding {args.posts} posts ...')
+            subprocess.run([sys.executable, os.path.join(ROOT, 'benchmarks', 'dataset.py'), '--database', url,
+                            '--posts', str(args.posts), '--tags', str(args.tags),
+                            '--categories', str(args.categories)], cwd=ROOT, check=True, stdout=subprocess.DEVNULL)
+        print(f'Running {args.workers} workers, {args.clients} clients, {args.duration}s ...')
+        result, errors = run(url, args)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    for error in errors[:10]:
+        print(f'Error: {error}')
+    print(f"\n{'req/s':>8}{'p50 ms':>9}{'p99 ms':>9}{'errors':>8}{'KB/resp':>9}{'queries/req':>13}")
+    print(f"{result['rps']:8.1f}{result['p50_ms']:9.1f}{result['p99_ms']:9.1f}{result['errors']:8d}"
+          f"{result['bytes_per_response'] / 1024:9.1f}{result['queries_per_request'] or 0:13.2f}")
+
+    scenario = 'page_cache' if args.page_cache else 'reader_mix'
+    params = {'posts': args.posts, 'tags': args.tags, 'categories': args.categories, 'seed': dataset.SEED,
+              'workers': args.workers, 'clients': args.clients}
+    if args.save:
+        recorded = baseline.load().get('load', {})
+        results = dict(recorded.get('results', {})) if recorded.get('dataset') == params else {}
+        results[scenario] = result
+        baseline.save('load', params, results)
+        print(f'\nSaved as the {scenario!r} baseline in {baseline.PATH}')
+        return
+    problems = baseline.regressions('load', params, {scenario: result})
+    print('\n' + ('\n'.join(problems) if problems else 'No regressions against the baseline'))
+    if args.check and problems:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
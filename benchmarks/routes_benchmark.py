@@ -0,0 +1,200 @@
+"""Microbenchmark every page handler in-process with the Flask test client.
+
+Seeds a throwaway database with benchmarks/dataset.py (or uses --database),
+then requests each GET route (public pages anonymously, admin pages signed
+in as the dataset's admin) with the page cache off, so the handlers
+themselves are measured. For each route it prints p50/p99 latency, the SQL
+statements run and the response size, and compares them against
+benchmarks/baseline.json. Routes that change data (POST) are left out.
+
+Usage:
+    python benchmarks/routes_benchmark.py [--runs 30] [--posts 2000]
+        [--tags 300] [--categories 20] [--database sqlite:////tmp/bench.db]
+        [--only index,post] [--check] [--save]
+
+--check exits with status 1 when a route regressed; --save records the
+results as the new baseline.
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import baseline
+import dataset
+from engine_benchmark import ROOT, percentile
+
+# (name, path, signed in as admin); paths are filled in from the dataset
+SCENARIOS = [
+    ('index', '/', False),
+    ('index_page_3', '/?page=3', False),
+    ('post', '/post/{post_slug}', False),
+    ('category', '/category/{category_slug}', False),
+    ('tag', '/tag/{tag_slug}', False),
+    ('search', '/search?q=council+budget', False),
+    ('about', '/about', False),
+    ('contact', '/contact', False),
+    ('login', '/login', False),
+    ('sitemap', '/sitemap.xml', False),
+    ('sitemap_pages', '/sitemap-pages.xml', False),
+    ('sitemap_posts', '/sitemap-posts-1.xml', False),
+    ('robots_txt', '/robots.txt', False),
+    ('admin', '/admin', True),
+    ('admin_posts', '/admin/posts', True),
+    ('new_post', '/admin/new-post', True),
+    ('edit_post', '/admin/edit-post/{post_id}', True),
+    ('admin_categories', '/admin/categories', True),
+    ('new_category', '/admin/new-category', True),
+    ('edit_category', '/admin/edit-category/{category_id}', True),
+    ('admin_tags', '/admin/tags', True),
+    ('new_tag', '/admin/new-tag', True),
+    ('edit_tag', '/admin/edit-tag/{tag_id}', True),
+    ('admin_users', '/admin/users', True),
+    ('new_user', '/admin/new-user', True),
+    ('edit_user', '/admin/edit-user/{user_id}', True),
+    ('admin_media', '/admin/media', True),
+    ('api_export_posts', '/admin/api/posts/export', True),
+]
+
+# GET endpoints deliberately not benchmarked
+SKIPPED = {
+    'static',  # files, not handlers
+    'logout',  # ends the session
+    'prometheus_metrics',  # output grows with the requests measured before it
+    'admin_media_status',  # needs an uploaded image
+}
+
+WARMUP = 3
+
+
+def targets():
+    """Values for the scenario paths: the busiest category and tag, a mid-list post"""
+    from sqlalchemy import func, select
+    from app import db
+    from models import Category, Post, Tag, User, post_tags
+
+    post_id, post_slug = db.session.execute(
+        select(Post.id, Post.slug).where(Post.published == True).order_by(Post.id)
+        .offset(db.session.scalar(select(func.count()).select_from(Post)) // 2).limit(1)).one()
+    category_id, category_slug = db.session.execute(
+        select(Category.id, Category.slug).join(Post, Post.category_id == Category.id)
+        .group_by(Category.id).order_by(func.count().desc(), Category.id).limit(1)).one()
+    tag_id, tag_slug = db.session.execute(
+        select(Tag.id, Tag.slug).join(post_tags, post_tags.c.tag_id == Tag.id)
+        .group_by(Tag.id).order_by(func.count().desc(), Tag.id).limit(1)).one()
+    user_id = db.session.scalar(select(User.id).where(User.username != dataset.ADMIN_USERNAME).order_by(User.id))
+    return {'post_id': post_id, 'post_slug': post_slug, 'category_id': category_id,
+            'category_slug': category_slug, 'tag_id': tag_id, 'tag_slug': tag_slug, 'user_id': user_id}
+
+
+def run(runs, only=None):
+    """``{route name: {p50_ms, p99_ms, queries, bytes}}`` for the configured database"""
+    sys.path.insert(0, ROOT)
+    from sqlalchemy import event
+    from app import app, db
+    from models import User
+
+    statements = [0]
+
+    def count(*args):
+        statements[0] += 1
+
+    results = {}
+    with app.app_context():
+        for engine in db.engines.values():
+            event.listen(engine, 'before_cursor_execute', count)
+        values = targets()
+        admin_id = db.session.scalar(db.select(User.id).where(User.username == dataset.ADMIN_USERNAME))
+        db.session.remove()
+
+    check_coverage(app, [path.format(**values) for _, path, _ in SCENARIOS])
+    anonymous = app.test_client()
+    admin = app.test_client()
+    with admin.session_transaction() as session:
+        session['_user_id'] = str(admin_id)
+        session['_fresh'] = True
+
+    for name, path, as_admin in SCENARIOS:
+        if only and name not in only:
+            continue
+        client = admin if as_admin else anonymous
+        path = path.format(**values)
+        for _ in range(WARMUP):
+            response = client.get(path, buffered=True)
+            if response.status_code != 200:
+                raise RuntimeError(f'{name}: GET {path} answered {response.status_code}')
+        latencies, queries = [], []
+        for _ in range(runs):
+            statements[0] = 0
+            start = time.perf_counter()
+            # Buffered, so streamed responses are timed to their last byte
+            response = client.get(path, buffered=True)
+            body = response.get_data()
+            latencies.append((time.perf_counter() - start) * 1000)
+            queries.append(statements[0])
+        results[name] = {
+            'p50_ms': round(percentile(latencies, 50), 2),
+            'p99_ms': round(percentile(latencies, 99), 2),
+            'queries': percentile(queries, 50),
+            'bytes': len(body),
+        }
+    return results
+
+
+def check_coverage(app, paths):
+    """Warn about GET routes added since SCENARIOS was last updated"""
+    adapter = app.url_map.bind('localhost')
+    covered = {adapter.match(path.split('?')[0])[0] for path in paths}
+    for rule in app.url_map.iter_rules():
+        if 'GET' in rule.methods and rule.endpoint not in covered | SKIPPED:
+            print(f'Warning: {rule.rule} ({rule.endpoint}) is not benchmarked; add it to SCENARIOS or SKIPPED')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=30, help='timed requests per route')
+    parser.add_argument('--posts', type=int, default=dataset.POSTS)
+    parser.add_argument('--tags', type=int, default=dataset.TAGS)
+    parser.add_argument('--categories', type=int, default=dataset.CATEGORIES)
+    parser.add_argument('--database', help='Database already seeded by benchmarks/dataset.py with these sizes')
+    parser.add_argument('--only', help='Comma-separated route names to run')
+    parser.add_argument('--check', action='store_true', help='Exit with status 1 on a regression')
+    parser.add_argument('--save', action='store_true', help='Record the results as the baseline')
+    args = parser.parse_args()
+    if args.save and args.only:
+        parser.error('--save records every route; drop --only')
+
+    tmp = tempfile.mkdtemp()
+    try:
+        url = args.database or f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        if not args.database:
+            print(f'Seeding {args.posts} posts ...')
+            subprocess.run([sys.executable, os.path.join(ROOT, 'benchmarks', 'dataset.py'), '--database', url,
+                            '--posts', str(args.posts), '--tags', str(args.tags),
+                            '--categories', str(args.categories)], cwd=ROOT, check=True, stdout=subprocess.DEVNULL)
+        os.environ.update(DATABASE_URL=url, PAGE_CACHE_ENABLED='False', TASK_QUEUE_EAGER='False')
+        only = set(args.only.split(',')) if args.only else None
+        results = run(args.runs, only)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    print(f"\n{'route':<20}{'p50 ms':>9}{'p99 ms':>9}{'queries':>9}{'KB':>9}")
+    for name, r in results.items():
+        print(f"{name:<20}{r['p50_ms']:9.1f}{r['p99_ms']:9.1f}{r['queries']:9d}{r['bytes'] / 1024:9.1f}")
+
+    params = {'posts': args.posts, 'tags': args.tags, 'categories': args.categories, 'seed': dataset.SEED}
+    if args.save:
+        baseline.save('routes', params, results)
+        print(f'\nSaved as the baseline in {baseline.PATH}')
+        return
+    problems = baseline.regressions('routes', params, results)
+    print('\n' + ('\n'.join(problems) if problems else 'No regressions against the baseline'))
+    if args.check and problems:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""Time to first byte of the home, post and category pages, buffered vs streamed.
+
+Seeds a throwaway database with benchmarks/dataset.py (or uses --database)
+and serves it with gunicorn twice, with STREAM_TEMPLATES off and on. A
+single client requests the home page, the longest posts and the busiest
+category like a browser does (Accept-Encoding: br, gzip) and records the
+time until the response starts (TTFB) and until its last byte, so the two
+modes' medians can be compared.
+
+Usage:
+    python benchmarks/streaming_benchmark.py [--requests 200]
+        [--sidebar-cache-ttl 300] [--database sqlite:////tmp/bench.db]
+
+--sidebar-cache-ttl 0 loads the sidebar on every request, the cost a
+streamed page defers until the sidebar is rendered.
+"""
+import argparse
+import http.client
+import os
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import dataset
+from engine_benchmark import ROOT, free_port, percentile, wait_for
+
+
+def pages(database_path):
+    """The paths requested: home, the three longest posts and the busiest category"""
+    connection = sqlite3.connect(database_path)
+    try:
+        posts = connection.execute(
+            'SELECT slug FROM post WHERE published = 1 ORDER BY length(content) DESC LIMIT 3').fetchall()
+        category = connection.execute(
+            'SELECT c.slug FROM category c JOIN post p ON p.category_id = c.id '
+            'GROUP BY c.id ORDER BY count(*) DESC LIMIT 1').fetchone()
+    finally:
+        connection.close()
+    return {'index': ['/'], 'post': [f'/post/{slug}' for slug, in posts], 'category': [f'/category/{category[0]}']}
+
+
+def measure(port, path):
+    """``(ttfb_ms, total_ms)`` of one request"""
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        start = time.perf_counter()
+        connection.request('GET', path, headers={'Accept-Encoding': 'br, gzip'})
+        # The status line is the first byte; headers only go out with the first part
+        response = connection.getresponse()
+        first = time.perf_counter()
+        response.read()
+        return (first - start) * 1000, (time.perf_counter() - start) * 1000
+    finally:
+        connection.close()
+
+
+def run(url, paths, stream, args):
+    env = dict(os.environ, DATABASE_URL=url, STREAM_TEMPLATES=str(stream), PAGE_CACHE_ENABLED='False',
+               SIDEBAR_CACHE_TTL=str(args.sidebar_cache_ttl), TASK_QUEUE_EAGER='False', METRICS_ENABLED='False')
+    port = free_port()
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-w', '1', '-b', f'127.0.0.1:{port}', '--log-level', 'warning', 'app:app'],
+        env=env, cwd=ROOT)
+    try:
+        wait_for(f'http://127.0.0.1:{port}/')
+        results = {}
+        for name, group in paths.items():
+            for path in group * 5:
+                measure(port, path)  # warm up
+            samples = [measure(port, group[i % len(group)]) for i in range(args.requests)]
+            results[name] = {
+                'ttfb_p50_ms': statistics.median(ttfb for ttfb, _ in samples),
+                'ttfb_p99_ms': percentile([ttfb for ttfb, _ in samples], 99),
+                'total_p50_ms': statistics.median(total for _, total in samples),
+            }
+        return results
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=200, help='requests per page and mode')
+    parser.add_argument('--sidebar-cache-ttl', type=int, default=300, help='SIDEBAR_CACHE_TTL of the server')
+    parser.add_argument('--database', help='SQLite URL of a database seeded by benchmarks/dataset.py')
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    try:
+        url = args.database or f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        if not args.database:
+            print(f'Seeding {dataset.POSTS} posts ...')
+            subprocess.run([sys.executable, os.path.join(ROOT, 'benchmarks', 'dataset.py'), '--database', url],
+                           cwd=ROOT, check=True, stdout=subprocess.DEVNULL)
+        paths = pages(url[len('sqlite:///'):])
+        results = {stream: run(url, paths, stream, args) for stream in (False, True)}
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    print(f"\n{'page':<10}{'mode':<10}{'TTFB p50':>10}{'TTFB p99':>10}{'total p50':>11}")
+    for name in paths:
+        for stream in (False, True):
+            result = results[stream][name]
+            print(f"{name:<10}{'streamed' if stream else 'buffered':<10}{result['ttfb_p50_ms']:10.2f}"
+                  f"{result['ttfb_p99_ms']:10.2f}{result['total_p50_ms']:11.2f}")
+
+
+if __name__ == '__main__':
+    main()
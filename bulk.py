@@ -0,0 +1,398 @@
+import csv
+import io
+import json
+import os
+from collections import Counter, defaultdict, deque, namedtuple
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import insert, select
+
+from app import db
+from content import process_content, slugify
+from images import add_references, media_references
+from models import Category, Post, Tag, User, post_tags
+from pagination import invalidate_counts
+from sidebar import invalidate_sidebar
+import aggregates
+import page_cache
+import related
+import search as search_index
+
+# Columns of an export, and what an import reads. Category, tags and author
+# are given by name (username for the author); tags are a list in JSONL and
+# comma-separated in CSV.
+FIELDS = (
+    'title', 'slug', 'summary', 'content', 'category', 'tags', 'author', 'published',
+    'created_at', 'updated_at', 'featured_image', 'meta_description', 'meta_keywords',
+)
+FORMATS = ('jsonl', 'csv')
+
+# Records per batch: sanitized together, inserted in one transaction
+BATCH_SIZE = 500
+
+# Errors kept in an ImportResult (the count of skipped records is exact)
+MAX_ERRORS = 100
+
+# Up to this many imported posts get their related posts updated one by one;
+# larger imports recompute every post's related posts in one pass
+RELATED_UPDATE_LIMIT = 50
+
+# Longest generated slug base, leaving room for a "-N" suffix
+SLUG_LENGTH = 240
+
+ImportResult = namedtuple('ImportResult', 'imported skipped errors')
+
+csv.field_size_limit(2 ** 31 - 1)  # post bodies are longer than the 128 KiB default
+
+
+def detect_format(filename, default='jsonl'):
+    """``'jsonl'`` or ``'csv'`` from a file name's extension"""
+    extension = os.path.splitext(filename or '')[1].lower()
+    if extension == '.csv':
+        return 'csv'
+    if extension in ('.jsonl', '.ndjson', '.json'):
+        return 'jsonl'
+    return default
+
+
+def read_records(stream, fmt):
+    """Yield ``(line number, record dict or the error reading it)`` from a text stream"""
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield number, ValueError(f'invalid JSON: {e}')
+            continue
+        yield number, record if isinstance(record, dict) else ValueError('not a JSON object')
+
+
+def _text(value):
+    return value.strip() if isinstance(value, str) and value.strip() else None
+
+
+def _boolean(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'y', 'on')
+    return bool(value)
+
+
+def _timestamp(value):
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(str(value).strip().replace('Z', '+00:00'))
+    except ValueError:
+        raise ValueError(f'invalid date {value!r}')
+    if parsed.tzinfo is not None:
+        # Stored as naive UTC, like datetime.utcnow()
+        parsed = (parsed - parsed.utcoffset()).replace(tzinfo=None)
+    return parsed
+
+
+def _normalize(record):
+    """The fields of an import record, checked and converted"""
+    title = _text(record.get('title'))
+    if title is None or not _text(record.get('content')):
+        raise ValueError('title and content are required')
+    tags = record.get('tags') or []
+    if isinstance(tags, str):
+        tags = tags.split(',')
+    return {
+        'title': title,
+        'slug': slugify(record.get('slug') or '')[:SLUG_LENGTH] or None,
+        'summary': _text(record.get('summary')),
+        'content': record['content'],
+        'category': _text(record.get('category')),
+        'tags': [name for name in (_text(tag) for tag in tags) if name],
+        'author': _text(record.get('author')),
+        'published': _boolean(record.get('published', False)),
+        'created_at': _timestamp(record.get('created_at')),
+        'updated_at': _timestamp(record.get('updated_at')),
+        'featured_image': _text(record.get('featured_image')),
+        'meta_description': _text(record.get('meta_description')),
+        'meta_keywords': _text(record.get('meta_keywords')),
+    }
+
+
+def _process_batch(bodies):
+    # Runs in the pool's worker processes
+    return [process_content(body) for body in bodies]
+
+
+def unique_slugs(wanted, skip=None):
+    """Free post slugs for ``wanted``, checked with one query per round
+
+    A taken slug gets the first free ``-1``, ``-2``... suffix, like the post
+    form does, or None where ``skip`` (a flag per slug) is set. Slugs
+    repeated within ``wanted`` count as taken.
+    """
+    taken = set(db.session.scalars(select(Post.slug).where(Post.slug.in_(set(wanted)))))
+    slugs = [None] * len(wanted)
+    claimed = set()
+    pending = defaultdict(list)  # base -> positions still without a slug
+    for position, slug in enumerate(wanted):
+        if slug in taken or slug in claimed:
+            if not (skip and skip[position]):
+                pending[slug].append(position)
+        else:
+            claimed.add(slug)
+            slugs[position] = slug
+
+    next_suffix = dict.fromkeys(pending, 1)
+    while pending:
+        candidates = {}
+        for base, positions in pending.items():
+            for offset in range(len(positions)):
+                candidates[f'{base}-{next_suffix[base] + offset}'] = base
+            next_suffix[base] += len(positions)
+        taken = set(db.session.scalars(select(Post.slug).where(Post.slug.in_(candidates))))
+        for candidate, base in candidates.items():
+            if candidate not in taken and candidate not in claimed and pending.get(base):
+                claimed.add(candidate)
+                slugs[pending[base].pop(0)] = candidate
+        pending = {base: positions for base, positions in pending.items() if positions}
+    return slugs
+
+
+def _taxonomy_ids(model, names):
+    """``{name: id}`` for category or tag names, creating the missing ones"""
+    slugs = {name: slugify(name)[:50] for name in names}
+    slugs = {name: slug for name, slug in slugs.items() if slug}
+    found = dict(db.session.execute(
+        select(model.slug, model.id).where(model.slug.in_(set(slugs.values())))).all())
+    missing = {}
+    for name, slug in slugs.items():
+        if slug not in found and slug not in missing:
+            missing[slug] = model(name=name[:50], slug=slug)
+    if missing:
+        db.session.add_all(missing.values())
+        db.session.flush()
+        found.update((slug, obj.id) for slug, obj in missing.items())
+    return {name: found[slug] for name, slug in slugs.items()}
+
+
+def _write_batch(records, processed, default_author_id, skip_taken, touched):
+    """Insert one batch of normalized records and their processed bodies (commits)
+
+    Returns:
+        The ids of the posts inserted
+    """
+    # Slugs given in the file identify posts, so a re-run skips what it
+    # imported before; slugs made from titles are numbered like the form does
+    slugs = unique_slugs([record['slug'] or slugify(record['title'])[:SLUG_LENGTH] or 'post' for record in records],
+                         skip=[skip_taken and record['slug'] is not None for record in records])
+    batch = [(record, body, slug) for record, body, slug in zip(records, processed, slugs) if slug]
+    if not batch:
+        return []
+
+    category_ids = _taxonomy_ids(Category, {record['category'] for record, _, _ in batch if record['category']})
+    tag_ids = _taxonomy_ids(Tag, {name for record, _, _ in batch for name in record['tags']})
+    usernames = {record['author'] for record, _, _ in batch if record['author']}
+    author_ids = dict(db.session.execute(
+        select(User.username, User.id).where(User.username.in_(usernames))).all()) if usernames else {}
+
+    now = datetime.utcnow()
+    rows = []
+    references = Counter()
+    for record, body, slug in batch:
+        created_at = record['created_at'] or now
+        rows.append({
+            'title': record['title'][:255],
+            'slug': slug,
+            'summary': record['summary'],
+            'content': body.html,
+            'excerpt': body.excerpt,
+            'word_count': body.word_count,
+            'toc': json.dumps(body.toc) if body.toc else None,
+            'first_image': body.first_image,
+            'published': record['published'],
+            'featured_image': record['featured_image'],
+            'created_at': created_at,
+            'updated_at': record['updated_at'] or created_at,
+            'meta_description': record['meta_description'],
+            'meta_keywords': record['meta_keywords'],
+            'author_id': author_ids.get(record['author'], default_author_id),
+            'category_id': category_ids.get(record['category']),
+        })
+        references.update(media_references(record['featured_image'], body.html))
+    db.session.execute(insert(Post), rows)
+
+    ids = dict(db.session.execute(select(Post.slug, Post.id).where(Post.slug.in_([row['slug'] for row in rows]))).all())
+    links = {(ids[slug], tag_ids[name]) for record, _, slug in batch for name in record['tags'] if name in tag_ids}
+    if links:
+        db.session.execute(insert(post_tags), [{'post_id': post_id, 'tag_id': tag_id} for post_id, tag_id in links])
+    if references:
+        add_references(references)
+    aggregates.add_posts(ids.values())
+    search_index.get_search_backend().index_posts([
+        (ids[row['slug']], row['title'], row['summary'], row['content'], row['published'], row['created_at'])
+        for row in rows])
+    db.session.commit()
+
+    touched.update(f'category:{category_id}' for category_id in category_ids.values())
+    touched.update(f'tag:{tag_id}' for _, tag_id in links)
+    return list(ids.values())
+
+
+def import_posts(stream, fmt='jsonl', default_author_id=None, processes=None, batch_size=BATCH_SIZE,
+                 skip_taken=True, refresh_related=True, log=None):
+    """Import posts from a JSONL or CSV text stream
+
+    Bodies are sanitized on a pool of ``processes`` (defaults to
+    ``BULK_IMPORT_PROCESSES``, then the CPU count; 1 runs inline) while the
+    previous batches are written. Each batch is one transaction, so an
+    interrupted import keeps the batches committed before it; with
+    ``skip_taken`` (the default) re-running it skips records whose given
+    slug exists, otherwise they get a numbered slug. Missing categories and
+    tags are created; unknown authors fall back to ``default_author_id``.
+    Pass ``refresh_related=False`` when importing several files in a row,
+    then run ``related.rebuild()`` once.
+
+    Returns:
+        An ImportResult
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f'Unknown format {fmt!r}; expected one of {", ".join(FORMATS)}')
+    if default_author_id is None:
+        default_author_id = db.session.scalar(select(User.id).where(User.is_admin == True).order_by(User.id))
+        if default_author_id is None:
+            # Every post needs an author; fail before the first batch is written
+            raise ValueError('No admin user to attribute posts to; create one (flask init-db) '
+                             'or pass a default author')
+    processes = processes or current_app.config.get('BULK_IMPORT_PROCESSES') or os.cpu_count() or 1
+    imported_ids = []
+    skipped = 0
+    errors = []
+    touched = set()
+
+    def batches():
+        nonlocal skipped
+        batch = []
+        for number, record in read_records(stream, fmt):
+            try:
+                if isinstance(record, Exception):
+                    raise record
+                batch.append(_normalize(record))
+            except ValueError as e:
+                skipped += 1
+                if len(errors) < MAX_ERRORS:
+                    errors.append(f'line {number}: {e}')
+                continue
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def write(records, processed):
+        nonlocal skipped
+        try:
+            post_ids = _write_batch(records, processed, default_author_id, skip_taken, touched)
+        except Exception:
+            db.session.rollback()
+            raise
+        imported_ids.extend(post_ids)
+        skipped += len(records) - len(post_ids)
+        if log:
+            log(f'{len(imported_ids)} imported, {skipped} skipped')
+
+    try:
+        if processes <= 1:
+            for records in batches():
+                write(records, _process_batch([record['content'] for record in records]))
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=processes) as pool:
+                # Keep every worker busy while this process writes to the database
+                in_flight = deque()
+                for records in batches():
+                    in_flight.append((records, pool.submit(_process_batch, [record['content'] for record in records])))
+                    if len(in_flight) > processes * 2:
+                        records, future = in_flight.popleft()
+                        write(records, future.result())
+                while in_flight:
+                    records, future = in_flight.popleft()
+                    write(records, future.result())
+    finally:
+        # Also when a batch failed: the batches before it are committed
+        if imported_ids:
+            invalidate_sidebar()
+            invalidate_counts()
+            page_cache.invalidate('posts', 'sidebar', *touched)
+            if refresh_related and len(imported_ids) <= RELATED_UPDATE_LIMIT:
+                for post_id in imported_ids:
+                    related.update_post(post_id)
+            elif refresh_related:
+                related.rebuild()
+    return ImportResult(len(imported_ids), skipped, errors)
+
+
+def _export_rows(published_only, batch_size):
+    categories = dict(db.session.execute(select(Category.id, Category.name)).all())
+    tags = dict(db.session.execute(select(Tag.id, Tag.name)).all())
+    authors = dict(db.session.execute(select(User.id, User.username)).all())
+    query = select(
+        Post.id, Post.title, Post.slug, Post.summary, Post.content, Post.category_id, Post.author_id,
+        Post.published, Post.created_at, Post.updated_at, Post.featured_image,
+        Post.meta_description, Post.meta_keywords,
+    ).order_by(Post.id).limit(batch_size)
+    if published_only:
+        query = query.where(Post.published == True)
+
+    last_id = 0
+    while True:
+        # Keyset batches, so no cursor stays open while the caller writes
+        rows = db.session.execute(query.where(Post.id > last_id)).all()
+        if not rows:
+            return
+        last_id = rows[-1].id
+        post_tag_names = defaultdict(list)
+        for post_id, tag_id in db.session.execute(
+                select(post_tags.c.post_id, post_tags.c.tag_id)
+                .where(post_tags.c.post_id.in_([row.id for row in rows])).order_by(post_tags.c.tag_id)):
+            post_tag_names[post_id].append(tags[tag_id])
+        yield [{
+            'title': row.title,
+            'slug': row.slug,
+            'summary': row.summary,
+            'content': row.content,
+            'category': categories.get(row.category_id),
+            'tags': post_tag_names[row.id],
+            'author': authors.get(row.author_id),
+            'published': bool(row.published),
+            'created_at': row.created_at.isoformat() if row.created_at else None,
+            'updated_at': row.updated_at.isoformat() if row.updated_at else None,
+            'featured_image': row.featured_image,
+            'meta_description': row.meta_description,
+            'meta_keywords': row.meta_keywords,
+        } for row in rows]
+
+
+def iter_export(fmt='jsonl', published_only=False, batch_size=BATCH_SIZE):
+    """Yield every post as JSONL or CSV text, one chunk per batch
+
+    The output imports back with ``import_posts``.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f'Unknown format {fmt!r}; expected one of {", ".join(FORMATS)}')
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=FIELDS)
+        writer.writeheader()
+        yield buffer.getvalue()
+    for records in _export_rows(published_only, batch_size):
+        if fmt == 'csv':
+            buffer = io.StringIO()
+            writer = csv.DictWriter(buffer, fieldnames=FIELDS)
+            writer.writerows(dict(record, tags=', '.join(record['tags'])) for record in records)
+            yield buffer.getvalue()
+        else:
+            yield ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
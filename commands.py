@@ -0,0 +1,255 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+from datetime import datetime, timedelta
+
+import click
+from werkzeug.security import generate_password_hash
+
+from app import app, db
+from content import apply_content
+from images import delete_image, media_references, orphaned_files, recount_references, update_references
+from models import Aggregate, Category, Media, Post, Tag, User
+from sidebar import invalidate_sidebar
+import search as search_index
+import aggregates
+import bulk
+import compression
+import page_cache
+import related
+import replicas
+import static_export
+import startup
+import tasks
+
+
+@app.cli.command('init-db')
+@click.option('--admin-password', default='admin123', show_default=True,
+              help='Password of the admin user created on an empty database.')
+def init_db(admin_password):
+    """Create missing tables; seed an admin user, categories and tags on an empty database"""
+    db.create_all()
+
+    # Check if there are any users
+    if not User.query.first():
+        # Create admin user
+        admin = User(
+            username='admin',
+            email='admin@example.com',
+            password_hash=generate_password_hash(admin_password),
+            is_admin=True
+        )
+        db.session.add(admin)
+
+        # Create some initial categories
+        db.session.add_all([
+            Category(name='Technology', slug='technology'),
+            Category(name='Travel', slug='travel'),
+            Category(name='Food', slug='food'),
+            Category(name='Lifestyle', slug='lifestyle')
+        ])
+
+        # Create some initial tags
+        db.session.add_all([
+            Tag(name='Python', slug='python'),
+            Tag(name='Flask', slug='flask'),
+            Tag(name='Web Development', slug='web-development'),
+            Tag(name='Tips', slug='tips')
+        ])
+        db.session.commit()
+
+        click.echo(f'Admin user created! Username: admin, Password: {admin_password}')
+        click.echo('IMPORTANT: Change the admin password after first login!')
+    elif not Aggregate.query.first():
+        # The aggregates table was just created next to existing data
+        aggregates.rebuild()
+        click.echo('Aggregates counted from the existing posts.')
+    else:
+        click.echo('Database already initialized.')
+
+
+@app.cli.command('startup-report')
+@click.option('--runs', type=int, default=5, show_default=True, help='Fresh processes to time.')
+def startup_report(runs):
+    """Time loading the app in fresh processes, as a web worker does, by phase"""
+    code = 'import json, app, startup; print(json.dumps(startup.phases()))'
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', code], cwd=app.root_path, check=True,
+                                capture_output=True, text=True).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+    # Median of each phase over the runs
+    median = [(phase, statistics.median(run[index][1] for run in samples))
+              for index, (phase, _) in enumerate(samples[0])]
+    click.echo(startup.report(median))
+    click.echo(f"For a per-module breakdown run: {os.path.basename(sys.executable)} -X importtime -c 'import app'")
+
+
+@app.cli.command('compress-static')
+@click.option('--force', is_flag=True, help='Recompress files whose siblings are up to date.')
+def compress_static(force):
+    """Write .br and .gz siblings of the static files, served instead of compressing per request"""
+    # Uploaded media are images, already compressed, and come and go at runtime
+    written, skipped = compression.build_static(
+        app.static_folder, set(app.config['COMPRESS_MIMETYPES']), min_size=app.config['COMPRESS_MIN_SIZE'],
+        force=force, exclude=('media',))
+    for path in written:
+        click.echo(f'Compressed {path}')
+    click.echo(f'{len(written)} files compressed, {len(skipped)} already up to date.')
+
+
+@app.cli.command('search-rebuild')
+def search_rebuild():
+    """Rebuild the full-text search index from the posts table"""
+    backend = search_index.get_search_backend()
+    backend.rebuild()
+    click.echo(f'Search index rebuilt ({type(backend).__name__}).')
+
+
+@app.cli.command('worker')
+@click.option('--processes', type=int, default=None, help='Worker processes (defaults to the CPU count).')
+@click.option('--poll-interval', type=float, default=1.0, help='Seconds between polls of an empty queue.')
+@click.option('--once', is_flag=True, help='Exit once the queue is empty.')
+def worker(processes, poll_interval, once):
+    """Run queued background jobs (image processing, file deletion)"""
+    tasks.run_worker(processes=processes, poll_interval=poll_interval, once=once, log=click.echo)
+
+
+@app.cli.command('media-gc')
+@click.option('--dry-run', is_flag=True, help='List what would be removed without removing it.')
+@click.option('--unreferenced', is_flag=True, help='Also delete media that no post uses.')
+@click.option('--grace', type=int, default=3600, help='Skip files and media newer than this many seconds.')
+def media_gc(dry_run, unreferenced, grace):
+    """Recount media references and remove orphaned image files"""
+    fixed = recount_references()
+    click.echo(f'Corrected {fixed} reference count(s).')
+
+    if unreferenced:
+        cutoff = datetime.utcnow() - timedelta(seconds=grace)
+        unused = Media.query.filter(Media.ref_count <= 0, Media.created_at < cutoff).all()
+        for media in unused:
+            click.echo(f'Unreferenced media: {media.filepath}')
+            if not dry_run:
+                delete_image(media.filepath)
+    if not dry_run:
+        db.session.commit()
+
+    orphans = orphaned_files(grace)
+    for path in orphans:
+        click.echo(f'Orphaned file: {path}')
+        if not dry_run:
+            os.remove(os.path.join(app.static_folder, path))
+    click.echo(f"{'Found' if dry_run else 'Removed'} {len(orphans)} orphaned file(s).")
+
+
+@app.cli.command('content-rebuild')
+@click.option('--batch-size', type=int, default=200, help='Posts processed per commit.')
+def content_rebuild(batch_size):
+    """Re-run the content pipeline (sanitizing, anchors, excerpts) on every post"""
+    def derived(post):
+        return post.content, post.excerpt, post.word_count, post.toc, post.first_image
+
+    backend = search_index.get_search_backend()
+    last_id = 0
+    processed = changed = 0
+    while True:
+        posts = Post.query.filter(Post.id > last_id).order_by(Post.id).limit(batch_size).all()
+        if not posts:
+            break
+        cache_tags = set()
+        for post in posts:
+            before = derived(post)
+            old_media = media_references(post.featured_image, post.content)
+            apply_content(post, post.content)
+            if derived(post) != before:
+                # New validators for the post's pages, a fresh search entry
+                post.updated_at = datetime.utcnow()
+                update_references(old_media, media_references(post.featured_image, post.content))
+                backend.index_post(post)
+                cache_tags.update(page_cache.post_tags_for(post))
+                changed += 1
+        db.session.commit()
+        page_cache.invalidate(*cache_tags)
+        last_id = posts[-1].id
+        processed += len(posts)
+    click.echo(f'Processed {processed} post(s), {changed} changed.')
+
+
+@app.cli.command('related-rebuild')
+def related_rebuild():
+    """Recompute the related posts of every post"""
+    written = related.rebuild()
+    click.echo(f'Related posts rebuilt ({written} rows).')
+
+
+@app.cli.command('aggregates-rebuild')
+def aggregates_rebuild():
+    """Recount the dashboard and sidebar aggregates from scratch"""
+    written = aggregates.rebuild()
+    invalidate_sidebar()
+    click.echo(f'Aggregates rebuilt ({written} rows).')
+
+
+@app.cli.command('posts-import')
+@click.argument('source', type=click.File('r', encoding='utf-8'))
+@click.option('--format', 'fmt', type=click.Choice(bulk.FORMATS), default=None,
+              help='Input format (defaults to the file extension, else jsonl).')
+@click.option('--author', default=None, help='Username for records without a known author (defaults to the first admin).')
+@click.option('--batch-size', type=int, default=bulk.BATCH_SIZE, show_default=True, help='Posts per transaction.')
+@click.option('--processes', type=int, default=None, help='Sanitizing processes (defaults to BULK_IMPORT_PROCESSES or the CPU count).')
+@click.option('--rename-existing', is_flag=True, help='Give posts whose slug is taken a numbered slug instead of skipping them.')
+@click.option('--skip-related', is_flag=True, help='Leave related posts alone; run `flask related-rebuild` afterwards.')
+def posts_import(source, fmt, author, batch_size, processes, rename_existing, skip_related):
+    """Import posts from a JSONL or CSV file (- for stdin)"""
+    author_id = None
+    if author:
+        author_id = db.session.scalar(db.select(User.id).where(User.username == author))
+        if author_id is None:
+            raise click.BadParameter(f'No user named {author!r}.', param_hint='--author')
+    try:
+        result = bulk.import_posts(
+            source, fmt or bulk.detect_format(source.name), default_author_id=author_id, processes=processes,
+            batch_size=batch_size, skip_taken=not rename_existing, refresh_related=not skip_related, log=click.echo)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    for error in result.errors:
+        click.echo(error, err=True)
+    click.echo(f'Imported {result.imported} post(s), skipped {result.skipped}.')
+
+
+@app.cli.command('posts-export')
+@click.argument('target', type=click.File('w', encoding='utf-8'))
+@click.option('--format', 'fmt', type=click.Choice(bulk.FORMATS), default=None,
+              help='Output format (defaults to the file extension, else jsonl).')
+@click.option('--published-only', is_flag=True, help='Leave drafts out.')
+def posts_export(target, fmt, published_only):
+    """Export every post as JSONL or CSV (- for stdout)"""
+    for chunk in bulk.iter_export(fmt or bulk.detect_format(target.name), published_only=published_only):
+        target.write(chunk)
+
+
+@app.cli.command('export-static')
+@click.option('--output', type=click.Path(file_okay=False), default=None,
+              help='Export directory (defaults to STATIC_EXPORT_DIR or instance/export).')
+@click.option('--base-url', default=None, help='Site URL used for absolute links (defaults to STATIC_EXPORT_BASE_URL).')
+@click.option('--processes', type=int, default=None, help='Render processes for a full export (defaults to the CPU count).')
+@click.option('--incremental', is_flag=True, help='Only re-render pages affected by posts changed since the last export.')
+def export_static(output, base_url, processes, incremental):
+    """Pre-render the public pages, sitemaps and robots.txt into static files"""
+    static_export.export_site(root=output, base_url=base_url, processes=processes,
+                              incremental=incremental, log=click.echo)
+
+
+@app.cli.command('replica-sync')
+def replica_sync():
+    """Copy a SQLite primary onto the SQLite replica (local stand-in for replication)"""
+    replica = db.engines.get(replicas.REPLICA_BIND)
+    if replica is None:
+        raise click.ClickException('REPLICA_DATABASE_URL is not set.')
+    if db.engine.dialect.name != 'sqlite' or replica.dialect.name != 'sqlite':
+        raise click.ClickException('replica-sync only copies SQLite files; use real replication elsewhere.')
+    replica.dispose()
+    replicas.sync_sqlite(db.engine.url.database, replica.url.database)
+    click.echo(f'Copied {db.engine.url.database} to {replica.url.database}.')
@@ -0,0 +1,287 @@
+"""Response compression on top of Flask-Compress.
+
+Flask-Compress compresses responses as they leave the app. This module adds:
+
+* compression levels per content type (``COMPRESS_LEVELS``), falling back to
+  Flask-Compress' level for the algorithm;
+* precompressed static files: ``flask compress-static`` writes ``.br`` and
+  ``.gz`` siblings next to the files in the static folder, and the static
+  view sends a sibling as is when the client accepts its encoding;
+* ``encode_cached``, with which the page cache keeps each page's compressed
+  bodies next to the rendered one instead of recompressing it per request;
+* streamed pages (see streaming.py) compressed part by part, each part
+  flushed to the client, where Flask-Compress would collect the whole page.
+"""
+import gzip
+import mimetypes
+import os
+import zlib
+
+import brotli
+import zstandard
+from flask import current_app, g, request, send_from_directory
+from flask_compress import Compress
+from werkzeug.security import safe_join
+
+# Encodings written by `flask compress-static`, best first, with their suffix
+STATIC_ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+# Levels used by `flask compress-static`: it runs once per deploy, not per request
+STATIC_LEVELS = {'br': 11, 'gzip': 9}
+
+# Flask-Compress' config key for the level of each algorithm
+_DEFAULT_LEVEL_KEYS = {
+    'br': 'COMPRESS_BR_LEVEL',
+    'gzip': 'COMPRESS_LEVEL',
+    'deflate': 'COMPRESS_DEFLATE_LEVEL',
+    'zstd': 'COMPRESS_ZSTD_LEVEL',
+}
+
+
+def parse_levels(value):
+    """Parse ``COMPRESS_LEVELS``, e.g. ``text/html=br:5,gzip:6;text/css=br:9``
+
+    Content types may end in ``/*`` to cover a whole major type.
+
+    Returns:
+        ``{content type: {algorithm: level}}``
+    """
+    levels = {}
+    for part in (value or '').split(';'):
+        if not part.strip():
+            continue
+        mimetype, _, settings = part.partition('=')
+        for setting in settings.split(','):
+            algorithm, _, level = setting.partition(':')
+            if not algorithm.strip() or not level.strip():
+                raise ValueError(f'COMPRESS_LEVELS: expected algorithm:level, got {setting.strip()!r}')
+            levels.setdefault(mimetype.strip().lower(), {})[algorithm.strip().lower()] = int(level)
+    return levels
+
+
+def level_for(mimetype, algorithm, config=None):
+    """Compression level of ``algorithm`` for a body of type ``mimetype``"""
+    config = current_app.config if config is None else config
+    levels = config.get('COMPRESS_LEVELS') or {}
+    mimetype = (mimetype or '').lower()
+    for key in (mimetype, mimetype.split('/')[0] + '/*'):
+        if algorithm in levels.get(key, {}):
+            return levels[key][algorithm]
+    return config[_DEFAULT_LEVEL_KEYS[algorithm]]
+
+
+def compress_body(data, algorithm, mimetype, level=None, config=None):
+    """``data`` compressed with ``algorithm`` at the level for ``mimetype``"""
+    config = current_app.config if config is None else config
+    if level is None:
+        level = level_for(mimetype, algorithm, config)
+    if algorithm == 'br':
+        return brotli.compress(data, mode=config['COMPRESS_BR_MODE'], quality=level,
+                               lgwin=config['COMPRESS_BR_WINDOW'], lgblock=config['COMPRESS_BR_BLOCK'])
+    if algorithm == 'gzip':
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    if algorithm == 'deflate':
+        return zlib.compress(data, level)
+    if algorithm == 'zstd':
+        return zstandard.ZstdCompressor(level).compress(data)
+    raise ValueError(f'Unknown compression algorithm {algorithm!r}')
+
+
+class _StreamCompressor:
+    """Compresses a stream in parts, each decodable as soon as it arrives"""
+
+    def __init__(self, algorithm, level, config):
+        self.algorithm = algorithm
+        if algorithm == 'br':
+            self._compressor = brotli.Compressor(mode=config['COMPRESS_BR_MODE'], quality=level,
+                                                 lgwin=config['COMPRESS_BR_WINDOW'],
+                                                 lgblock=config['COMPRESS_BR_BLOCK'])
+        elif algorithm == 'zstd':
+            self._compressor = zstandard.ZstdCompressor(level).compressobj()
+        else:
+            # wbits 31 writes a gzip container, 15 a zlib one (HTTP's deflate)
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31 if algorithm == 'gzip' else 15)
+
+    def part(self, data):
+        if self.algorithm == 'br':
+            return self._compressor.process(data) + self._compressor.flush()
+        if self.algorithm == 'zstd':
+            return self._compressor.compress(data) + self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def end(self):
+        if self.algorithm == 'br':
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+def _compressed_parts(parts, compressor, charset):
+    try:
+        for part in parts:
+            data = compressor.part(part.encode(charset) if isinstance(part, str) else part)
+            if data:
+                yield data
+        yield compressor.end()
+    finally:
+        # Ends the page's request context when the client goes away early
+        if hasattr(parts, 'close'):
+            parts.close()
+
+
+class TunedCompress(Compress):
+    """Flask-Compress with per-content-type levels, precompressed static files
+    and streamed pages compressed as they are sent"""
+
+    def init_app(self, app):
+        app.config.setdefault('COMPRESS_LEVELS', {})
+        app.config.setdefault('COMPRESS_STATIC_PRECOMPRESSED', True)
+        super().init_app(app)
+        app.extensions['compress'] = self
+        if app.has_static_folder:
+            app.view_functions['static'] = send_static_file
+
+    def after_request(self, response):
+        if response.is_streamed and g.get('streamed_page'):
+            return encode_stream(response)
+        return super().after_request(response)
+
+    def compress(self, app, response, algorithm):
+        return compress_body(response.get_data(), algorithm, response.mimetype, config=app.config)
+
+
+def _extension():
+    return current_app.extensions['compress']
+
+
+def negotiate(response):
+    """The encoding to compress ``response`` with for this request, or None
+
+    Applies the same rules as Flask-Compress: a compressible content type,
+    a 2xx status, at least ``COMPRESS_MIN_SIZE`` bytes and no encoding yet.
+    """
+    extension = _extension()
+    if (response.mimetype not in extension.compress_mimetypes_set
+            or not 200 <= response.status_code < 300
+            or 'Content-Encoding' in response.headers
+            or (response.content_length or 0) < current_app.config['COMPRESS_MIN_SIZE']):
+        return None
+    return request.accept_encodings.best_match(extension.enabled_algorithms)
+
+
+def encode_cached(response, encodings):
+    """Send a cached page compressed, reusing a body compressed for an earlier request
+
+    ``encodings`` maps encodings to the page's compressed bodies. A missing one
+    is compressed now and added, so the caller should store it again when the
+    returned flag is True.
+
+    Returns:
+        True if ``encodings`` gained an entry
+    """
+    encoding = negotiate(response)
+    if encoding is None:
+        response.vary.add('Accept-Encoding')
+        return False
+    added = encoding not in encodings
+    if added:
+        encodings[encoding] = compress_body(response.get_data(), encoding, response.mimetype)
+    response.set_data(encodings[encoding])
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return added
+
+
+def encode_stream(response):
+    """Compress a streamed response part by part as it is sent"""
+    response.vary.add('Accept-Encoding')
+    extension = _extension()
+    if (response.mimetype not in extension.compress_mimetypes_set
+            or not 200 <= response.status_code < 300
+            or 'Content-Encoding' in response.headers):
+        return response
+    encoding = request.accept_encodings.best_match(extension.enabled_algorithms)
+    if encoding is None:
+        return response
+    compressor = _StreamCompressor(encoding, level_for(response.mimetype, encoding), current_app.config)
+    response.response = _compressed_parts(response.response, compressor, response.charset)
+    response.headers['Content-Encoding'] = encoding
+    # The same ETag suffix Flask-Compress adds to what it compresses
+    etag = response.headers.get('ETag')
+    if etag:
+        response.headers['ETag'] = f'{etag[:-1]}:{encoding}"'
+    return response
+
+
+def _fresh_sibling(path, suffix):
+    """Whether ``path`` has a compressed sibling at least as new as itself"""
+    try:
+        return os.stat(path + suffix).st_mtime_ns >= os.stat(path).st_mtime_ns
+    except OSError:
+        return False
+
+
+def send_static_file(filename):
+    """The static view, sending a precompressed sibling the client accepts
+
+    Siblings older than their file (it changed since the last build) are
+    ignored, so an outdated build never serves old content.
+    """
+    app = current_app
+    path = safe_join(app.static_folder, filename)
+    if path is not None and app.config.get('COMPRESS_STATIC_PRECOMPRESSED', True):
+        for encoding, suffix in STATIC_ENCODINGS:
+            if request.accept_encodings[encoding] and _fresh_sibling(path, suffix):
+                mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+                response = send_from_directory(app.static_folder, filename + suffix, mimetype=mimetype,
+                                               max_age=app.get_send_file_max_age(filename))
+                response.headers['Content-Encoding'] = encoding
+                response.vary.add('Accept-Encoding')
+                return response
+    response = app.send_static_file(filename)
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def build_static(folder, mimetypes_set, min_size=0, force=False, exclude=()):
+    """Write ``.br`` and ``.gz`` siblings of the compressible files in ``folder``
+
+    Subdirectories named in ``exclude`` are left alone. Files whose siblings
+    are up to date are skipped unless ``force``; a sibling that would be no
+    smaller than its file is not written (and an old one removed), so the
+    file itself is sent instead.
+
+    Returns:
+        ``(written, skipped)`` lists of paths relative to ``folder``
+    """
+    suffixes = tuple(suffix for _, suffix in STATIC_ENCODINGS)
+    written, skipped = [], []
+    for root, directories, names in os.walk(folder):
+        if root == folder:
+            directories[:] = [name for name in directories if name not in exclude]
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            relative = os.path.relpath(path, folder)
+            if name.endswith(suffixes) or mimetypes.guess_type(name)[0] not in mimetypes_set:
+                continue
+            if os.path.getsize(path) < min_size:
+                continue
+            if not force and all(_fresh_sibling(path, suffix) for suffix in suffixes):
+                skipped.append(relative)
+                continue
+            with open(path, 'rb') as f:
+                data = f.read()
+            for encoding, suffix in STATIC_ENCODINGS:
+                if encoding == 'br':
+                    compressed = brotli.compress(data, quality=STATIC_LEVELS['br'])
+                else:
+                    compressed = gzip.compress(data, compresslevel=STATIC_LEVELS['gzip'], mtime=0)
+                if len(compressed) >= len(data):
+                    if os.path.exists(path + suffix):
+                        os.remove(path + suffix)
+                    continue
+                tmp_path = f'{path}{suffix}.{os.getpid()}.tmp'
+                with open(tmp_path, 'wb') as f:
+                    f.write(compressed)
+                os.replace(tmp_path, path + suffix)
+            written.append(relative)
+    return written, skipped
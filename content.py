@@ -0,0 +1,118 @@
+import html
+import json
+import re
+from collections import namedtuple
+
+# bleach and python-slugify are imported on first use: most requests only
+# read posts that were sanitized when they were saved
+
+# Tags and attributes allowed in post bodies
+ALLOWED_TAGS = [
+    'a', 'abbr', 'acronym', 'b', 'blockquote', 'br', 'code', 'div', 'em',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'i', 'img', 'li', 'ol', 'p',
+    'pre', 'span', 'strong', 'table', 'tbody', 'td', 'th', 'thead', 'tr', 'ul'
+]
+ALLOWED_ATTRS = {
+    '*': ['class', 'style'],
+    'a': ['href', 'rel', 'target'],
+    'img': ['src', 'alt', 'width', 'height']
+}
+
+# Longest plain-text excerpt stored for listings (fits Post.excerpt)
+EXCERPT_LENGTH = 280
+
+# Average reading speed used for the reading time
+WORDS_PER_MINUTE = 200
+
+# Headings that get anchors and a table of contents entry
+_HEADING_RE = re.compile(r'<(h[2-4])(\s[^>]*)?>(.*?)</\1>', re.IGNORECASE | re.DOTALL)
+_IMG_SRC_RE = re.compile(r"""<img\b[^>]*?\bsrc\s*=\s*["']([^"']+)["']""", re.IGNORECASE)
+_TAG_RE = re.compile(r'<[^>]+>')
+
+# Everything derived from a post body when it is saved
+ProcessedContent = namedtuple('ProcessedContent', 'html excerpt word_count toc first_image')
+
+
+def slugify(text, **kwargs):
+    """python-slugify's ``slugify``, imported on first use"""
+    from slugify import slugify as _slugify
+    return _slugify(text, **kwargs)
+
+
+def clean_html(html_content):
+    """Clean HTML content to prevent XSS vulnerabilities"""
+    import bleach
+    return bleach.clean(
+        html_content or '',
+        tags=ALLOWED_TAGS,
+        attributes=ALLOWED_ATTRS,
+        strip=True
+    )
+
+
+def html_to_text(html_content):
+    """Strip tags and entities from HTML, leaving plain text"""
+    return html.unescape(_TAG_RE.sub(' ', html_content or ''))
+
+
+def make_excerpt(text, length=EXCERPT_LENGTH):
+    """Collapse whitespace and cut ``text`` at a word boundary"""
+    text = ' '.join(text.split())
+    if len(text) <= length:
+        return text
+    cut = text[:length - 1].rsplit(' ', 1)[0]
+    return cut.rstrip(',;:.-') + '…'
+
+
+def add_heading_anchors(html_content):
+    """Give h2-h4 headings unique ``id`` anchors
+
+    Returns:
+        (html, toc): the HTML with anchors and ``[[level, anchor, text], ...]``
+    """
+    toc = []
+    used = set()
+
+    def anchor(match):
+        tag, body = match.group(1).lower(), match.group(3)
+        text = ' '.join(html_to_text(body).split())
+        base = slugify(text) or 'section'
+        slug, count = base, 1
+        while slug in used:
+            count += 1
+            slug = f'{base}-{count}'
+        used.add(slug)
+        toc.append([int(tag[1]), slug, text])
+        # Attributes were sanitized already; any previous id was stripped
+        return f'<{tag} id="{slug}"{match.group(2) or ""}>{body}</{tag}>'
+
+    return _HEADING_RE.sub(anchor, html_content), toc
+
+
+def process_content(html_content):
+    """Sanitize a post body and derive what the views need from it
+
+    Runs once when a post is saved, so views never parse the body: listings
+    use the excerpt, and the post page uses the stored HTML and TOC.
+    """
+    cleaned, toc = add_heading_anchors(clean_html(html_content))
+    text = html_to_text(cleaned)
+    first_image = _IMG_SRC_RE.search(cleaned)
+    return ProcessedContent(
+        html=cleaned,
+        excerpt=make_excerpt(text),
+        word_count=len(text.split()),
+        toc=toc,
+        first_image=first_image.group(1)[:255] if first_image else None,
+    )
+
+
+def apply_content(post, html_content):
+    """Store a processed body and its derived columns on ``post``"""
+    processed = process_content(html_content)
+    post.content = processed.html
+    post.excerpt = processed.excerpt
+    post.word_count = processed.word_count
+    post.toc = json.dumps(processed.toc) if processed.toc else None
+    post.first_image = processed.first_image
+    return processed
@@ -0,0 +1,111 @@
+import os
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+# Named engine profiles, picked with DB_ENGINE_PROFILE. Each one holds the
+# create_engine() options and, for SQLite, the PRAGMAs run on every new
+# connection. Pool sizes are per process, so the total is multiplied by the
+# number of gunicorn workers.
+PROFILES = {
+    # Local development: SQLite defaults plus a busy timeout, so the
+    # dev server and `flask worker` don't trip over each other's locks
+    'sqlite-dev': {
+        'engine': {},
+        'pragmas': {
+            'busy_timeout': 5000,
+        },
+    },
+    # Production on SQLite: write-ahead logging lets readers run while a
+    # write is in progress, and synchronous=NORMAL is safe with WAL
+    'sqlite-prod-wal': {
+        'engine': {
+            'pool_size': 5,
+            'max_overflow': 10,
+            'pool_timeout': 10,
+        },
+        'pragmas': {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'busy_timeout': 15000,
+            'cache_size': -16000,  # KiB (16 MB) per connection
+            'temp_store': 'MEMORY',
+            'mmap_size': 134217728,  # 128 MB
+        },
+    },
+    # Azure SQL / SQL Server through pyodbc. Azure drops idle connections
+    # after about 30 minutes, so connections are recycled before that and
+    # pinged before use; fast_executemany batches bulk inserts in one trip
+    'mssql': {
+        'engine': {
+            'pool_size': 5,
+            'max_overflow': 10,
+            'pool_timeout': 30,
+            'pool_recycle': 1500,
+            'pool_pre_ping': True,
+            'fast_executemany': True,
+        },
+        'pragmas': {},
+    },
+    # Any other server database
+    'default': {
+        'engine': {
+            'pool_pre_ping': True,
+        },
+        'pragmas': {},
+    },
+}
+
+
+def default_profile(uri):
+    """Profile used for ``uri`` when DB_ENGINE_PROFILE is not set"""
+    backend = make_url(uri).get_backend_name()
+    if backend == 'sqlite':
+        return 'sqlite-dev'
+    if backend == 'mssql':
+        return 'mssql'
+    return 'default'
+
+
+def _is_memory_sqlite(url):
+    return url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')
+
+
+def engine_options(profile, uri):
+    """SQLALCHEMY_ENGINE_OPTIONS for ``profile``
+
+    DB_POOL_SIZE and DB_MAX_OVERFLOW override the profile's pool size.
+
+    Raises:
+        ValueError: If the profile is unknown
+    """
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown DB_ENGINE_PROFILE {profile!r}; expected one of {', '.join(PROFILES)}")
+    options = dict(PROFILES[profile]['engine'])
+    url = make_url(uri)
+    if _is_memory_sqlite(url):
+        # In-memory databases use a single static connection, not a pool
+        return {}
+    for key, env in (('pool_size', 'DB_POOL_SIZE'), ('max_overflow', 'DB_MAX_OVERFLOW')):
+        if os.environ.get(env):
+            options[key] = int(os.environ[env])
+    if url.get_backend_name() != 'mssql':
+        options.pop('fast_executemany', None)
+    return options
+
+
+def install_pragmas(engine, profile):
+    """Run the profile's PRAGMAs on every new SQLite connection of ``engine``"""
+    pragmas = PROFILES[profile]['pragmas']
+    if engine.dialect.name != 'sqlite' or not pragmas:
+        return
+    memory = _is_memory_sqlite(engine.url)
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            if memory and name in ('journal_mode', 'mmap_size'):
+                continue
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
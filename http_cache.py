@@ -0,0 +1,159 @@
+import hashlib
+import os
+import re
+import threading
+from datetime import timezone
+
+from flask import current_app, g, request, session
+from flask_login import current_user
+from werkzeug.security import safe_join
+
+from app import app
+
+# One year, the longest lifetime caches honour
+IMMUTABLE_MAX_AGE = 31536000
+
+# Flask-Compress appends the content coding to ETags it compresses, and so
+# does add_cache_headers for pages compressed by the page cache
+_CODING_SUFFIX = re.compile(r':(gzip|br|deflate|zstd)$')
+
+# filename -> (mtime_ns, size, version) for static files fingerprinted so far
+_versions = {}
+_versions_lock = threading.Lock()
+
+
+def static_version(filename):
+    """Short hash of a static file's contents, or None if it doesn't exist
+
+    Hashes are cached per file and recomputed when its size or modification
+    time changes, so each call costs a single ``stat``.
+    """
+    path = safe_join(app.static_folder, filename)
+    if path is None:
+        return None
+    try:
+        stat = os.stat(path)
+    except (OSError, ValueError):
+        return None
+    cached = _versions.get(filename)
+    if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            digest.update(chunk)
+    version = digest.hexdigest()[:12]
+    with _versions_lock:
+        _versions[filename] = (stat.st_mtime_ns, stat.st_size, version)
+    return version
+
+
+@app.url_defaults
+def fingerprint_static_urls(endpoint, values):
+    # url_for('static', filename=...) gains ?v=<content hash>, so the URL
+    # changes whenever the file does and the response can be cached forever
+    if endpoint == 'static' and 'v' not in values and values.get('filename'):
+        version = static_version(values['filename'])
+        if version is not None:
+            values['v'] = version
+
+
+def _page_etag(parts):
+    user = current_user.get_id() if current_user.is_authenticated else 'anonymous'
+    raw = '|'.join(str(part) for part in (*parts, user))
+    return hashlib.md5(raw.encode('utf-8')).hexdigest()
+
+
+def _client_has(etag, last_modified):
+    """Whether the request's validators match the current version of the page"""
+    if request.if_none_match:
+        # If-None-Match takes precedence over If-Modified-Since (RFC 9110)
+        if request.if_none_match.star_tag:
+            return True
+        return any(_CODING_SUFFIX.sub('', tag) == etag
+                   for tag in request.if_none_match.as_set(include_weak=True))
+    if request.if_modified_since and last_modified:
+        return last_modified.replace(microsecond=0, tzinfo=timezone.utc) <= request.if_modified_since
+    return False
+
+
+def not_modified(last_modified, *parts):
+    """Check the conditional request headers before a page is rendered
+
+    Views call this with the newest ``Post.updated_at`` the page shows and
+    anything else that changes the rendered output (ids, names, the sidebar
+    digest ...). The page gets a weak ETag over those parts plus the viewing
+    user, and a ``Last-Modified`` header.
+
+    Returns:
+        A 304 response when the client's copy is still current, else None
+    """
+    if request.method not in ('GET', 'HEAD') or '_flashes' in session:
+        return None
+    return revalidate(_page_etag((last_modified, *parts)), last_modified)
+
+
+def revalidate(etag, last_modified):
+    """Attach validators to the current response, returning a 304 if they match
+
+    Also used by the page cache to answer conditional requests for stored pages.
+    """
+    g.page_validators = (etag, last_modified)
+    if _client_has(etag, last_modified):
+        return current_app.response_class(status=304)
+    return None
+
+
+def digest(value):
+    """Stable short hash of a value's repr, e.g. for a sidebar snapshot in an ETag"""
+    return hashlib.md5(repr(value).encode('utf-8')).hexdigest()[:12]
+
+
+@app.after_request
+def add_cache_headers(response):
+    if request.endpoint == 'static':
+        filename = (request.view_args or {}).get('filename')
+        version = request.args.get('v')
+        response.cache_control.public = True
+        response.cache_control.no_cache = None
+        if version and version == static_version(filename):
+            response.cache_control.max_age = IMMUTABLE_MAX_AGE
+            response.cache_control.immutable = True
+        else:
+            # Unversioned (or outdated) URLs, e.g. images linked from post content
+            response.cache_control.max_age = current_app.config.get('STATIC_CACHE_MAX_AGE', 604800)
+        return response
+
+    if response.status_code not in (200, 304):
+        return response
+    validators = g.get('page_validators')
+    if validators is not None:
+        etag, last_modified = validators
+        coding = response.headers.get('Content-Encoding')
+        response.set_etag(f'{etag}:{coding}' if coding else etag, weak=True)
+        if last_modified:
+            response.last_modified = last_modified.replace(tzinfo=timezone.utc)
+
+    shared_max_age = current_app.config.get('PUBLIC_CACHE_MAX_AGE', 0)
+    if g.get('public_page') and shared_max_age > 0 and is_anonymous_response():
+        # Every anonymous visitor gets this page, so shared caches (CDN,
+        # proxy) may reuse it; browsers still revalidate it with the ETag
+        response.cache_control.public = True
+        response.cache_control.max_age = 0
+        response.cache_control.s_maxage = shared_max_age
+        if current_app.config.get('PUBLIC_CACHE_VARY_COOKIE', True):
+            response.vary.add('Cookie')
+    elif validators is not None:
+        # The page differs per user, so shared caches must revalidate per cookie
+        response.cache_control.no_cache = True
+        if current_user.is_authenticated:
+            response.cache_control.private = True
+        response.vary.add('Cookie')
+    return response
+
+
+def is_anonymous_response():
+    """Whether the response is the same for any visitor: nobody is signed in
+    and the request neither showed nor left a flash message"""
+    return not current_user.is_authenticated and not session.modified
@@ -0,0 +1,512 @@
+import hashlib
+import json
+import os
+import re
+import secrets
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict
+from datetime import datetime
+from urllib.parse import urljoin, urlparse
+
+from markupsafe import Markup, escape
+from flask import g, request, url_for
+from sqlalchemy import or_
+from werkzeug.utils import secure_filename
+
+from app import app, db
+from models import Media, Post
+from tasks import task, enqueue
+import page_cache
+
+# Largest size kept for the base image (matches the old thumbnail size)
+MAX_SIZE = (1200, 800)
+
+# Widths generated for srcset; widths above the base image's are skipped
+RESPONSIVE_WIDTHS = (320, 640, 960)
+
+# Encoder settings per output format
+ENCODE_OPTIONS = {
+    'JPEG': {'quality': 82, 'optimize': True, 'progressive': True},
+    'PNG': {'optimize': True},
+    'WEBP': {'quality': 80, 'method': 6},
+    'AVIF': {'quality': 60},
+}
+
+# Pillow format -> (file extension, MIME type)
+FORMATS = {
+    'JPEG': ('.jpg', 'image/jpeg'),
+    'PNG': ('.png', 'image/png'),
+    'WEBP': ('.webp', 'image/webp'),
+    'AVIF': ('.avif', 'image/avif'),
+    'GIF': ('.gif', 'image/gif'),
+}
+
+# Hex digits of the content hash used in file names
+HASH_NAME_LENGTH = 32
+
+# Chunk size for copying uploads to disk
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Upload extension -> Pillow format the base image is kept in. The base path
+# is handed out as soon as the upload is saved, so processing must not change it.
+UPLOAD_FORMATS = {
+    '.jpg': 'JPEG',
+    '.jpeg': 'JPEG',
+    '.png': 'PNG',
+    '.gif': 'GIF',
+    '.webp': 'WEBP',
+}
+
+
+def modern_formats():
+    """Modern formats this Pillow build can encode, best first
+
+    AVIF needs a plugin such as ``pillow-avif-plugin``; without one only WebP
+    derivatives are written.
+    """
+    from PIL import Image
+    Image.init()
+    return [fmt for fmt in ('AVIF', 'WEBP') if fmt in Image.SAVE]
+
+
+def _fallback_format(image):
+    # Keep transparency where the source has it, otherwise use JPEG
+    if image.mode in ('RGBA', 'LA', 'P'):
+        return 'PNG'
+    return 'JPEG'
+
+
+def _save(image, path, fmt):
+    """Encode ``image`` without any of the source metadata (EXIF, ICC, XMP)"""
+    if fmt == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    image.save(path, fmt, **ENCODE_OPTIONS.get(fmt, {}))
+
+
+def process_image(filepath):
+    """Re-encode an uploaded image in place and write its responsive derivatives
+
+    The base image keeps its path and format, but is oriented, resized and
+    stripped of metadata. It is written to a temporary file first so the
+    original upload stays servable until the new one is complete.
+
+    Args:
+        filepath: Path of the uploaded image relative to the static folder
+
+    Returns:
+        A dict with the base image's dimensions, MIME type and derivative sources
+    """
+    full_path = os.path.join(app.static_folder, filepath)
+    stem, base_ext = os.path.splitext(filepath)
+    base_format = UPLOAD_FORMATS[base_ext.lower()]
+    tmp_path = f'{full_path}.{os.getpid()}.tmp'
+
+    # Pillow is imported on first use; only uploads and the worker need it
+    from PIL import Image, ImageOps
+    with Image.open(full_path) as original:
+        # Animated GIFs are stored as-is; re-encoding frames isn't worth it
+        if getattr(original, 'is_animated', False):
+            return {'width': original.width, 'height': original.height,
+                    'mime': FORMATS['GIF'][1], 'sources': {}}
+
+        # Apply the EXIF orientation before the metadata is dropped
+        image = ImageOps.exif_transpose(original)
+        if image.mode not in ('RGB', 'RGBA', 'L', 'LA', 'P'):
+            image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+        image.thumbnail(MAX_SIZE)
+
+    _save(image, tmp_path, base_format)
+    os.replace(tmp_path, full_path)
+
+    # The <img> fallback must be JPEG or PNG, whatever the upload was
+    fallback = base_format if base_format in ('JPEG', 'PNG') else _fallback_format(image)
+    widths = [w for w in RESPONSIVE_WIDTHS if w < image.width] + [image.width]
+    sources = {}
+    for fmt in modern_formats() + [fallback]:
+        fmt_ext, fmt_mime = FORMATS[fmt]
+        entries = []
+        for width in widths:
+            if fmt == base_format and width == image.width:
+                entries.append([width, filepath])
+                continue
+            if width == image.width:
+                resized = image
+            else:
+                resized = image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+            path = f"{stem}-{width}w{fmt_ext}"
+            _save(resized, os.path.join(app.static_folder, path), fmt)
+            entries.append([width, path])
+        sources[fmt_mime] = entries
+
+    return {'width': image.width, 'height': image.height,
+            'mime': FORMATS[base_format][1], 'sources': sources}
+
+
+def _save_upload(file, path):
+    """Copy an upload to ``path`` and return the SHA-256 hex digest of its bytes"""
+    digest = hashlib.sha256()
+    with open(path, 'wb') as out:
+        for chunk in iter(lambda: file.stream.read(UPLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+            out.write(chunk)
+    return digest.hexdigest()
+
+
+def store_image(file, image_type='content', alt_text='', uploaded_by=None):
+    """Save an upload under its content hash and queue it for processing
+
+    Files are named after the SHA-256 of the uploaded bytes, so uploading
+    the same image again returns the existing Media row instead of storing
+    another copy. Only the image header is read here, so the request returns
+    quickly even for large uploads. A new Media row stays 'pending' until
+    the worker has written the derivatives (see ``process_media``). The row
+    and its job are added to the session but not committed.
+
+    Args:
+        file: The uploaded file object
+        image_type: Either 'featured' or 'content' to determine subdirectory
+        alt_text: Alternative text stored with the media
+        uploaded_by: Id of the uploading user
+
+    Raises:
+        ValueError: If the upload isn't a supported image
+    """
+    if image_type not in ['featured', 'content']:
+        image_type = 'content'
+    folder = f"media/{image_type}"
+    upload_folder = os.path.join(app.static_folder, folder)
+    os.makedirs(upload_folder, exist_ok=True)
+
+    filename = secure_filename(file.filename)
+    ext = os.path.splitext(filename)[1].lower()
+    if ext not in UPLOAD_FORMATS:
+        raise ValueError('Unsupported image type')
+    if ext == '.jpeg':
+        ext = '.jpg'
+
+    tmp_path = os.path.join(upload_folder, f'.upload-{secrets.token_hex(8)}.tmp')
+    content_hash = _save_upload(file, tmp_path)
+    existing = Media.query.filter_by(content_hash=content_hash).first()
+    if existing is not None:
+        os.remove(tmp_path)
+        return existing
+
+    try:
+        # Opening only parses the header; the pixels are decoded by the worker
+        from PIL import Image
+        with Image.open(tmp_path) as image:
+            width, height = image.size
+    except Exception:
+        os.remove(tmp_path)
+        raise ValueError('Uploaded file is not a valid image')
+
+    filepath = f"{folder}/{content_hash[:HASH_NAME_LENGTH]}{ext}"
+    full_path = os.path.join(app.static_folder, filepath)
+    os.replace(tmp_path, full_path)
+
+    media = Media(
+        filename=filename or os.path.basename(filepath),
+        filepath=filepath,
+        filetype=FORMATS[UPLOAD_FORMATS[ext]][1],
+        filesize=os.path.getsize(full_path),
+        alt_text=alt_text,
+        width=width,
+        height=height,
+        status='pending',
+        content_hash=content_hash,
+        uploaded_by=uploaded_by
+    )
+    db.session.add(media)
+    db.session.flush()
+    enqueue('process_image', media_id=media.id)
+    return media
+
+
+def _mark_failed(media_id):
+    media = db.session.get(Media, media_id)
+    if media is not None:
+        media.status = 'failed'
+
+
+@task('process_image', on_failure=_mark_failed)
+def process_media(media_id):
+    """Worker job: write the derivatives for a pending upload"""
+    media = db.session.get(Media, media_id)
+    if media is None:
+        # Deleted before the worker got to it
+        return
+    info = process_image(media.filepath)
+    media.width = info['width']
+    media.height = info['height']
+    media.filetype = info['mime']
+    media.filesize = os.path.getsize(os.path.join(app.static_folder, media.filepath))
+    media.variants = json.dumps(info['sources'])
+    media.status = 'ready'
+    # Pages using the image were rendered with the placeholder: change their
+    # validators and drop their cached copies
+    posts = [post for post in Post.query.filter(or_(
+        Post.featured_image == media.filepath,
+        Post.content.contains(f"{app.static_url_path}/{media.filepath}")))
+        if media.filepath in media_references(post.featured_image, post.content)]
+    now = datetime.utcnow()
+    for post in posts:
+        post.updated_at = now
+    page_cache.invalidate(*set().union(*(page_cache.post_tags_for(post) for post in posts)))
+
+
+@task('delete_files')
+def delete_files(paths):
+    """Worker job: remove image files relative to the static folder"""
+    if Media.query.filter(Media.filepath.in_(paths)).count():
+        # The same image was uploaded again since the job was queued
+        return
+    for relative in paths:
+        file_path = os.path.join(app.static_folder, relative)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+
+# src attribute of <img> tags in post content
+_IMG_SRC = re.compile(r"""<img\b[^>]*?\bsrc\s*=\s*["']([^"']+)["']""", re.IGNORECASE)
+
+
+def media_references(featured_image, content):
+    """Paths of the uploaded images a post uses, relative to the static folder
+
+    Covers the featured image and inline ``<img>`` tags in the content,
+    whether their ``src`` is a relative or an absolute URL.
+    """
+    paths = set()
+    if featured_image:
+        paths.add(featured_image)
+    prefix = app.static_url_path.rstrip('/') + '/'
+    for src in _IMG_SRC.findall(content or ''):
+        path = urlparse(src).path
+        if path.startswith(prefix + 'media/'):
+            paths.add(path[len(prefix):])
+    return paths
+
+
+def update_references(old_paths, new_paths):
+    """Adjust ``Media.ref_count`` after a post's images changed (not committed)"""
+    added = new_paths - old_paths
+    removed = old_paths - new_paths
+    if added:
+        Media.query.filter(Media.filepath.in_(added)).update(
+            {Media.ref_count: Media.ref_count + 1})
+    if removed:
+        Media.query.filter(Media.filepath.in_(removed)).update(
+            {Media.ref_count: Media.ref_count - 1})
+
+
+def add_references(counts):
+    """Add ``{path: uses}`` to ``Media.ref_count`` for posts inserted in bulk (not committed)"""
+    by_count = defaultdict(list)
+    for path, count in counts.items():
+        by_count[count].append(path)
+    for count, paths in by_count.items():
+        Media.query.filter(Media.filepath.in_(paths)).update(
+            {Media.ref_count: Media.ref_count + count}, synchronize_session=False)
+
+
+def post_references():
+    """``{path: uses}`` of the images referenced by all posts"""
+    counts = Counter()
+    rows = db.session.query(Post.featured_image, Post.content).yield_per(500)
+    for featured_image, content in rows:
+        counts.update(media_references(featured_image, content))
+    return counts
+
+
+def recount_references():
+    """Recompute every ``Media.ref_count`` from the posts (not committed)
+
+    Returns:
+        The number of rows whose count was wrong
+    """
+    counts = post_references()
+    fixed = 0
+    for media in Media.query:
+        count = counts.get(media.filepath, 0)
+        if media.ref_count != count:
+            media.ref_count = count
+            fixed += 1
+    return fixed
+
+
+# Base name of an upload or derivative: <stem>.<ext> or <stem>-<width>w.<ext>
+_MEDIA_FILE = re.compile(r'^(?P<stem>[^.]+?)(-\d+w)?\.[a-z0-9]+$')
+
+
+def orphaned_files(grace=3600):
+    """Files under ``static/media`` that belong to no Media row and no post
+
+    Images uploaded before Media rows existed (featured or inline) have no
+    row, so every path a post references is kept, along with the files
+    derived from it. Files modified in the last ``grace`` seconds are
+    skipped so uploads and jobs in progress are left alone.
+
+    Returns:
+        Paths relative to the static folder
+    """
+    referenced = set(post_references())
+    stems = {os.path.splitext(os.path.basename(path))[0]
+             for path in referenced.union(path for path, in db.session.query(Media.filepath))}
+    root = os.path.join(app.static_folder, 'media')
+    cutoff = time.time() - grace
+    orphans = []
+    for directory, _, names in os.walk(root):
+        for name in names:
+            full_path = os.path.join(directory, name)
+            if os.path.getmtime(full_path) > cutoff:
+                continue
+            path = os.path.relpath(full_path, app.static_folder).replace(os.sep, '/')
+            if path in referenced:
+                continue
+            match = _MEDIA_FILE.match(name)
+            if match is None or match.group('stem') not in stems:
+                orphans.append(path)
+    return sorted(orphans)
+
+
+def variant_paths(media):
+    """Every file written for ``media``, including the base image"""
+    paths = {media.filepath}
+    for entries in json.loads(media.variants or '{}').values():
+        paths.update(path for _, path in entries)
+    return paths
+
+
+# filepath -> (expires, (width, height, sources)) for processed images
+# looked up by this process, least recently used first. Paths are derived
+# from the image's content, so a path always maps to the same derivatives;
+# entries only expire so that an image deleted through another process
+# stops being rendered with derivatives. Pending images aren't cached, so
+# their derivatives show up once ready.
+_variant_cache = OrderedDict()
+_variant_lock = threading.Lock()
+
+# Upper bound on cached lookups, and seconds one is reused
+MAX_CACHED_VARIANTS = 2000
+VARIANT_CACHE_TTL = 300
+
+_MISSING = object()
+
+
+def _cached_variants(path):
+    """The cached lookup for ``path``, or _MISSING if there is none or it expired"""
+    with _variant_lock:
+        entry = _variant_cache.get(path)
+        if entry is None:
+            return _MISSING
+        if entry[0] <= time.monotonic():
+            del _variant_cache[path]
+            return _MISSING
+        _variant_cache.move_to_end(path)
+        return entry[1]
+
+
+def _variants_for(path):
+    value = _cached_variants(path)
+    if value is not _MISSING:
+        return value
+    if path in g.get('pending_media', ()):
+        return None
+    media = Media.query.filter_by(filepath=path).first()
+    if media is not None and media.status == 'pending':
+        return None
+    return _remember_variants(path, media)
+
+
+def _remember_variants(path, media):
+    value = None
+    if media is not None and media.variants:
+        value = (media.width, media.height, json.loads(media.variants))
+    with _variant_lock:
+        _variant_cache[path] = (time.monotonic() + VARIANT_CACHE_TTL, value)
+        _variant_cache.move_to_end(path)
+        while len(_variant_cache) > MAX_CACHED_VARIANTS:
+            _variant_cache.popitem(last=False)
+    return value
+
+
+def uncached_variants(paths):
+    """The image paths whose derivatives this process hasn't looked up yet"""
+    return {path for path in paths if path and _cached_variants(path) is _MISSING}
+
+
+def remember_variants(paths, media_rows):
+    """Cache derivative lookups for ``paths`` from Media rows loaded elsewhere
+
+    The async views fetch them up front, so rendering never queries.
+    """
+    by_path = {media.filepath: media for media in media_rows}
+    for path in paths:
+        media = by_path.get(path)
+        if media is not None and media.status == 'pending':
+            g.setdefault('pending_media', set()).add(path)
+        else:
+            _remember_variants(path, media)
+
+
+def forget_variants(path):
+    """Drop this process' cached derivative lookup for a deleted image
+
+    Other processes drop theirs when it expires (``VARIANT_CACHE_TTL``).
+    """
+    with _variant_lock:
+        _variant_cache.pop(path, None)
+
+
+@app.template_global()
+def absolute_url(src):
+    """``src`` from a post's body as an absolute URL, e.g. for ``og:image``"""
+    return urljoin(request.url_root, src)
+
+
+@app.template_global()
+def responsive_image(path, alt='', sizes='100vw', loading='lazy', **attrs):
+    """Render a ``<picture>`` with modern formats and a ``srcset`` per width
+
+    Images uploaded before the pipeline existed have no derivatives and get
+    a plain ``<img>``, as do uploads still waiting for the worker (the
+    unprocessed upload serves as a placeholder). Extra keyword arguments become attributes on the
+    ``<img>``; use ``class_`` for ``class``.
+    """
+    img_attrs = {'alt': alt, 'loading': loading, 'decoding': 'async'}
+    img_attrs.update({key.rstrip('_'): value for key, value in attrs.items()})
+
+    variants = _variants_for(path)
+    if variants is None:
+        img_attrs = {'src': url_for('static', filename=path), **img_attrs}
+        return Markup('<img %s>' % _attributes(img_attrs))
+
+    width, height, sources = variants
+    parts = ['<picture>']
+    fallback_srcset = None
+    for mime, entries in sources.items():
+        srcset = ', '.join(f"{url_for('static', filename=p)} {w}w" for w, p in entries)
+        if mime in ('image/avif', 'image/webp'):
+            parts.append('<source %s>' % _attributes({'type': mime, 'srcset': srcset, 'sizes': sizes}))
+        else:
+            fallback_srcset = srcset
+    img_attrs = {'src': url_for('static', filename=path), 'srcset': fallback_srcset, 'sizes': sizes,
+                 'width': width, 'height': height, **img_attrs}
+    parts.append('<img %s>' % _attributes(img_attrs))
+    parts.append('</picture>')
+    return Markup(''.join(parts))
+
+
+def _attributes(values):
+    return ' '.join(f'{key}="{escape(value)}"' for key, value in values.items() if value is not None)
+
+
+def delete_image(path):
+    """Delete an image's Media row and queue its files for removal (not committed)"""
+    media = Media.query.filter_by(filepath=path).first()
+    paths = variant_paths(media) if media is not None else {path}
+    if media is not None:
+        db.session.delete(media)
+    enqueue('delete_files', paths=sorted(paths))
+    forget_variants(path)
@@ -0,0 +1,425 @@
+import contextvars
+import cProfile
+import glob
+import json
+import os
+import pstats
+import random
+import threading
+import time
+from collections import defaultdict
+
+from flask import request
+from flask.templating import Environment
+from jinja2 import Template
+from sqlalchemy import event
+
+import startup
+
+# Upper bounds (seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Seconds between writes of this process' totals to METRICS_DIR
+DUMP_INTERVAL = 5.0
+
+# Deepest call stack written to a folded flamegraph dump
+MAX_STACK_DEPTH = 64
+
+# Call paths taking less than this share of a profiled request are left out
+# of its flamegraph; walking them all grows exponentially with the call graph
+MIN_STACK_SHARE = 0.001
+
+# The request being measured in this thread (or asyncio task)
+_current = contextvars.ContextVar('metrics_sample', default=None)
+
+
+class Sample:
+    """What one request has spent so far"""
+    __slots__ = ('start', 'endpoint', 'sql_count', 'sql_time', 'template_time', 'profiler')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.endpoint = None
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+        self.profiler = None
+
+
+class EndpointStats:
+    """Running totals for one endpoint"""
+
+    def __init__(self):
+        self.requests = 0
+        self.statuses = defaultdict(int)  # '2xx' -> count
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)  # the last one is +Inf
+        self.latency = 0.0
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+        self.response_bytes = 0
+
+    def add(self, sample, status, size, duration):
+        self.requests += 1
+        self.statuses[f'{status // 100}xx'] += 1
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if duration <= bound:
+                break
+        else:
+            index = len(LATENCY_BUCKETS)
+        self.buckets[index] += 1
+        self.latency += duration
+        self.sql_count += sample.sql_count
+        self.sql_time += sample.sql_time
+        self.template_time += sample.template_time
+        self.response_bytes += size
+
+    def to_dict(self):
+        return {
+            'requests': self.requests, 'statuses': dict(self.statuses), 'buckets': self.buckets,
+            'latency': self.latency, 'sql_count': self.sql_count, 'sql_time': self.sql_time,
+            'template_time': self.template_time, 'response_bytes': self.response_bytes,
+        }
+
+
+class Registry:
+    """Per-endpoint totals for this process"""
+
+    def __init__(self):
+        self._stats = defaultdict(EndpointStats)
+        self._lock = threading.Lock()
+        self._dumped_at = 0.0
+
+    def record(self, sample, status, size, duration):
+        with self._lock:
+            self._stats[sample.endpoint or 'none'].add(sample, status, size, duration)
+
+    def snapshot(self):
+        """``{endpoint: totals dict}``"""
+        with self._lock:
+            return {endpoint: stats.to_dict() for endpoint, stats in self._stats.items()}
+
+    def dump(self, directory, force=False):
+        """Write this process' totals for ``/metrics`` to merge (throttled)"""
+        now = time.monotonic()
+        if not force and now - self._dumped_at < DUMP_INTERVAL:
+            return
+        self._dumped_at = now
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'{os.getpid()}.json')
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_path, path)
+
+
+registry = Registry()
+_config = {}
+
+
+def _merge(into, totals):
+    for endpoint, values in totals.items():
+        merged = into.setdefault(endpoint, {
+            'requests': 0, 'statuses': {}, 'buckets': [0] * (len(LATENCY_BUCKETS) + 1), 'latency': 0.0,
+            'sql_count': 0, 'sql_time': 0.0, 'template_time': 0.0, 'response_bytes': 0,
+        })
+        for key in ('requests', 'latency', 'sql_count', 'sql_time', 'template_time', 'response_bytes'):
+            merged[key] += values[key]
+        for status, count in values['statuses'].items():
+            merged['statuses'][status] = merged['statuses'].get(status, 0) + count
+        merged['buckets'] = [a + b for a, b in zip(merged['buckets'], values['buckets'])]
+
+
+def collect():
+    """Totals per endpoint, across every worker process when METRICS_DIR is set"""
+    directory = _config.get('dir')
+    if not directory:
+        return registry.snapshot()
+    registry.dump(directory, force=True)
+    totals = {}
+    for path in glob.glob(os.path.join(directory, '*.json')):
+        try:
+            with open(path) as f:
+                _merge(totals, json.load(f))
+        except (OSError, ValueError):
+            continue
+    return totals
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_prometheus():
+    """The collected totals in the Prometheus text exposition format"""
+    totals = collect()
+    lines = []
+
+    def metric(name, kind, help_text, rows):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        lines.extend(rows)
+
+    endpoints = sorted(totals)
+    metric('blog_http_requests_total', 'counter', 'Requests handled, by endpoint and status class', [
+        f'blog_http_requests_total{{endpoint="{_label(endpoint)}",status="{status}"}} {count}'
+        for endpoint in endpoints for status, count in sorted(totals[endpoint]['statuses'].items())])
+
+    rows = []
+    for endpoint in endpoints:
+        values = totals[endpoint]
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), values['buckets']):
+            cumulative += count
+            rows.append(f'blog_http_request_duration_seconds_bucket{{endpoint="{_label(endpoint)}",le="{bound}"}} {cumulative}')
+        rows.append(f'blog_http_request_duration_seconds_sum{{endpoint="{_label(endpoint)}"}} {round(values["latency"], 6)}')
+        rows.append(f'blog_http_request_duration_seconds_count{{endpoint="{_label(endpoint)}"}} {values["requests"]}')
+    metric('blog_http_request_duration_seconds', 'histogram', 'Request latency, by endpoint', rows)
+
+    for name, key, help_text in (
+            ('blog_sql_statements_total', 'sql_count', 'SQL statements executed, by endpoint'),
+            ('blog_sql_duration_seconds_total', 'sql_time', 'Time spent executing SQL, by endpoint'),
+            ('blog_template_render_seconds_total', 'template_time', 'Time spent rendering templates, by endpoint'),
+            ('blog_response_bytes_total', 'response_bytes', 'Response body bytes sent, by endpoint')):
+        metric(name, 'counter', help_text, [
+            f'{name}{{endpoint="{_label(endpoint)}"}} {round(totals[endpoint][key], 6)}' for endpoint in endpoints])
+
+    metric('blog_startup_seconds', 'gauge', 'Time the answering process took to load the app, by phase', [
+        f'blog_startup_seconds{{phase="{_label(phase)}"}} {round(seconds, 6)}' for phase, seconds in startup.phases()])
+    return '\n'.join(lines) + '\n'
+
+
+def _percentile(buckets, fraction):
+    """Upper bucket bound below which ``fraction`` of the requests finished"""
+    total = sum(buckets)
+    if not total:
+        return None
+    cumulative = 0
+    for bound, count in zip(LATENCY_BUCKETS + (None,), buckets):
+        cumulative += count
+        if cumulative >= total * fraction:
+            return bound
+    return None
+
+
+def summary():
+    """Rows for the admin dashboard panel, slowest endpoints (by total time) first"""
+    rows = []
+    for endpoint, values in collect().items():
+        requests = values['requests'] or 1
+        p95 = _percentile(values['buckets'], 0.95)
+        rows.append({
+            'endpoint': endpoint,
+            'requests': values['requests'],
+            'avg_ms': values['latency'] / requests * 1000,
+            'p95_ms': p95 * 1000 if p95 is not None else None,
+            'sql_per_request': values['sql_count'] / requests,
+            'sql_ms': values['sql_time'] / requests * 1000,
+            'template_ms': values['template_time'] / requests * 1000,
+            'avg_kb': values['response_bytes'] / requests / 1024,
+            'total_time': values['latency'],
+        })
+    return sorted(rows, key=lambda row: row['total_time'], reverse=True)
+
+
+class TimedTemplate(Template):
+    """Template that adds its render time to the current request's sample
+
+    Only top-level renders go through ``render`` (or ``generate`` when the
+    page is streamed); templates they extend or include are rendered inside
+    it, so nothing is counted twice.
+    """
+
+    def render(self, *args, **kwargs):
+        sample = _current.get()
+        if sample is None:
+            return super().render(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            sample.template_time += time.perf_counter() - start
+
+    def generate(self, *args, **kwargs):
+        # Streamed pages: only the time spent producing each chunk counts,
+        # not the time the chunks wait for the client
+        sample = _current.get()
+        chunks = super().generate(*args, **kwargs)
+        if sample is None:
+            yield from chunks
+            return
+        while True:
+            start = time.perf_counter()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            finally:
+                sample.template_time += time.perf_counter() - start
+            yield chunk
+
+    async def render_async(self, *args, **kwargs):
+        sample = _current.get()
+        if sample is None:
+            return await super().render_async(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return await super().render_async(*args, **kwargs)
+        finally:
+            sample.template_time += time.perf_counter() - start
+
+
+class TimedEnvironment(Environment):
+    """Flask's Jinja environment, compiling templates into ``TimedTemplate``"""
+    template_class = TimedTemplate
+
+
+def instrument_engine(engine):
+    """Count and time the SQL statements ``engine`` runs during requests"""
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if _current.get() is not None:
+            conn.info.setdefault('metrics_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        sample = _current.get()
+        starts = conn.info.get('metrics_start')
+        if sample is not None and starts:
+            sample.sql_count += 1
+            sample.sql_time += time.perf_counter() - starts.pop()
+
+
+def start():
+    """Begin measuring a request; pass the result to ``finish``"""
+    sample = Sample()
+    rate = _config.get('profile_rate', 0)
+    if rate and random.random() < rate:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            sample.profiler = profiler
+        except ValueError:
+            pass  # another profiler is already active in this thread
+    return sample, _current.set(sample)
+
+
+def finish(started, status, size):
+    """Record a finished request"""
+    sample, token = started
+    duration = time.perf_counter() - sample.start
+    if sample.profiler is not None:
+        sample.profiler.disable()
+        _dump_profile(sample, duration)
+    _current.reset(token)
+    registry.record(sample, status, size, duration)
+    if _config.get('dir'):
+        registry.dump(_config['dir'])
+
+
+def folded_stacks(profile):
+    """Collapse a cProfile run into ``{"a;b;c": seconds}`` flamegraph stacks
+
+    cProfile keeps caller/callee edges rather than whole stacks, so each
+    callee's time is split between its callers in proportion to the time
+    spent on that edge, as flameprof and similar tools do.
+    """
+    stats = pstats.Stats(profile).stats
+    threshold = sum(values[2] for values in stats.values()) * MIN_STACK_SHARE
+    callees = defaultdict(dict)
+    for func, (_, _, _, _, callers) in stats.items():
+        for caller, edge in callers.items():
+            callees[caller][func] = edge
+
+    def name(func):
+        filename, line, function = func
+        return f'{function} ({os.path.basename(filename)}:{line})' if line else function
+
+    stacks = defaultdict(float)
+
+    def walk(func, path, on_path, share):
+        own = stats[func][2] * share
+        path = path + (name(func),)
+        if own > 0:
+            stacks[';'.join(path)] += own
+        if len(path) >= MAX_STACK_DEPTH:
+            return
+        for callee, edge in callees[func].items():
+            callee_total = stats[callee][3]
+            if callee in on_path or not callee_total or edge[3] * share < threshold:
+                continue
+            walk(callee, path, on_path | {callee}, share * edge[3] / callee_total)
+
+    for func, values in stats.items():
+        if not values[4]:
+            walk(func, (), frozenset([func]), 1.0)
+    return stacks
+
+
+def _dump_profile(sample, duration):
+    directory = _config.get('profile_dir')
+    os.makedirs(directory, exist_ok=True)
+    base = os.path.join(directory, f'{sample.endpoint or "none"}-{time.time_ns()}-{os.getpid()}')
+    sample.profiler.dump_stats(base + '.prof')
+    with open(base + '.folded', 'w') as f:
+        for stack, seconds in sorted(folded_stacks(sample.profiler).items()):
+            f.write(f'{stack} {max(1, round(seconds * 1e6))}\n')  # microseconds
+
+
+class MetricsMiddleware:
+    """WSGI middleware timing each request up to its last byte"""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        started = start()
+        status = [500]
+
+        def measured_start_response(status_line, headers, exc_info=None):
+            status[0] = int(status_line.split(' ', 1)[0])
+            return start_response(status_line, headers, exc_info)
+
+        try:
+            result = self.wsgi_app(environ, measured_start_response)
+        except BaseException:
+            finish(started, 500, 0)
+            raise
+        return self._iterate(result, started, status)
+
+    @staticmethod
+    def _iterate(result, started, status):
+        size = 0
+        try:
+            for chunk in result:
+                size += len(chunk)
+                yield chunk
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+            finish(started, status[0], size)
+
+
+def init_app(app, engines):
+    """Instrument ``app`` and its database engines
+
+    Settings: ``METRICS_ENABLED``, ``METRICS_DIR`` (share totals between
+    worker processes), ``PROFILE_SAMPLE_RATE`` and ``PROFILE_DIR``.
+    """
+    if not app.config.get('METRICS_ENABLED', True):
+        return
+    _config['dir'] = app.config.get('METRICS_DIR')
+    _config['profile_rate'] = app.config.get('PROFILE_SAMPLE_RATE', 0.0)
+    _config['profile_dir'] = app.config.get('PROFILE_DIR') or os.path.join(app.instance_path, 'profiles')
+
+    app.jinja_environment = TimedEnvironment
+    for engine in engines:
+        instrument_engine(engine)
+    app.wsgi_app = MetricsMiddleware(app.wsgi_app)
+
+    @app.before_request
+    def label_request():
+        sample = _current.get()
+        if sample is not None:
+            sample.endpoint = request.endpoint
@@ -1,11 +1,15 @@
+import json
 from datetime import datetime
 from flask_login import UserMixin
-from app import db, login_manager
+from app import db
+from content import WORDS_PER_MINUTE
 
 # Association table for many-to-many relationship between posts and tags
 post_tags = db.Table('post_tags',
     db.Column('post_id', db.Integer, db.ForeignKey('post.id'), primary_key=True),
-    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'), primary_key=True)
+    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'), primary_key=True),
+    # The primary key covers post -> tags; tag pages walk the table from tag_id
+    db.Index('ix_post_tags_tag_id_post_id', 'tag_id', 'post_id')
 )
 
 class User(db.Model, UserMixin):
@@ -22,10 +26,6 @@ class User(db.Model, UserMixin):
     def __repr__(self):
         return f"User('{self.username}', '{self.email}')"
 
-@login_manager.user_loader
-def load_user(user_id):
-    return User.query.get(int(user_id))
-
 class Category(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50), nullable=False)
@@ -55,6 +55,11 @@ class Post(db.Model):
     slug = db.Column(db.String(255), unique=True, nullable=False)
     summary = db.Column(db.Text, nullable=True)
     content = db.Column(db.Text, nullable=False)
+    # Derived from content when the post is saved (see content.py)
+    excerpt = db.Column(db.String(300), nullable=True)  # plain-text excerpt for listings
+    word_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    toc = db.Column(db.Text, nullable=True)  # JSON: [[level, anchor, text], ...]
+    first_image = db.Column(db.String(255), nullable=True)  # src of the first inline image
     published = db.Column(db.Boolean, default=False)
     featured_image = db.Column(db.String(255), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -66,10 +71,28 @@ class Post(db.Model):
     author_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     category_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=True)
     
+    # Indexes for the hot public queries: published listings sorted by date,
+    # and category pages filtered by category then sorted by date
+    __table_args__ = (
+        db.Index('ix_post_published_created_at', 'published', 'created_at'),
+        db.Index('ix_post_category_id_published_created_at', 'category_id', 'published', 'created_at'),
+    )
+    
     # Relationships
-    tags = db.relationship('Tag', secondary=post_tags, lazy='subquery',
+    # Loaded on access; listing queries eager-load tags only where they are shown
+    tags = db.relationship('Tag', secondary=post_tags, lazy='select',
                           backref=db.backref('posts', lazy=True))
 
+    @property
+    def reading_time(self):
+        """Estimated reading time in whole minutes (at least one)"""
+        return max(1, round((self.word_count or 0) / WORDS_PER_MINUTE))
+    
+    @property
+    def toc_entries(self):
+        """Table of contents as ``[(level, anchor, text), ...]``"""
+        return [tuple(entry) for entry in json.loads(self.toc)] if self.toc else []
+    
     def __repr__(self):
         return f"Post('{self.title}', '{self.slug}')"
 
@@ -81,6 +104,12 @@ class Media(db.Model):
     filetype = db.Column(db.String(50), nullable=False)  # image/pdf/etc
     filesize = db.Column(db.Integer, nullable=False)  # size in bytes
     alt_text = db.Column(db.String(255))
+    width = db.Column(db.Integer)  # base image dimensions in pixels
+    height = db.Column(db.Integer)
+    variants = db.Column(db.Text)  # JSON: {mime type: [[width, path], ...]}
+    status = db.Column(db.String(20), default='ready')  # pending until derivatives are written
+    content_hash = db.Column(db.String(64), index=True)  # SHA-256 of the uploaded bytes
+    ref_count = db.Column(db.Integer, nullable=False, default=0)  # posts using the image
     uploaded_by = db.Column(db.Integer, db.ForeignKey('user.id'))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
@@ -89,3 +118,64 @@ class Media(db.Model):
     
     def __repr__(self):
         return f"Media('{self.filename}', '{self.filetype}')"
+
+class Job(db.Model):
+    """Background job queued for the worker (see tasks.py)"""
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text, nullable=False, default='{}')  # JSON keyword arguments
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued/running/done/failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=3)
+    last_error = db.Column(db.Text)
+    run_after = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # The worker polls for the oldest runnable job
+    __table_args__ = (
+        db.Index('ix_job_status_run_after', 'status', 'run_after'),
+    )
+    
+    def __repr__(self):
+        return f"Job('{self.kind}', '{self.status}')"
+
+class RelatedPost(db.Model):
+    """Precomputed related-post score (see related.py)"""
+    __tablename__ = 'related_posts'
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), primary_key=True)
+    related_id = db.Column(db.Integer, db.ForeignKey('post.id'), primary_key=True)
+    score = db.Column(db.Float, nullable=False)
+    
+    # A post page reads its best-scored rows; updates find the posts listing one
+    __table_args__ = (
+        db.Index('ix_related_posts_post_id_score', 'post_id', 'score'),
+        db.Index('ix_related_posts_related_id', 'related_id'),
+    )
+    
+    def __repr__(self):
+        return f"RelatedPost({self.post_id}, {self.related_id}, {self.score:.3f})"
+
+class SearchChange(db.Model):
+    """A post written since the in-memory search indexes were built (see search.py)
+
+    A row without a post id asks every worker to rebuild its whole index.
+    """
+    __tablename__ = 'search_changes'
+    id = db.Column(db.Integer, primary_key=True)
+    post_id = db.Column(db.Integer, nullable=True)  # no foreign key: deleted posts are logged too
+    changed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f"SearchChange({self.id}, {self.post_id})"
+
+class Aggregate(db.Model):
+    """Maintained count, e.g. published posts per category (see aggregates.py)"""
+    __tablename__ = 'aggregates'
+    name = db.Column(db.String(30), primary_key=True)  # e.g. 'category.published'
+    item_id = db.Column(db.Integer, primary_key=True, autoincrement=False)  # 0 for site-wide totals
+    value = db.Column(db.Integer, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f"Aggregate('{self.name}', {self.item_id}, {self.value})"
@@ -0,0 +1,284 @@
+import hashlib
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, g, request, session, make_response
+from flask_login import current_user
+
+import compression
+import http_cache
+
+# Response header reporting whether the page came from the cache
+CACHE_HEADER = 'X-Page-Cache'
+
+# Headers worth replaying from a cached response
+_STORED_HEADERS = ('Content-Type', 'Content-Language')
+
+
+class MemoryPageCache:
+    """In-process LRU page cache
+
+    Entries are evicted least-recently-used once ``max_entries`` is reached,
+    when their TTL expires, or when one of their tags is invalidated.
+    """
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (expires, tags, payload)
+        self._tag_index = {}           # tag -> set of keys
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, _, payload = entry
+            if expires < time.time():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return payload
+
+    def set(self, key, payload, tags, ttl):
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (time.time() + ttl, tags, payload)
+            for tag in tags:
+                self._tag_index.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def replace(self, key, payload):
+        """Swap the payload of a cached entry, keeping its expiry and tags"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries[key] = (entry[0], entry[1], payload)
+
+    def invalidate_tags(self, tags):
+        with self._lock:
+            for tag in tags:
+                for key in self._tag_index.pop(tag, ()):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tag_index.clear()
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[1]:
+            keys = self._tag_index.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tag_index[tag]
+
+
+class DiskPageCache:
+    """On-disk page cache shared by every worker process
+
+    Each entry is a pickle file named after a hash of its key. Invalidation
+    bumps a version file per tag; an entry stored under an older version of
+    any of its tags is treated as a miss, so no entry index is needed.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.tag_directory = os.path.join(directory, 'tags')
+        os.makedirs(self.tag_directory, exist_ok=True)
+
+    @staticmethod
+    def _hash(value):
+        return hashlib.sha1(value.encode('utf-8')).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, self._hash(key) + '.cache')
+
+    def _tag_path(self, tag):
+        return os.path.join(self.tag_directory, self._hash(tag))
+
+    def _tag_version(self, tag):
+        try:
+            with open(self._tag_path(tag)) as f:
+                return f.read()
+        except OSError:
+            return ''
+
+    def _write(self, path, data, mode='wb'):
+        # Write to a temporary file and rename so readers never see partial data
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, mode) as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _read(self, key):
+        path = self._entry_path(key)
+        try:
+            with open(path, 'rb') as f:
+                expires, versions, payload = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if expires < time.time() or any(
+                self._tag_version(tag) != version for tag, version in versions.items()):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return expires, versions, payload
+
+    def get(self, key):
+        entry = self._read(key)
+        return entry[2] if entry is not None else None
+
+    def set(self, key, payload, tags, ttl):
+        versions = {tag: self._tag_version(tag) for tag in tags}
+        self._write(self._entry_path(key), pickle.dumps((time.time() + ttl, versions, payload)))
+
+    def replace(self, key, payload):
+        """Swap the payload of a cached entry, keeping its expiry and tag versions"""
+        entry = self._read(key)
+        if entry is not None:
+            self._write(self._entry_path(key), pickle.dumps((entry[0], entry[1], payload)))
+
+    def invalidate_tags(self, tags):
+        for tag in tags:
+            self._write(self._tag_path(tag), str(time.time_ns()), mode='w')
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith('.cache'):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_page_cache():
+    """Return the configured page cache backend (``PAGE_CACHE_BACKEND``)"""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                config = current_app.config
+                if config.get('PAGE_CACHE_BACKEND') == 'disk':
+                    directory = config.get('PAGE_CACHE_DIR') or os.path.join(
+                        current_app.instance_path, 'page_cache')
+                    _backend = DiskPageCache(directory)
+                else:
+                    _backend = MemoryPageCache(config.get('PAGE_CACHE_MAX_ENTRIES', 1000))
+    return _backend
+
+
+def add_page_tags(*tags):
+    """Record content tags that the page being rendered depends on"""
+    if 'page_cache_tags' in g:
+        g.page_cache_tags.update(tags)
+
+
+def post_tags_for(post):
+    """Return the cache tags touched by writing ``post``"""
+    tags = {'posts', f'post:{post.id}'}
+    if post.category_id:
+        tags.add(f'category:{post.category_id}')
+    tags.update(f'tag:{tag.id}' for tag in post.tags)
+    return tags
+
+
+def invalidate(*tags):
+    """Evict every cached page depending on any of ``tags``"""
+    if current_app.config.get('PAGE_CACHE_ENABLED') and tags:
+        get_page_cache().invalidate_tags(set(tags))
+
+
+def _is_cacheable_request():
+    return (
+        current_app.config.get('PAGE_CACHE_ENABLED')
+        and request.method == 'GET'
+        and not current_user.is_authenticated
+        and '_flashes' not in session
+    )
+
+
+def cached_response():
+    """The stored response for this request, a 304 for it, or None on a miss
+
+    On a miss (of a cacheable request) the page starts collecting its tags;
+    pass the rendered response to ``store_response``.
+    """
+    if not _is_cacheable_request():
+        return None
+
+    cache = get_page_cache()
+    payload = cache.get(request.full_path)
+    if payload is not None:
+        status, headers, body = payload[:3]
+        validators = payload[3] if len(payload) > 3 else None
+        encodings = dict(payload[4]) if len(payload) > 4 else {}
+        if validators is not None:
+            not_modified = http_cache.revalidate(*validators)
+            if not_modified is not None:
+                not_modified.headers[CACHE_HEADER] = 'HIT'
+                return not_modified
+        response = current_app.response_class(body, status=status, headers=headers)
+        if compression.encode_cached(response, encodings):
+            # First request for this encoding: keep its body for the next ones
+            cache.replace(request.full_path, (status, headers, body, validators, encodings))
+        response.headers[CACHE_HEADER] = 'HIT'
+        return response
+
+    g.page_cache_tags = set()
+    return None
+
+
+def store_response(response):
+    """Store a page rendered after a ``cached_response`` miss"""
+    if 'page_cache_tags' not in g:
+        return response
+    if (response.status_code == 200 and not response.is_streamed
+            and not response.direct_passthrough and not session.modified):
+        headers = [(name, response.headers[name]) for name in _STORED_HEADERS if name in response.headers]
+        body = response.get_data()
+        # Compressed here rather than by Flask-Compress, so the compressed
+        # body is stored too and later hits don't compress the page again
+        encodings = {}
+        compression.encode_cached(response, encodings)
+        get_page_cache().set(request.full_path,
+                             (response.status_code, headers, body, g.get('page_validators'), encodings),
+                             frozenset(g.page_cache_tags), current_app.config.get('PAGE_CACHE_TTL', 300))
+    response.headers[CACHE_HEADER] = 'MISS'
+    return response
+
+
+def cached_page(view):
+    """Serve a view from the page cache for anonymous visitors
+
+    The cache key is the path plus query string. Views call
+    ``add_page_tags`` to declare the posts, categories and tags they render,
+    and writes evict matching pages through ``invalidate``. The view is also
+    marked as a public page, which downstream caches may keep for anonymous
+    visitors (``PUBLIC_CACHE_MAX_AGE``, see http_cache).
+    """
+    @wraps(view)
+    def decorated_function(*args, **kwargs):
+        g.public_page = True
+        if not _is_cacheable_request():
+            return view(*args, **kwargs)
+        cached = cached_response()
+        if cached is not None:
+            return cached
+        return store_response(make_response(view(*args, **kwargs)))
+    return decorated_function
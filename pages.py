@@ -0,0 +1,116 @@
+"""The public pages served both by the Flask app and by asgi.py.
+
+Each page is a generator: it yields ``queries.Fetch`` requests for the
+statements it needs and is sent their results, then returns either a
+finished response (e.g. a 304) or ``(template name, context)``. routes.py
+runs the pages on the request's session (``serve``), asgi.py awaits the same
+requests on an async session, so both deployments render the same pages from
+one implementation.
+"""
+from flask import abort, g
+from sqlalchemy import select
+
+import http_cache
+import images
+import queries
+from models import Category, Media, Tag
+from page_cache import add_page_tags, post_tags_for
+from pagination import paginate
+from queries import Fetch
+from sidebar import cached_sidebar_data, make_sidebar_data, remember_sidebar_data, sidebar_queries
+from streaming import render_page
+
+
+def sidebar():
+    """The sidebar data, like ``sidebar.get_sidebar_data``"""
+    if 'sidebar_data' not in g:
+        data = cached_sidebar_data()
+        if data is None:
+            rows = []
+            for query in sidebar_queries():
+                rows.append((yield Fetch(query, 'rows')))
+            data = make_sidebar_data(*rows)
+            remember_sidebar_data(data)
+        g.sidebar_data = data
+    return g.sidebar_data
+
+
+def load_variants(posts):
+    """Look up the responsive image derivatives of the posts' featured images at once"""
+    paths = images.uncached_variants(post.featured_image for post in posts)
+    if paths:
+        rows = yield Fetch(select(Media).where(Media.filepath.in_(paths)), 'all')
+        images.remember_variants(paths, rows)
+
+
+def index():
+    posts = yield from paginate(queries.index_posts(), per_page=6, count_key='index')
+    add_page_tags('posts', 'sidebar')
+    yield from load_variants(posts.items)
+    return 'index.html', {'title': 'Home', 'posts': posts}
+
+
+def post(slug, show_drafts=False):
+    post = yield Fetch(queries.post_detail(slug).limit(1).statement, 'first')
+    # Only admins see drafts
+    if post is None or (not post.published and not show_drafts):
+        abort(404)
+
+    # Related posts are precomputed (see related.py), so this is one lookup
+    related_posts = yield Fetch(queries.related_posts(post, limit=2).statement, 'all')
+    if not related_posts:
+        # Not computed yet, e.g. right after the migration that added the table
+        related_posts = yield Fetch(queries.shared_tag_or_category_posts(post, limit=2).statement, 'all')
+
+    # Answer conditional requests before rendering anything
+    not_modified = http_cache.not_modified(
+        max([post.updated_at] + [related.updated_at for related in related_posts]),
+        post.id, post.author.username, post.category.name if post.category else None,
+        [tag.name for tag in post.tags], [related.id for related in related_posts]
+    )
+    if not_modified is not None:
+        return not_modified
+
+    add_page_tags(*post_tags_for(post), f'user:{post.author_id}',
+                  *(f'post:{related.id}' for related in related_posts))
+    yield from load_variants([post, *related_posts])
+    return 'post.html', {'title': post.title, 'post': post, 'related_posts': related_posts}
+
+
+def _listing(model, slug, posts_query, template, title):
+    """A category or tag page"""
+    owner = yield Fetch(select(model).filter_by(slug=slug).limit(1), 'first')
+    if owner is None:
+        abort(404)
+    name = model.__tablename__
+
+    # Answer conditional requests before paginating or rendering
+    last_modified, post_count = yield Fetch(
+        queries.listing_version_query(posts_query(owner)).statement, 'one')
+    sidebar_data = yield from sidebar()
+    not_modified = http_cache.not_modified(last_modified, owner.id, owner.name, post_count,
+                                           http_cache.digest(sidebar_data))
+    if not_modified is not None:
+        return not_modified
+
+    posts = yield from paginate(posts_query(owner), per_page=6, count_key=f'{name}:{owner.id}')
+    add_page_tags(f'{name}:{owner.id}', 'sidebar')
+    yield from load_variants(posts.items)
+    return template, {'title': f'{title}: {owner.name}', name: owner, 'posts': posts}
+
+
+def category(slug):
+    return (yield from _listing(Category, slug, queries.category_posts, 'category.html', 'Category'))
+
+
+def tag(slug):
+    return (yield from _listing(Tag, slug, queries.tag_posts, 'tag.html', 'Tag'))
+
+
+def serve(page):
+    """Run a page on the request's session and render it (streamed when enabled)"""
+    rv = queries.run(page)
+    if isinstance(rv, tuple):
+        template_name, context = rv
+        return render_page(template_name, **context)
+    return rv
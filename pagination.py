@@ -0,0 +1,269 @@
+import base64
+import json
+import threading
+import time
+from datetime import datetime
+from math import ceil
+
+from flask import abort, current_app, request
+from flask_sqlalchemy.pagination import Pagination
+from sqlalchemy import and_, func, or_, select
+
+from models import Post
+from queries import Fetch, run
+
+
+class CallbackPagination(Pagination):
+    """Pagination over results that don't come from a single ORM query
+
+    Behaves like the object returned by ``Query.paginate()`` (``items``,
+    ``total``, ``iter_pages()`` ...) so the existing templates work unchanged.
+
+    Args:
+        fetch_items: Callable taking ``(offset, limit)`` and returning a list
+        fetch_count: Callable returning the total number of results
+    """
+
+    def _query_items(self):
+        return self._query_args['fetch_items'](self._query_offset, self.per_page)
+
+    def _query_count(self):
+        return self._query_args['fetch_count']()
+
+    # Offset pagination has no cursors; present so templates can treat both
+    # pagination types the same way
+    next_cursor = None
+    prev_cursor = None
+
+
+def encode_cursor(direction, post):
+    """Build an opaque cursor pointing just past ``post`` in ``direction``"""
+    raw = json.dumps([direction, post.created_at.isoformat(), post.id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """Return ``(direction, created_at, post_id)`` or abort with 404 for a bad token"""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        direction, created_at, post_id = json.loads(raw)
+        if direction not in ('next', 'prev'):
+            raise ValueError(direction)
+        return direction, datetime.fromisoformat(created_at), int(post_id)
+    except (ValueError, TypeError):
+        abort(404)
+
+
+_NEWEST_FIRST = (Post.created_at.desc(), Post.id.desc())
+_OLDEST_FIRST = (Post.created_at.asc(), Post.id.asc())
+
+
+class KeysetPagination:
+    """Cursor pagination over posts ordered by ``(created_at, id)``, newest first
+
+    The first ``shallow_pages`` pages are addressed by page number, so the
+    templates' ``iter_pages`` navigation keeps working there. Deeper pages
+    use opaque ``next_cursor``/``prev_cursor`` tokens, which seek from the
+    last (or first) row shown instead of scanning past an OFFSET.
+
+    Args:
+        query: Post query to paginate; any existing ordering is replaced
+        per_page: Number of posts per page
+        page: Page number, used when no cursor is given
+        cursor: Cursor token from a previous page
+        total: Total number of posts, or None if counting is skipped
+        shallow_pages: Number of leading pages linked by number
+
+    Pass ``query=None`` to fetch the rows elsewhere (``paginate`` does):
+    run ``page_query()`` and hand the result to ``take()``.
+    """
+
+    def __init__(self, query, per_page, page=1, cursor=None, total=None, shallow_pages=5):
+        self.per_page = per_page
+        self.total = total
+        self.shallow_pages = shallow_pages
+        self.cursor = decode_cursor(cursor) if cursor is not None else None
+        self.page = page if self.cursor is None else None
+        if query is not None:
+            self.take(self.page_query(query).all())
+
+    def page_query(self, query):
+        """``query`` narrowed to this page, plus one row to tell if there's another"""
+        query = query.order_by(None)
+        if self.cursor is None:
+            return query.order_by(*_NEWEST_FIRST).offset((self.page - 1) * self.per_page).limit(self.per_page + 1)
+
+        direction, created_at, post_id = self.cursor
+        if direction == 'next':
+            return query.filter(or_(
+                Post.created_at < created_at,
+                and_(Post.created_at == created_at, Post.id < post_id)
+            )).order_by(*_NEWEST_FIRST).limit(self.per_page + 1)
+        return query.filter(or_(
+            Post.created_at > created_at,
+            and_(Post.created_at == created_at, Post.id > post_id)
+        )).order_by(*_OLDEST_FIRST).limit(self.per_page + 1)
+
+    def take(self, rows):
+        """Fill in the page from the rows ``page_query()`` returned"""
+        rows = list(rows)
+        more = len(rows) > self.per_page
+        if self.cursor is None:
+            self.has_prev = self.page > 1
+            self.has_next = more
+            self.items = rows[:self.per_page]
+        elif self.cursor[0] == 'next':
+            self.has_prev = True
+            self.has_next = more
+            self.items = rows[:self.per_page]
+        else:
+            self.has_prev = more
+            self.has_next = True
+            self.items = list(reversed(rows[:self.per_page]))
+            if not self.has_prev:
+                # Walked back to the start, so this is page 1 again
+                self.page = 1
+
+    @property
+    def pages(self):
+        """The total number of pages, or 0 when the total isn't known"""
+        if not self.total:
+            return 0
+        return ceil(self.total / self.per_page)
+
+    @property
+    def prev_num(self):
+        if self.page is None or self.page <= 1:
+            return None
+        return self.page - 1
+
+    @property
+    def next_num(self):
+        if self.page is None or self.page >= self.shallow_pages or not self.has_next:
+            return None
+        return self.page + 1
+
+    @property
+    def prev_cursor(self):
+        if not self.has_prev or self.prev_num is not None or not self.items:
+            return None
+        return encode_cursor('prev', self.items[0])
+
+    @property
+    def next_cursor(self):
+        if not self.has_next or self.next_num is not None or not self.items:
+            return None
+        return encode_cursor('next', self.items[-1])
+
+    def iter_pages(self, *, left_edge=2, left_current=2, right_current=4, right_edge=2):
+        """Yield page numbers like ``Pagination.iter_pages``, limited to the shallow pages"""
+        if self.page is None:
+            return
+        pages_end = max(min(self.pages, self.shallow_pages), self.page) + 1
+        left_end = min(1 + left_edge, pages_end)
+        yield from range(1, left_end)
+        if left_end == pages_end:
+            return
+        mid_start = max(left_end, self.page - left_current)
+        mid_end = min(self.page + right_current + 1, pages_end)
+        if mid_start - left_end > 0:
+            yield None
+        yield from range(mid_start, mid_end)
+        if mid_end == pages_end:
+            return
+        right_start = max(mid_end, pages_end - right_edge)
+        if right_start - mid_end > 0:
+            yield None
+        yield from range(right_start, pages_end)
+
+    def __iter__(self):
+        yield from self.items
+
+
+# Upper bound on cached totals, since search queries make for unbounded keys
+MAX_CACHED_COUNTS = 1000
+
+_count_lock = threading.Lock()
+_counts = {}  # key -> (expires, total)
+
+
+def cached_count(key, count):
+    """Return ``count()``, cached under ``key`` for ``PAGINATION_COUNT_TTL`` seconds
+
+    Returns None when ``PAGINATION_COUNT_TTL`` is negative, which skips
+    counting altogether.
+    """
+    if current_app.config.get('PAGINATION_COUNT_TTL', 60) < 0:
+        return None
+    total = peek_count(key)
+    if total is None:
+        total = count()
+        store_count(key, total)
+    return total
+
+
+def peek_count(key):
+    """The cached total for ``key``, or None if it isn't cached (or expired)"""
+    entry = _counts.get(key)
+    if entry is not None and entry[0] > time.monotonic():
+        return entry[1]
+    return None
+
+
+def store_count(key, total):
+    """Cache a total counted elsewhere (e.g. by the async views)"""
+    ttl = current_app.config.get('PAGINATION_COUNT_TTL', 60)
+    with _count_lock:
+        if len(_counts) >= MAX_CACHED_COUNTS:
+            _counts.clear()
+        _counts[key] = (time.monotonic() + ttl, total)
+
+
+def invalidate_counts():
+    """Forget every cached total after a write"""
+    with _count_lock:
+        _counts.clear()
+
+
+def paginate(query, per_page, count_key):
+    """Paginate a post listing using the ``page`` or ``cursor`` request argument
+
+    Only the first ``PAGINATION_SHALLOW_PAGES`` pages have numbers; asking
+    for a deeper ``page`` without a cursor is a 404.
+
+    A generator yielding the ``queries.Fetch`` requests it needs (see
+    pages.py); ``paginate_posts`` runs it on the request's session.
+
+    Returns:
+        A KeysetPagination
+    """
+    page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor') or None
+    shallow_pages = current_app.config.get('PAGINATION_SHALLOW_PAGES', 5)
+    # Deeper pages are only reached by cursor, never by an OFFSET scan
+    if page < 1 or (cursor is None and page > shallow_pages):
+        abort(404)
+    total = None
+    if current_app.config.get('PAGINATION_COUNT_TTL', 60) >= 0:
+        total = peek_count(count_key)
+        if total is None:
+            total = yield Fetch(select(func.count()).select_from(query.order_by(None).statement.subquery()),
+                                'scalar')
+            store_count(count_key, total)
+    pagination = KeysetPagination(
+        None,
+        per_page=per_page,
+        page=page,
+        cursor=cursor,
+        total=total,
+        shallow_pages=shallow_pages,
+    )
+    pagination.take((yield Fetch(pagination.page_query(query).statement, 'all')))
+    if not pagination.items and page != 1:
+        abort(404)
+    return pagination
+
+
+def paginate_posts(query, per_page, count_key):
+    """Paginate a post listing on the request's session (see ``paginate``)"""
+    return run(paginate(query, per_page, count_key))
@@ -0,0 +1,124 @@
+from collections import namedtuple
+
+from sqlalchemy import false, func, or_
+from sqlalchemy.orm import defer, joinedload, selectinload
+
+from app import db
+from models import Post, RelatedPost, Tag
+
+# A statement a page (see pages.py) needs run, and what it wants back:
+# 'first' or 'all' ORM objects, the 'one' row, every row ('rows') or a 'scalar'
+Fetch = namedtuple('Fetch', 'statement shape')
+
+# Loader options per view. Card listings never show the article body, so the
+# large content column is deferred, and only the relationships each template
+# actually touches are eager-loaded.
+CARD_OPTIONS = (defer(Post.content),)
+CARD_WITH_CATEGORY = CARD_OPTIONS + (joinedload(Post.category),)
+CARD_WITH_TAGS = CARD_OPTIONS + (selectinload(Post.tags),)
+CARD_WITH_CATEGORY_AND_TAGS = CARD_WITH_CATEGORY + (selectinload(Post.tags),)
+ADMIN_ROW_OPTIONS = CARD_WITH_CATEGORY + (joinedload(Post.author),)
+# Search results are shown both publicly and in the admin post list
+SEARCH_RESULT_OPTIONS = CARD_WITH_CATEGORY_AND_TAGS + (joinedload(Post.author),)
+DETAIL_OPTIONS = (joinedload(Post.author), joinedload(Post.category), selectinload(Post.tags))
+
+
+def published_posts(*options):
+    """Published posts, newest first, with the given loader options"""
+    return Post.query.filter(Post.published == True).options(*options).order_by(Post.created_at.desc())
+
+
+def index_posts():
+    """Cards on the home page (shows each post's category)"""
+    return published_posts(*CARD_WITH_CATEGORY)
+
+
+def category_posts(category):
+    """Cards on a category page (shows each post's tags)"""
+    return published_posts(*CARD_WITH_TAGS).filter(Post.category_id == category.id)
+
+
+def tag_posts(tag):
+    """Cards on a tag page (shows each post's category)"""
+    return published_posts(*CARD_WITH_CATEGORY).filter(Post.tags.contains(tag))
+
+
+def search_result_posts(post_ids):
+    """Search result cards and admin rows, in any order"""
+    return Post.query.filter(Post.id.in_(post_ids)).options(*SEARCH_RESULT_OPTIONS)
+
+
+def post_detail(slug):
+    """A single article with everything post.html renders"""
+    return Post.query.filter_by(slug=slug).options(*DETAIL_OPTIONS)
+
+
+def related_posts(post, limit=2):
+    """Related-post cards for ``post``, best score first (see related.py)"""
+    return published_posts(*CARD_OPTIONS).join(
+        RelatedPost, RelatedPost.related_id == Post.id
+    ).filter(RelatedPost.post_id == post.id).order_by(None).order_by(RelatedPost.score.desc()).limit(limit)
+
+
+def shared_tag_or_category_posts(post, limit=2):
+    """Newest posts sharing a tag with ``post``, then its category
+
+    For posts that have no precomputed related posts yet (e.g. before the
+    first `flask related-rebuild`).
+    """
+    shares_tag = Post.tags.any(Tag.id.in_([tag.id for tag in post.tags])) if post.tags else false()
+    same_category = Post.category_id == post.category_id if post.category_id else false()
+    return published_posts(*CARD_OPTIONS).filter(
+        Post.id != post.id, or_(shares_tag, same_category)
+    ).order_by(None).order_by(shares_tag.desc(), Post.created_at.desc()).limit(limit)
+
+
+def admin_posts():
+    """Rows in the admin post list (shows author and category)"""
+    return Post.query.options(*ADMIN_ROW_OPTIONS).order_by(Post.created_at.desc())
+
+
+def recent_posts(limit=5):
+    """Recent posts on the admin dashboard, drafts included"""
+    return Post.query.options(*CARD_OPTIONS).order_by(Post.created_at.desc()).limit(limit)
+
+
+def listing_version_query(query):
+    """Query for ``(newest updated_at, post count)`` of a listing"""
+    return query.order_by(None).with_entities(func.max(Post.updated_at), func.count(Post.id))
+
+
+def listing_version(query):
+    """``(newest updated_at, post count)`` of a listing, for HTTP validators"""
+    return listing_version_query(query).one()
+
+
+def shaped(result, shape):
+    """The part of ``result`` a ``Fetch`` of ``shape`` asked for"""
+    if shape == 'first':
+        return result.scalars().first()
+    if shape == 'all':
+        return result.scalars().unique().all()
+    if shape == 'one':
+        return result.one()
+    if shape == 'rows':
+        return result.all()
+    if shape == 'scalar':
+        return result.scalar()
+    raise ValueError(f'Unknown fetch shape {shape!r}')
+
+
+def run(plan):
+    """Run a generator yielding ``Fetch`` requests on the request's session
+
+    Returns:
+        The generator's return value
+    """
+    try:
+        request = next(plan)
+        while True:
+            request = plan.send(shaped(db.session.execute(request.statement), request.shape))
+    except StopIteration as e:
+        return e.value
+    finally:
+        plan.close()
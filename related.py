@@ -0,0 +1,280 @@
+import heapq
+import math
+from bisect import bisect_left
+from collections import defaultdict, namedtuple
+
+from flask import current_app
+from sqlalchemy import delete, func, insert, select
+
+from app import db
+from models import Post, RelatedPost, post_tags
+
+# Score = TAG_WEIGHT * weighted tag overlap (cosine of IDF-weighted tag
+# vectors, 0..1) + CATEGORY_WEIGHT for the same category + RECENCY_WEIGHT *
+# closeness in publication date. Closeness decays with RECENCY_DAYS and is
+# symmetric, so stored scores never go stale just because time passes.
+TAG_WEIGHT = 1.0
+CATEGORY_WEIGHT = 0.3
+RECENCY_WEIGHT = 0.1
+RECENCY_DAYS = 90.0
+
+# Rows written per INSERT batch
+BATCH_SIZE = 1000
+
+# What scoring needs to know about a post
+Profile = namedtuple('Profile', 'id category_id created_at published tags')
+
+
+def max_related():
+    """Number of related posts stored per post (``RELATED_POSTS_STORED``)"""
+    return current_app.config.get('RELATED_POSTS_STORED', 6)
+
+
+def _load_profiles(*criteria):
+    """Profiles of the posts matching ``criteria``, keyed by id"""
+    rows = db.session.query(Post.id, Post.category_id, Post.created_at, Post.published).filter(*criteria).all()
+    tags = defaultdict(set)
+    ids = [row.id for row in rows]
+    for start in range(0, len(ids), 500):
+        chunk = ids[start:start + 500]
+        for post_id, tag_id in db.session.execute(
+                select(post_tags.c.post_id, post_tags.c.tag_id).where(post_tags.c.post_id.in_(chunk))):
+            tags[post_id].add(tag_id)
+    return {row.id: Profile(row.id, row.category_id, row.created_at, row.published, frozenset(tags[row.id]))
+            for row in rows}
+
+
+class Scorer:
+    """Scores pairs of posts using tag weights from the published posts
+
+    A tag's weight is its inverse document frequency, so sharing a rare tag
+    counts for more than sharing one that is on every post.
+    """
+
+    def __init__(self, document_frequency, post_count):
+        self.default_weight = math.log(1 + max(post_count, 1))
+        self.weights = {tag_id: math.log(1 + post_count / df) for tag_id, df in document_frequency.items()}
+        self._norms = {}
+
+    @classmethod
+    def load(cls):
+        post_count = db.session.query(func.count(Post.id)).filter(Post.published == True).scalar()
+        document_frequency = dict(db.session.query(post_tags.c.tag_id, func.count()).join(
+            Post, Post.id == post_tags.c.post_id
+        ).filter(Post.published == True).group_by(post_tags.c.tag_id).all())
+        return cls(document_frequency, post_count)
+
+    def weight(self, tag_id):
+        return self.weights.get(tag_id, self.default_weight)
+
+    def norm(self, profile):
+        norm = self._norms.get(profile.id)
+        if norm is None:
+            norm = math.sqrt(sum(self.weight(tag_id) ** 2 for tag_id in profile.tags))
+            self._norms[profile.id] = norm
+        return norm
+
+    def combine(self, a, b, dot):
+        """Final score from the weighted tag dot product of ``a`` and ``b``"""
+        same_category = a.category_id is not None and a.category_id == b.category_id
+        if not dot and not same_category:
+            return 0.0
+        tag_score = dot / (self.norm(a) * self.norm(b)) if dot else 0.0
+        days = abs((a.created_at - b.created_at).total_seconds()) / 86400
+        return (TAG_WEIGHT * tag_score + CATEGORY_WEIGHT * same_category
+                + RECENCY_WEIGHT * math.exp(-days / RECENCY_DAYS))
+
+    def score(self, a, b):
+        dot = sum(self.weight(tag_id) ** 2 for tag_id in a.tags & b.tags)
+        return self.combine(a, b, dot)
+
+
+def _nearest_in_category(profile, limit):
+    """Ids of the published posts in ``profile``'s category closest to it in time
+
+    Same-category posts without a shared tag only differ by date closeness,
+    so the nearest ones on either side are the only candidates that matter.
+    """
+    if profile.category_id is None:
+        return set()
+    base = select(Post.id).where(Post.category_id == profile.category_id,
+                                 Post.published == True, Post.id != profile.id)
+    newer = base.where(Post.created_at >= profile.created_at).order_by(Post.created_at.asc()).limit(limit)
+    older = base.where(Post.created_at < profile.created_at).order_by(Post.created_at.desc()).limit(limit)
+    return set(db.session.scalars(newer)) | set(db.session.scalars(older))
+
+
+def _score_candidates(profile, scorer):
+    """``{post id: score}`` for the published posts related to ``profile``"""
+    candidate_ids = _nearest_in_category(profile, max_related())
+    if profile.tags:
+        candidate_ids.update(db.session.scalars(
+            select(post_tags.c.post_id).where(post_tags.c.tag_id.in_(profile.tags))))
+    candidate_ids.discard(profile.id)
+    scores = {}
+    candidate_ids = list(candidate_ids)
+    for start in range(0, len(candidate_ids), 500):
+        candidates = _load_profiles(Post.id.in_(candidate_ids[start:start + 500]), Post.published == True)
+        for candidate in candidates.values():
+            score = scorer.score(profile, candidate)
+            if score > 0:
+                scores[candidate.id] = score
+    return scores
+
+
+def _top(scores, limit):
+    return heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+
+
+def _write_list(post_id, top):
+    db.session.execute(delete(RelatedPost).where(RelatedPost.post_id == post_id))
+    if top:
+        db.session.execute(insert(RelatedPost), [
+            {'post_id': post_id, 'related_id': related_id, 'score': score} for related_id, score in top])
+
+
+def _refresh(profile, scorer):
+    _write_list(profile.id, _top(_score_candidates(profile, scorer), max_related()))
+
+
+def scoring_inputs(post):
+    """What a post's related lists depend on, to tell whether an edit changed it"""
+    return post.category_id, post.created_at, bool(post.published), frozenset(tag.id for tag in post.tags)
+
+
+def update_post(post_id):
+    """Bring related posts up to date after a post was saved or deleted (commits)
+
+    Recomputes the post's own list, then merges it into the lists of the
+    posts it scored against, since scores are symmetric. Posts that listed
+    it but no longer relate to it are recomputed in full. Tag weights drift
+    slightly as posts are added; ``flask related-rebuild`` recomputes
+    everything from scratch.
+    """
+    limit = max_related()
+    scorer = Scorer.load()
+    listed_by = set(db.session.scalars(select(RelatedPost.post_id).where(RelatedPost.related_id == post_id)))
+    profile = _load_profiles(Post.id == post_id).get(post_id)
+
+    scores = {}
+    if profile is None:
+        db.session.execute(delete(RelatedPost).where(RelatedPost.post_id == post_id))
+    else:
+        scores = _score_candidates(profile, scorer)
+        _write_list(post_id, _top(scores, limit))
+        if not profile.published:
+            # Drafts keep their own list but don't appear in anyone else's
+            scores = {}
+
+    db.session.execute(delete(RelatedPost).where(RelatedPost.related_id == post_id))
+    current = defaultdict(dict)
+    neighbour_ids = list(scores)
+    for start in range(0, len(neighbour_ids), 500):
+        for row in RelatedPost.query.filter(RelatedPost.post_id.in_(neighbour_ids[start:start + 500])):
+            current[row.post_id][row.related_id] = row.score
+    # Posts that listed this one but no longer rank it lost an entry
+    stale = listed_by - set(scores)
+    for neighbour_id, score in scores.items():
+        entries = current[neighbour_id]
+        entries[post_id] = score
+        top = _top(entries, limit)
+        if any(related_id == post_id for related_id, _ in top):
+            _write_list(neighbour_id, top)
+        elif neighbour_id in listed_by:
+            stale.add(neighbour_id)
+
+    if stale:
+        for neighbour in _load_profiles(Post.id.in_(stale)).values():
+            _refresh(neighbour, scorer)
+    db.session.commit()
+
+
+def remove_post(post_id):
+    """Delete a post's related rows before the post itself is deleted (not committed)
+
+    Returns:
+        Ids of the posts that listed it; pass them to ``refresh_posts`` after
+        the deletion is committed
+    """
+    listed_by = set(db.session.scalars(select(RelatedPost.post_id).where(RelatedPost.related_id == post_id)))
+    db.session.execute(delete(RelatedPost).where(
+        (RelatedPost.post_id == post_id) | (RelatedPost.related_id == post_id)))
+    listed_by.discard(post_id)
+    return listed_by
+
+
+def refresh_posts(post_ids):
+    """Recompute the related posts of ``post_ids`` in full (commits)"""
+    if not post_ids:
+        return
+    scorer = Scorer.load()
+    for profile in _load_profiles(Post.id.in_(post_ids)).values():
+        _refresh(profile, scorer)
+    db.session.commit()
+
+
+def rebuild():
+    """Recompute every post's related posts in one pass (commits)
+
+    Works like a sparse matrix product of the IDF-weighted post x tag
+    matrix with its transpose: each post's row of tag dot products is
+    accumulated from the tag postings lists, so only pairs that share a tag
+    are ever touched.
+
+    Returns:
+        The number of related-post rows written
+    """
+    limit = max_related()
+    scorer = Scorer.load()
+    profiles = _load_profiles()
+    published = [p for p in profiles.values() if p.published]
+
+    # Sparse columns of the tag matrix: tag -> published posts carrying it
+    postings = defaultdict(list)
+    for profile in published:
+        for tag_id in profile.tags:
+            postings[tag_id].append(profile.id)
+
+    # Published posts per category, sorted by date for nearest-neighbour lookups
+    by_category = defaultdict(list)
+    for profile in published:
+        if profile.category_id is not None:
+            by_category[profile.category_id].append((profile.created_at, profile.id))
+    for members in by_category.values():
+        members.sort()
+
+    rows = []
+    written = 0
+    db.session.execute(delete(RelatedPost))
+    for profile in profiles.values():
+        dots = defaultdict(float)
+        for tag_id in profile.tags:
+            weight = scorer.weight(tag_id) ** 2
+            for other_id in postings.get(tag_id, ()):
+                dots[other_id] += weight
+
+        candidates = set(dots)
+        members = by_category.get(profile.category_id)
+        if members:
+            position = bisect_left(members, (profile.created_at, profile.id))
+            for _, other_id in members[max(0, position - limit):position + limit + 1]:
+                candidates.add(other_id)
+        candidates.discard(profile.id)
+
+        scores = {}
+        for other_id in candidates:
+            score = scorer.combine(profile, profiles[other_id], dots.get(other_id, 0.0))
+            if score > 0:
+                scores[other_id] = score
+        for related_id, score in _top(scores, limit):
+            rows.append({'post_id': profile.id, 'related_id': related_id, 'score': score})
+
+        if len(rows) >= BATCH_SIZE:
+            db.session.execute(insert(RelatedPost), rows)
+            written += len(rows)
+            rows = []
+    if rows:
+        db.session.execute(insert(RelatedPost), rows)
+        written += len(rows)
+    db.session.commit()
+    return written
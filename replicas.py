@@ -0,0 +1,119 @@
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+
+# Bind key of the read replica in SQLALCHEMY_BINDS
+REPLICA_BIND = 'replica'
+
+# Read-only public views whose queries may go to the replica
+REPLICA_ENDPOINTS = {
+    'index', 'post', 'category', 'tag', 'search', 'about',
+    'sitemap', 'sitemap_pages', 'sitemap_posts',
+}
+
+# Session key holding the time until which this visitor reads from the primary
+_STICKY_KEY = 'db_primary_until'
+
+# Last time this process wrote to the primary. Caches filled right after a
+# write (sidebar, page cache) must not be filled from a lagging replica.
+_last_write = 0.0
+_last_write_lock = threading.Lock()
+
+
+def _note_write():
+    global _last_write
+    if has_request_context():
+        g.db_wrote = True
+    with _last_write_lock:
+        _last_write = time.time()
+
+
+def recently_wrote():
+    """Whether this process wrote within the last ``REPLICA_STICKY_SECONDS``"""
+    return time.time() - _last_write <= current_app.config.get('REPLICA_STICKY_SECONDS', 10)
+
+
+def _replica_allowed():
+    if not has_request_context() or not g.get('db_replica') or g.get('db_wrote'):
+        return False
+    return not recently_wrote()
+
+
+class RoutingSession(Session):
+    """Session that sends reads of replica-enabled requests to the replica
+
+    Flushes and INSERT/UPDATE/DELETE statements always go to the primary.
+    Once a request has written, the rest of it reads from the primary too.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            writing = self._flushing or (clause is not None and (
+                getattr(clause, 'is_dml', False) or getattr(clause, 'is_ddl', False)))
+            if writing:
+                _note_write()
+            elif _replica_allowed():
+                engine = self._db.engines.get(REPLICA_BIND)
+                if engine is not None:
+                    return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@contextmanager
+def use_primary():
+    """Read from the primary inside the block, e.g. before a raw SQL write"""
+    previous = g.get('db_replica') if has_request_context() else None
+    if has_request_context():
+        g.db_replica = False
+    try:
+        yield
+    finally:
+        if has_request_context():
+            g.db_replica = previous
+
+
+def sticky():
+    """Whether this visitor wrote recently and must read from the primary"""
+    return session.get(_STICKY_KEY, 0) >= time.time()
+
+
+def init_app(app):
+    """Register the request hooks that turn replica reads on and off"""
+
+    @app.before_request
+    def route_reads():
+        g.db_replica = (
+            REPLICA_BIND in app.config.get('SQLALCHEMY_BINDS', {})
+            and request.endpoint in REPLICA_ENDPOINTS
+            and request.method in ('GET', 'HEAD')
+            # Read-your-writes: whoever just saved something keeps reading
+            # from the primary until the replica has caught up
+            and not sticky()
+        )
+
+    @app.after_request
+    def stick_to_primary(response):
+        # Only signed-in users: anonymous requests write incidentally (e.g.
+        # /search creating its FTS table), and a session cookie on them would
+        # keep public pages out of shared caches. This process' own reads
+        # still avoid the replica after any write (see recently_wrote).
+        if g.get('db_wrote') and '_user_id' in session:
+            session[_STICKY_KEY] = time.time() + app.config.get('REPLICA_STICKY_SECONDS', 10)
+        return response
+
+
+def sync_sqlite(primary_path, replica_path):
+    """Copy a SQLite primary onto its replica file (stands in for replication)"""
+    os.makedirs(os.path.dirname(os.path.abspath(replica_path)), exist_ok=True)
+    source = sqlite3.connect(primary_path)
+    target = sqlite3.connect(replica_path)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
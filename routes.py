@@ -1,76 +1,60 @@
-import os
+import io
 import secrets
-from datetime import datetime, timedelta
-from PIL import Image
-from slugify import slugify
-import bleach
-from flask import render_template, url_for, flash, redirect, request, abort, jsonify
+from datetime import datetime
+from flask import render_template, url_for, flash, redirect, request, abort, jsonify, session, stream_with_context
 from flask_login import login_user, logout_user, current_user, login_required
 from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
 
 from app import app, db
 from models import User, Post, Category, Tag, Media
-from forms import MediaForm, MediaUploadForm
+from sidebar import invalidate_sidebar, load_sidebar_data
+import http_cache
+import search as search_index
+import page_cache
+import sitemaps
+import related
+import aggregates
+import auth
+import bulk
+import metrics
+from page_cache import cached_page, add_page_tags
+import queries
+import pages
+from images import store_image, delete_image, media_references, update_references
+from pagination import paginate_posts, invalidate_counts
+from sidebar import get_sidebar_data
+from content import apply_content, slugify
 
 # Helper functions
 def save_image(form_picture, image_type='content'):
-    """Save uploaded images with a secure filename to the unified media folder structure
+    """Save an uploaded image and a Media row for it, queueing its derivatives
     
     Args:
         form_picture: The uploaded file object
         image_type: Either 'featured' or 'content' to determine subdirectory
+    
+    Returns:
+        The path of the base image relative to the static folder
     """
-    random_hex = secrets.token_hex(8)
-    _, f_ext = os.path.splitext(form_picture.filename)
-    picture_fn = random_hex + f_ext
-    
-    # Define the subdirectory based on image type
-    if image_type not in ['featured', 'content']:
-        # Default to content if invalid type provided
-        image_type = 'content'
-    
-    # Set the folder path relative to static folder
-    folder = f"media/{image_type}"
-    
-    # Use app.static_folder to get the correct absolute path
-    upload_folder = os.path.join(app.static_folder, folder)
-    
-    # Create folder if it doesn't exist
-    os.makedirs(upload_folder, exist_ok=True)
-    
-    # Save the image
-    picture_path = os.path.join(upload_folder, picture_fn)
-    
-    # Resize image to save space
-    output_size = (1200, 800)
-    i = Image.open(form_picture)
-    i.thumbnail(output_size)
-    i.save(picture_path)
-    
-    # Return the relative path to be stored in the database
-    # Always use forward slashes for web URLs, not os.path.join which uses backslashes on Windows
-    return f"{folder}/{picture_fn}"
-
-def clean_html(html_content):
-    """Clean HTML content to prevent XSS vulnerabilities"""
-    allowed_tags = [
-        'a', 'abbr', 'acronym', 'b', 'blockquote', 'br', 'code', 'div', 'em',
-        'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'i', 'img', 'li', 'ol', 'p',
-        'pre', 'span', 'strong', 'table', 'tbody', 'td', 'th', 'thead', 'tr', 'ul'
-    ]
-    allowed_attrs = {
-        '*': ['class', 'style'],
-        'a': ['href', 'rel', 'target'],
-        'img': ['src', 'alt', 'width', 'height']
-    }
-    cleaned = bleach.clean(
-        html_content,
-        tags=allowed_tags,
-        attributes=allowed_attrs,
-        strip=True
-    )
-    return cleaned
+    media = store_image(form_picture, image_type=image_type, uploaded_by=current_user.id)
+    return media.filepath
+
+def sidebar_version():
+    """Digest of the sidebar as the database has it now; take it before a write"""
+    return http_cache.digest(load_sidebar_data())
+
+def content_changed(sidebar_before, *tags):
+    """Drop cached pages that depend on the given tags after a write
+
+    Every listing shows the sidebar, so the cached sidebar and the 'sidebar'
+    tag are only dropped when the write changed it (``sidebar_before`` is
+    ``sidebar_version()`` from before the write).
+    """
+    invalidate_counts()
+    if sidebar_version() != sidebar_before:
+        invalidate_sidebar()
+        tags += ('sidebar',)
+    page_cache.invalidate(*tags)
 
 def admin_required(f):
     """Decorator for routes that require admin privileges"""
@@ -95,63 +79,27 @@ def internal_server_error(e):
 def forbidden(e):
     return render_template('errors/403.html', title='Forbidden'), 403
 
-# Public Routes
+# Public Routes (the pages themselves are in pages.py, shared with asgi.py)
 @app.route('/')
 @app.route('/index')
+@cached_page
 def index():
-    page = request.args.get('page', 1, type=int)
-    posts = Post.query.filter_by(published=True).order_by(Post.created_at.desc()).paginate(page=page, per_page=6)
-    return render_template('index.html', title='Home', posts=posts)
+    return pages.serve(pages.index())
 
 @app.route('/post/<string:slug>')
+@cached_page
 def post(slug):
-    post = Post.query.filter_by(slug=slug).first_or_404()
-    
-    # Only show published posts to non-admin users
-    if not post.published and (not current_user.is_authenticated or not current_user.is_admin):
-        abort(404)
-    
-    # Get related posts based on tags or category
-    related_posts = []
-    if post.tags:
-        tag_ids = [tag.id for tag in post.tags]
-        related_posts = Post.query.filter(
-            Post.id != post.id,
-            Post.published == True,
-            Post.tags.any(Tag.id.in_(tag_ids))
-        ).order_by(Post.created_at.desc()).limit(2).all()
-    
-    # If not enough related posts by tag, add some from same category
-    if len(related_posts) < 2 and post.category:
-        category_related = Post.query.filter(
-            Post.id != post.id,
-            Post.published == True,
-            Post.category_id == post.category_id
-        ).order_by(Post.created_at.desc()).limit(2 - len(related_posts)).all()
-        
-        related_posts.extend(category_related)
-    
-    return render_template('post.html', title=post.title, post=post, related_posts=related_posts)
+    return pages.serve(pages.post(slug, show_drafts=current_user.is_authenticated and current_user.is_admin))
 
 @app.route('/category/<string:slug>')
+@cached_page
 def category(slug):
-    category = Category.query.filter_by(slug=slug).first_or_404()
-    page = request.args.get('page', 1, type=int)
-    posts = Post.query.filter_by(category_id=category.id, published=True).order_by(
-        Post.created_at.desc()).paginate(page=page, per_page=6)
-    
-    return render_template('category.html', title=f'Category: {category.name}', 
-                          category=category, posts=posts)
+    return pages.serve(pages.category(slug))
 
 @app.route('/tag/<string:slug>')
+@cached_page
 def tag(slug):
-    tag = Tag.query.filter_by(slug=slug).first_or_404()
-    page = request.args.get('page', 1, type=int)
-    posts = Post.query.filter(Post.tags.contains(tag), Post.published == True).order_by(
-        Post.created_at.desc()).paginate(page=page, per_page=6)
-    
-    return render_template('tag.html', title=f'Tag: {tag.name}', 
-                          tag=tag, posts=posts)
+    return pages.serve(pages.tag(slug))
 
 @app.route('/search')
 def search():
@@ -161,30 +109,18 @@ def search():
     if not query:
         return redirect(url_for('index'))
     
-    # Search posts by title, content, summary
-    posts = Post.query.filter(
-        Post.published == True,
-        (Post.title.contains(query) | 
-         Post.content.contains(query) | 
-         Post.summary.contains(query))
-    ).order_by(Post.created_at.desc()).paginate(page=page, per_page=10)
+    # Search posts by title, content, summary (ranked by relevance)
+    posts = search_index.get_search_backend().search(query, page=page, per_page=10)
     
-    # Get categories with post counts
-    categories = Category.query.all()
-    categories_with_counts = []
-    for category in categories:
-        post_count = Post.query.filter_by(category_id=category.id, published=True).count()
-        category.post_count = post_count
-        categories_with_counts.append(category)
-    
-    # Get popular tags
-    popular_tags = Tag.query.join(Tag.posts).group_by(Tag.id).order_by(db.func.count().desc()).limit(10).all()
+    # Categories with post counts and popular tags, as in the sidebar
+    sidebar = get_sidebar_data()
     
     return render_template('search.html', title=f'Search Results for: {query}',
-                          query=query, posts=posts, categories=categories_with_counts,
-                          popular_tags=popular_tags)
+                          query=query, posts=posts, categories=sidebar.categories,
+                          popular_tags=sidebar.popular_tags)
 
 @app.route('/about')
+@cached_page
 def about():
     return render_template('about.html', title='About Us')
 
@@ -226,6 +162,9 @@ def login():
 @app.route('/logout')
 @login_required
 def logout():
+    # Drop the whole session, so once the message is shown the visitor has no
+    # cookie and gets the same cacheable pages as any anonymous reader
+    session.clear()
     logout_user()
     flash('You have been logged out.', 'info')
     return redirect(url_for('index'))
@@ -234,14 +173,17 @@ def logout():
 @app.route('/admin')
 @admin_required
 def admin():
-    recent_posts = Post.query.order_by(Post.created_at.desc()).limit(5).all()
+    recent_posts = queries.recent_posts(5).all()
     
-    # Add stats for dashboard counters
+    # Add stats for dashboard counters (maintained in the aggregates table)
+    totals = aggregates.totals()
     stats = {
-        'posts_count': Post.query.count(),
-        'categories_count': Category.query.count(),
-        'tags_count': Tag.query.count(),
-        'users_count': User.query.count()
+        'posts_count': totals[aggregates.POSTS_PUBLISHED] + totals[aggregates.POSTS_DRAFT],
+        'published_count': totals[aggregates.POSTS_PUBLISHED],
+        'drafts_count': totals[aggregates.POSTS_DRAFT],
+        'categories_count': totals[aggregates.CATEGORIES],
+        'tags_count': totals[aggregates.TAGS],
+        'users_count': totals[aggregates.USERS]
     }
     
     # Add system information for the system info panel
@@ -254,8 +196,12 @@ def admin():
         'environment': 'Development' if app.debug else 'Production'
     }
     
+    # Per-endpoint request metrics for the performance panel
+    route_metrics = metrics.summary()[:15]
+
     return render_template('admin/dashboard.html', title='Admin Dashboard', 
-                          recent_posts=recent_posts, stats=stats, system_info=system_info)
+                          recent_posts=recent_posts, stats=stats, system_info=system_info,
+                          route_metrics=route_metrics)
 
 @app.route('/admin/posts')
 @admin_required
@@ -264,12 +210,10 @@ def admin_posts():
     search_query = request.args.get('q', '')
     
     if search_query:
-        posts = Post.query.filter(
-            Post.title.contains(search_query) | 
-            Post.content.contains(search_query)
-        ).order_by(Post.created_at.desc()).paginate(page=page, per_page=10)
+        posts = search_index.get_search_backend().search(
+            search_query, page=page, per_page=10, published_only=False)
     else:
-        posts = Post.query.order_by(Post.created_at.desc()).paginate(page=page, per_page=10)
+        posts = paginate_posts(queries.admin_posts(), per_page=10, count_key='admin')
     
     return render_template('admin/posts.html', title='Manage Posts', posts=posts)
 
@@ -289,18 +233,8 @@ def new_post():
         meta_keywords = request.form.get('meta_keywords')
         published = 'published' in request.form
         
-        # Clean HTML content
-        clean_content = clean_html(content)
-        
-        # Create slug from title
-        slug = slugify(title)
-        
-        # Check for slug uniqueness and modify if needed
-        base_slug = slug
-        count = 1
-        while Post.query.filter_by(slug=slug).first():
-            slug = f"{base_slug}-{count}"
-            count += 1
+        # Create a unique slug from the title
+        slug = bulk.unique_slugs([slugify(title)])[0]
         
         # Handle featured image upload
         featured_image = None
@@ -313,10 +247,10 @@ def new_post():
                                      categories=categories, tags=tags)
         
         # Create new post
+        sidebar_before = sidebar_version()
         post = Post(
             title=title,
             slug=slug,
-            content=clean_content,
             summary=summary,
             category_id=category_id,
             featured_image=featured_image,
@@ -326,12 +260,19 @@ def new_post():
             author_id=current_user.id
         )
         
+        # Sanitize the body and store its excerpt, word count and TOC
+        apply_content(post, content)
+        
         # Add selected tags
         if tag_ids:
-            post.tags = [Tag.query.get(tag_id) for tag_id in tag_ids]
+            post.tags = Tag.query.filter(Tag.id.in_(tag_ids)).all()
         
         db.session.add(post)
+        update_references(set(), media_references(featured_image, post.content))
         db.session.commit()
+        content_changed(sidebar_before, *page_cache.post_tags_for(post))
+        search_index.index_post(post)
+        related.update_post(post.id)
         
         flash('Post created successfully!', 'success')
         return redirect(url_for('admin_posts'))
@@ -347,8 +288,13 @@ def edit_post(post_id):
     tags = Tag.query.all()
     
     if request.method == 'POST':
+        # Pages for the post's previous category and tags are affected too
+        old_cache_tags = page_cache.post_tags_for(post)
+        old_media = media_references(post.featured_image, post.content)
+        old_scoring = related.scoring_inputs(post)
+        sidebar_before = sidebar_version()
         post.title = request.form.get('title')
-        post.content = clean_html(request.form.get('content'))
+        apply_content(post, request.form.get('content'))
         post.summary = request.form.get('summary')
         post.category_id = request.form.get('category_id') or None
         post.meta_description = request.form.get('meta_description')
@@ -367,9 +313,15 @@ def edit_post(post_id):
         
         # Update tags
         tag_ids = request.form.getlist('tags')
-        post.tags = [Tag.query.get(tag_id) for tag_id in tag_ids]
+        post.tags = Tag.query.filter(Tag.id.in_(tag_ids)).all() if tag_ids else []
         
+        update_references(old_media, media_references(post.featured_image, post.content))
         db.session.commit()
+        content_changed(sidebar_before, *old_cache_tags, *page_cache.post_tags_for(post))
+        search_index.index_post(post)
+        # Related posts only depend on the category, tags and dates
+        if related.scoring_inputs(post) != old_scoring:
+            related.update_post(post.id)
         
         flash('Post updated successfully!', 'success')
         return redirect(url_for('admin_posts'))
@@ -381,19 +333,26 @@ def edit_post(post_id):
 @admin_required
 def delete_post(post_id):
     post = Post.query.get_or_404(post_id)
+    sidebar_before = sidebar_version()
     
-    # Delete featured image file if it exists
+    update_references(media_references(post.featured_image, post.content), set())
+    
+    # Delete the featured image unless another post still uses it
     if post.featured_image:
-        try:
-            # Use app.static_folder to get the correct path
-            image_path = os.path.join(app.static_folder, post.featured_image)
-            if os.path.exists(image_path):
-                os.remove(image_path)
-        except Exception as e:
-            app.logger.error(f"Error deleting image file: {str(e)}")
+        media = Media.query.filter_by(filepath=post.featured_image).first()
+        if media is None or media.ref_count <= 0:
+            try:
+                delete_image(post.featured_image)
+            except Exception as e:
+                app.logger.error(f"Error deleting image file: {str(e)}")
     
+    cache_tags = page_cache.post_tags_for(post)
+    listed_by = related.remove_post(post_id)
     db.session.delete(post)
     db.session.commit()
+    content_changed(sidebar_before, *cache_tags)
+    search_index.remove_post(post_id)
+    related.refresh_posts(listed_by)
     
     flash('Post deleted successfully!', 'success')
     return redirect(url_for('admin_posts'))
@@ -403,7 +362,9 @@ def delete_post(post_id):
 @admin_required
 def admin_categories():
     categories = Category.query.all()
-    return render_template('admin/categories.html', title='Manage Categories', categories=categories)
+    post_counts = aggregates.counts('category')
+    return render_template('admin/categories.html', title='Manage Categories', categories=categories,
+                          post_counts=post_counts)
 
 @app.route('/admin/new-category', methods=['GET', 'POST'])
 @admin_required
@@ -421,9 +382,11 @@ def new_category():
             slug = f"{base_slug}-{count}"
             count += 1
         
+        sidebar_before = sidebar_version()
         category = Category(name=name, slug=slug)
         db.session.add(category)
         db.session.commit()
+        content_changed(sidebar_before)
         
         flash('Category created successfully!', 'success')
         return redirect(url_for('admin_categories'))
@@ -436,6 +399,7 @@ def edit_category(category_id):
     category = Category.query.get_or_404(category_id)
     
     if request.method == 'POST':
+        sidebar_before = sidebar_version()
         name = request.form.get('name')
         
         # Update slug if name changed
@@ -453,6 +417,7 @@ def edit_category(category_id):
         
         category.name = name
         db.session.commit()
+        content_changed(sidebar_before, f'category:{category.id}')
         
         flash('Category updated successfully!', 'success')
         return redirect(url_for('admin_categories'))
@@ -469,8 +434,10 @@ def delete_category(category_id):
         flash('Cannot delete category that has posts!', 'danger')
         return redirect(url_for('admin_categories'))
     
+    sidebar_before = sidebar_version()
     db.session.delete(category)
     db.session.commit()
+    content_changed(sidebar_before, f'category:{category_id}')
     
     flash('Category deleted successfully!', 'success')
     return redirect(url_for('admin_categories'))
@@ -480,7 +447,8 @@ def delete_category(category_id):
 @admin_required
 def admin_tags():
     tags = Tag.query.all()
-    return render_template('admin/tags.html', title='Manage Tags', tags=tags)
+    post_counts = aggregates.counts('tag')
+    return render_template('admin/tags.html', title='Manage Tags', tags=tags, post_counts=post_counts)
 
 @app.route('/admin/new-tag', methods=['GET', 'POST'])
 @admin_required
@@ -498,9 +466,11 @@ def new_tag():
             slug = f"{base_slug}-{count}"
             count += 1
         
+        sidebar_before = sidebar_version()
         tag = Tag(name=name, slug=slug)
         db.session.add(tag)
         db.session.commit()
+        content_changed(sidebar_before)
         
         flash('Tag created successfully!', 'success')
         return redirect(url_for('admin_tags'))
@@ -513,6 +483,7 @@ def edit_tag(tag_id):
     tag = Tag.query.get_or_404(tag_id)
     
     if request.method == 'POST':
+        sidebar_before = sidebar_version()
         name = request.form.get('name')
         
         # Update slug if name changed
@@ -530,6 +501,7 @@ def edit_tag(tag_id):
         
         tag.name = name
         db.session.commit()
+        content_changed(sidebar_before, f'tag:{tag.id}')
         
         flash('Tag updated successfully!', 'success')
         return redirect(url_for('admin_tags'))
@@ -542,8 +514,12 @@ def delete_tag(tag_id):
     tag = Tag.query.get_or_404(tag_id)
     
     # Remove the tag from posts but don't delete the posts
+    post_ids = [post.id for post in tag.posts]
+    sidebar_before = sidebar_version()
     db.session.delete(tag)
     db.session.commit()
+    content_changed(sidebar_before, f'tag:{tag_id}')
+    related.refresh_posts(post_ids)
     
     flash('Tag deleted successfully!', 'success')
     return redirect(url_for('admin_tags'))
@@ -553,7 +529,8 @@ def delete_tag(tag_id):
 @admin_required
 def admin_users():
     users = User.query.all()
-    return render_template('admin/users.html', title='Manage Users', users=users)
+    post_counts = aggregates.counts('author')
+    return render_template('admin/users.html', title='Manage Users', users=users, post_counts=post_counts)
 
 @app.route('/admin/new-user', methods=['GET', 'POST'])
 @admin_required
@@ -616,6 +593,8 @@ def edit_user(user_id):
         user.is_admin = is_admin
         
         db.session.commit()
+        auth.forget_user(user_id)
+        page_cache.invalidate(f'user:{user_id}')
         
         flash('User updated successfully!', 'success')
         return redirect(url_for('admin_users'))
@@ -638,70 +617,36 @@ def delete_user(user_id):
     
     db.session.delete(user)
     db.session.commit()
+    auth.forget_user(user_id)
+    page_cache.invalidate(f'user:{user_id}')
     
     flash('User deleted successfully!', 'success')
     return redirect(url_for('admin_users'))
 
 # SEO Improvements - Sitemap
 @app.route('/sitemap.xml')
+@cached_page
 def sitemap():
-    """Generate sitemap.xml for better search engine indexing"""
-    pages = []
-    ten_days_ago = datetime.utcnow() - timedelta(days=10)
-    
-    # Add static pages
-    for rule in app.url_map.iter_rules():
-        # Only include GET routes that don't require parameters and aren't admin routes
-        if ('GET' in rule.methods and 
-            len(rule.arguments) == 0 and 
-            not rule.rule.startswith('/admin') and
-            not rule.rule.startswith('/static') and
-            not rule.rule.startswith('/login') and
-            'sitemap' not in rule.endpoint):
-            
-            pages.append({
-                'loc': url_for(rule.endpoint, _external=True),
-                'lastmod': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S'),
-                'changefreq': 'weekly',
-                'priority': '0.8'
-            })
-    
-    # Add all published blog posts
-    posts = Post.query.filter_by(published=True).all()
-    for post in posts:
-        # Use the post's updated_at date, or created_at if not updated
-        lastmod = post.updated_at or post.created_at
-        
-        pages.append({
-            'loc': url_for('post', slug=post.slug, _external=True),
-            'lastmod': lastmod.strftime('%Y-%m-%dT%H:%M:%S'),
-            'changefreq': 'monthly',
-            'priority': '0.9'
-        })
-    
-    # Add all categories
-    categories = Category.query.all()
-    for category in categories:
-        pages.append({
-            'loc': url_for('category', slug=category.slug, _external=True),
-            'lastmod': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S'),
-            'changefreq': 'weekly',
-            'priority': '0.8'
-        })
-    
-    # Add all tags
-    tags = Tag.query.all()
-    for tag in tags:
-        pages.append({
-            'loc': url_for('tag', slug=tag.slug, _external=True),
-            'lastmod': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S'),
-            'changefreq': 'weekly',
-            'priority': '0.7'
-        })
-    
-    sitemap_xml = render_template('sitemap.xml', pages=pages)
-    response = app.response_class(sitemap_xml, mimetype='application/xml')
-    return response
+    """Sitemap index pointing at the pages sitemap and the post shards"""
+    add_page_tags('posts', 'sidebar')
+    index_xml = sitemaps.render_index(sitemaps.post_shards())
+    return app.response_class(index_xml, mimetype='application/xml')
+
+@app.route('/sitemap-pages.xml')
+@cached_page
+def sitemap_pages():
+    """Sitemap of the static pages, categories and tags"""
+    add_page_tags('posts', 'sidebar')
+    sitemap_xml = render_template('sitemap.xml', pages=sitemaps.page_entries())
+    return app.response_class(sitemap_xml, mimetype='application/xml')
+
+@app.route('/sitemap-posts-<int:shard>.xml')
+def sitemap_posts(shard):
+    """One shard of published posts, streamed on first request and then cached"""
+    count, lastmod = sitemaps.shard_version(shard)
+    if not count:
+        abort(404)
+    return sitemaps.post_shard_response(shard, count, lastmod)
 
 # Generate robots.txt
 @app.route('/robots.txt')
@@ -716,6 +661,49 @@ Disallow: /register/
     """
     return app.response_class(robots_content, mimetype='text/plain')
 
+# Request metrics for Prometheus
+@app.route('/metrics')
+def prometheus_metrics():
+    # Scrapers send METRICS_TOKEN as a bearer token; admins can read it signed in
+    token = app.config.get('METRICS_TOKEN')
+    scraper = token and secrets.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}')
+    if not scraper and not (current_user.is_authenticated and current_user.is_admin):
+        # Plain text for scrapers rather than the site's error pages
+        if current_user.is_authenticated or request.headers.get('Authorization'):
+            return app.response_class('Forbidden\n', status=403, mimetype='text/plain')
+        return app.response_class('Unauthorized\n', status=401, mimetype='text/plain',
+                                  headers={'WWW-Authenticate': 'Bearer'})
+    return app.response_class(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+# Bulk post import/export (same formats as `flask posts-import` / `posts-export`)
+@app.route('/admin/api/posts/import', methods=['POST'])
+@admin_required
+def api_import_posts():
+    """Import posts from an uploaded ``file`` or the raw request body"""
+    upload = request.files.get('file')
+    fmt = request.args.get('format') or bulk.detect_format(
+        upload.filename if upload else None, 'csv' if request.mimetype == 'text/csv' else 'jsonl')
+    if fmt not in bulk.FORMATS:
+        return jsonify({'error': f'Unknown format {fmt!r}'}), 400
+    stream = io.TextIOWrapper(upload.stream if upload else request.stream, encoding='utf-8')
+    # Sanitize inline: a process pool doesn't belong inside a web worker, and
+    # large imports are for `flask posts-import`
+    result = bulk.import_posts(stream, fmt, default_author_id=current_user.id, processes=1,
+                               skip_taken=request.args.get('on_conflict', 'skip') != 'rename')
+    return jsonify({'imported': result.imported, 'skipped': result.skipped, 'errors': result.errors})
+
+@app.route('/admin/api/posts/export')
+@admin_required
+def api_export_posts():
+    """Stream every post as JSONL (default) or CSV"""
+    fmt = request.args.get('format', 'jsonl')
+    if fmt not in bulk.FORMATS:
+        return jsonify({'error': f'Unknown format {fmt!r}'}), 400
+    chunks = bulk.iter_export(fmt, published_only=request.args.get('published_only') == '1')
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    return app.response_class(stream_with_context(chunks), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename=posts.{fmt}'})
+
 # Editor Image Upload Route
 @app.route('/admin/upload-editor-image', methods=['POST'])
 @admin_required
@@ -731,12 +719,16 @@ def upload_editor_image():
     
     try:
         # Save the image to the content subfolder
-        image_path = save_image(image_file, image_type='content')
-        image_url = url_for('static', filename=image_path, _external=True)
+        media = store_image(image_file, image_type='content', uploaded_by=current_user.id)
+        db.session.commit()
+        image_url = url_for('static', filename=media.filepath, _external=True)
         
+        # The original is served until the worker has processed it
         return jsonify({
             'success': True,
-            'url': image_url
+            'url': image_url,
+            'media_id': media.id,
+            'status': media.status
         })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -746,6 +738,7 @@ def upload_editor_image():
 @admin_required
 def admin_media():
     """Admin media gallery page"""
+    from forms import MediaForm  # Flask-WTF is imported on first use
     # Get all media files from database
     media_files = Media.query.order_by(Media.created_at.desc()).all()
     
@@ -765,41 +758,40 @@ def admin_media():
             'filename': media.filename,
             'path': media.filepath,
             'type': image_type,
+            'status': media.status,
+            'references': media.ref_count,
             'date_uploaded': media.created_at
         })
     
     return render_template('admin/media.html', title='Media Gallery', images=images, form=form)
 
+@app.route('/admin/media/<int:image_id>/status')
+@admin_required
+def admin_media_status(image_id):
+    """Report whether an upload has been processed yet (polled by the admin UI)"""
+    media = Media.query.get_or_404(image_id)
+    return jsonify({
+        'id': media.id,
+        'status': media.status,
+        'url': url_for('static', filename=media.filepath)
+    })
+
 @app.route('/admin/media/upload', methods=['POST'])
 @admin_required
 def admin_upload_image():
     """Handle image upload for media gallery"""
+    from forms import MediaForm
     form = MediaForm()
     
     if form.validate_on_submit():
         try:
-            # Save the image file
-            image_path = save_image(form.image.data, image_type=form.image_type.data)
-            
-            # Get file size in bytes
-            file_path = os.path.join(app.static_folder, image_path)
-            file_size = os.path.getsize(file_path)
-            
-            # Get file extension to determine type
-            _, file_ext = os.path.splitext(form.image.data.filename)
-            file_type = f"image/{file_ext.replace('.', '')}"
-            
-            # Create new media record
-            new_media = Media(
-                filename=secure_filename(form.image.data.filename),
-                filepath=image_path,
-                filetype=file_type,
-                filesize=file_size,
+            # Save the upload and queue its derivatives, creating the media record
+            store_image(
+                form.image.data,
+                image_type=form.image_type.data,
                 alt_text=form.alt_text.data if form.alt_text.data else '',
                 uploaded_by=current_user.id
             )
-            
-            db.session.add(new_media)
             db.session.commit()
             
             flash('Image uploaded successfully!', 'success')
@@ -818,14 +810,13 @@ def admin_delete_image(image_id):
     """Delete an image from the media gallery"""
     media = Media.query.get_or_404(image_id)
     
+    if media.ref_count > 0:
+        flash(f'Image is still used by {media.ref_count} post(s) and was not deleted.', 'warning')
+        return redirect(url_for('admin_media'))
+    
     try:
-        # First delete the file from the filesystem
-        file_path = os.path.join(app.static_folder, media.filepath)
-        if os.path.exists(file_path):
-            os.remove(file_path)
-        
-        # Then delete the database record
-        db.session.delete(media)
+        # Delete the database record; the files are removed by the worker
+        delete_image(media.filepath)
         db.session.commit()
         flash('Image deleted successfully!', 'success')
     except Exception as e:
@@ -0,0 +1,391 @@
+import math
+import re
+import sqlite3
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+
+from flask import current_app
+from sqlalchemy import func, insert, select, text
+
+from app import db
+from content import html_to_text
+from models import Post, SearchChange
+from pagination import CallbackPagination, cached_count
+import queries
+import replicas
+
+# Relative weight of each indexed field when ranking results
+FIELD_WEIGHTS = {'title': 10.0, 'summary': 5.0, 'body': 1.0}
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(value):
+    """Split text into lowercase search terms"""
+    return _TOKEN_RE.findall((value or '').lower())
+
+
+def _load_posts(post_ids):
+    """Load posts by id, keeping the ranking order of ``post_ids``"""
+    if not post_ids:
+        return []
+    posts = {post.id: post for post in queries.search_result_posts(post_ids)}
+    return [posts[post_id] for post_id in post_ids if post_id in posts]
+
+
+class SearchBackend:
+    """Interface shared by the search backends
+
+    Backends keep their index in sync through ``index_post`` and
+    ``remove_post``, and return BM25-ranked results from ``search`` as a
+    pagination object compatible with ``Query.paginate()``.
+    """
+
+    def index_post(self, post):
+        raise NotImplementedError
+
+    def remove_post(self, post_id):
+        raise NotImplementedError
+
+    def index_posts(self, rows):
+        """Add posts inserted in bulk, as ``(id, title, summary, content,
+        published, created_at)`` rows (not committed)"""
+        raise NotImplementedError
+
+    def rebuild(self):
+        raise NotImplementedError
+
+    def ranked_ids(self, query, published_only, offset, limit):
+        raise NotImplementedError
+
+    def count(self, query, published_only):
+        raise NotImplementedError
+
+    def search(self, query, page=1, per_page=10, published_only=True):
+        """Search posts and return one page of ranked results"""
+        return CallbackPagination(
+            page=page,
+            per_page=per_page,
+            fetch_items=lambda offset, limit: _load_posts(
+                self.ranked_ids(query, published_only, offset, limit)),
+            fetch_count=lambda: cached_count(
+                f'search:{published_only}:{query}', lambda: self.count(query, published_only)),
+        )
+
+
+class FTS5SearchBackend(SearchBackend):
+    """SQLite FTS5 virtual table keyed by post id"""
+
+    table = 'post_search'
+
+    def __init__(self):
+        self._ready = False
+        self._lock = threading.Lock()
+
+    def _ensure_table(self):
+        """Create the FTS table on first use and fill it for existing databases"""
+        if self._ready:
+            return
+        with self._lock, replicas.use_primary():
+            if self._ready:
+                return
+            exists = db.session.execute(
+                text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                {'name': self.table}
+            ).first()
+            if not exists:
+                db.session.execute(text(
+                    f"CREATE VIRTUAL TABLE {self.table} USING fts5("
+                    "title, summary, body, tokenize = 'porter unicode61')"
+                ))
+                self._populate()
+                db.session.commit()
+            self._ready = True
+
+    def _populate(self):
+        rows = db.session.query(Post.id, Post.title, Post.summary, Post.content).yield_per(500)
+        batch = []
+        for row in rows:
+            batch.append(self._row_params(*row))
+            if len(batch) >= 500:
+                self._insert(batch)
+                batch = []
+        if batch:
+            self._insert(batch)
+
+    @staticmethod
+    def _row_params(post_id, title, summary, content):
+        return {'id': post_id, 'title': title or '', 'summary': summary or '',
+                'body': html_to_text(content)}
+
+    def _insert(self, params):
+        db.session.execute(text(
+            f"INSERT INTO {self.table} (rowid, title, summary, body) "
+            "VALUES (:id, :title, :summary, :body)"
+        ), params)
+
+    @staticmethod
+    def _match_expression(query):
+        # Quote every term so user input can't inject FTS syntax, and allow
+        # prefix matches so partial words still find results
+        terms = tokenize(query)
+        return ' '.join(f'"{term}"*' for term in terms)
+
+    def index_post(self, post):
+        self._ensure_table()
+        self.remove_post(post.id)
+        self._insert([self._row_params(post.id, post.title, post.summary, post.content)])
+
+    def remove_post(self, post_id):
+        self._ensure_table()
+        db.session.execute(text(f"DELETE FROM {self.table} WHERE rowid = :id"), {'id': post_id})
+
+    def index_posts(self, rows):
+        self._ensure_table()
+        # A table created just now was filled with these posts already
+        db.session.execute(text(f"DELETE FROM {self.table} WHERE rowid = :id"), [{'id': row[0]} for row in rows])
+        self._insert([self._row_params(*row[:4]) for row in rows])
+
+    def rebuild(self):
+        self._ensure_table()
+        db.session.execute(text(f"DELETE FROM {self.table}"))
+        self._populate()
+        db.session.commit()
+
+    def _where(self, published_only):
+        sql = f"FROM {self.table} JOIN post ON post.id = {self.table}.rowid WHERE {self.table} MATCH :match"
+        if published_only:
+            sql += " AND post.published = 1"
+        return sql
+
+    def ranked_ids(self, query, published_only, offset, limit):
+        self._ensure_table()
+        match = self._match_expression(query)
+        if not match:
+            return []
+        weights = ', '.join(str(weight) for weight in FIELD_WEIGHTS.values())
+        rows = db.session.execute(text(
+            f"SELECT post.id {self._where(published_only)} "
+            f"ORDER BY bm25({self.table}, {weights}), post.created_at DESC "
+            "LIMIT :limit OFFSET :offset"
+        ), {'match': match, 'limit': limit, 'offset': offset})
+        return [row[0] for row in rows]
+
+    def count(self, query, published_only):
+        self._ensure_table()
+        match = self._match_expression(query)
+        if not match:
+            return 0
+        return db.session.execute(
+            text(f"SELECT count(*) {self._where(published_only)}"), {'match': match}
+        ).scalar()
+
+
+class InvertedIndexSearchBackend(SearchBackend):
+    """Pure-Python in-memory inverted index for databases without FTS5
+
+    Each process builds its own index from the database on first use. Writes
+    don't touch it directly: they log the post in ``search_changes``, and
+    every process replays the changes it hasn't seen before each search, so
+    all workers return the same results. ``rebuild`` logs a marker that makes
+    every process rebuild, and trims the log up to it.
+    """
+
+    k1 = 1.2
+    b = 0.75
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._built = False
+        self._postings = defaultdict(dict)  # term -> {post_id: weighted tf}
+        self._doc_terms = {}                # post_id -> set of terms
+        self._doc_lengths = {}              # post_id -> weighted length
+        self._published = {}                # post_id -> bool
+        self._created = {}                  # post_id -> created_at
+        self._vocabulary = []               # sorted terms, for prefix matching
+        self._seen = 0                      # last search_changes id applied
+
+    def _add(self, post_id, title, summary, content, published, created_at):
+        frequencies = defaultdict(float)
+        length = 0.0
+        for field, value in (('title', title), ('summary', summary), ('body', html_to_text(content))):
+            weight = FIELD_WEIGHTS[field]
+            for term in tokenize(value):
+                frequencies[term] += weight
+                length += weight
+        for term, frequency in frequencies.items():
+            self._postings[term][post_id] = frequency
+        self._doc_terms[post_id] = set(frequencies)
+        self._doc_lengths[post_id] = length
+        self._published[post_id] = bool(published)
+        self._created[post_id] = created_at
+
+    def _discard(self, post_id):
+        for term in self._doc_terms.pop(post_id, ()):
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(post_id, None)
+                if not postings:
+                    del self._postings[term]
+        self._doc_lengths.pop(post_id, None)
+        self._published.pop(post_id, None)
+        self._created.pop(post_id, None)
+
+    @staticmethod
+    def _log(post_ids):
+        if post_ids:
+            db.session.execute(insert(SearchChange), [{'post_id': post_id} for post_id in post_ids])
+
+    def index_post(self, post):
+        self._log([post.id])
+
+    def remove_post(self, post_id):
+        self._log([post_id])
+
+    def index_posts(self, rows):
+        self._log([row[0] for row in rows])
+
+    @staticmethod
+    def _post_rows(*where):
+        return db.session.query(
+            Post.id, Post.title, Post.summary, Post.content, Post.published, Post.created_at
+        ).filter(*where).yield_per(500)
+
+    def _build(self):
+        with self._lock:
+            # Changes logged while the posts are read are replayed afterwards
+            self._seen = db.session.execute(select(func.max(SearchChange.id))).scalar() or 0
+            self._postings.clear()
+            self._doc_terms.clear()
+            self._doc_lengths.clear()
+            self._published.clear()
+            self._created.clear()
+            for row in self._post_rows():
+                self._add(*row)
+            self._vocabulary = sorted(self._postings)
+            self._built = True
+
+    def _sync(self):
+        """Apply the changes other processes (or this one) logged since the last sync"""
+        changes = db.session.execute(
+            select(SearchChange.id, SearchChange.post_id).where(SearchChange.id > self._seen)
+            .order_by(SearchChange.id)).all()
+        if not changes:
+            return
+        if any(post_id is None for _, post_id in changes):
+            self._build()
+            return
+        post_ids = {post_id for _, post_id in changes}
+        for post_id in post_ids:
+            self._discard(post_id)
+        for row in self._post_rows(Post.id.in_(post_ids)):
+            self._add(*row)
+        self._vocabulary = sorted(self._postings)
+        self._seen = changes[-1][0]
+
+    def rebuild(self):
+        """Rebuild this process' index and have every other process rebuild too"""
+        with self._lock:
+            marker = db.session.execute(insert(SearchChange).values(post_id=None)).inserted_primary_key[0]
+            db.session.execute(SearchChange.__table__.delete().where(SearchChange.id < marker))
+            db.session.commit()
+            self._build()
+
+    def _expand(self, term):
+        """Return every indexed term that starts with ``term``"""
+        start = bisect_left(self._vocabulary, term)
+        matches = []
+        for candidate in self._vocabulary[start:]:
+            if not candidate.startswith(term):
+                break
+            matches.append(candidate)
+        return matches
+
+    def _score(self, query, published_only):
+        with self._lock:
+            if self._built:
+                self._sync()
+            else:
+                self._build()
+            terms = tokenize(query)
+            if not terms:
+                return []
+            n_docs = len(self._doc_lengths) or 1
+            avg_length = (sum(self._doc_lengths.values()) / n_docs) or 1.0
+            scores = None
+            for term in terms:
+                # Every query term must match (like FTS5's implicit AND)
+                term_scores = defaultdict(float)
+                for expanded in self._expand(term):
+                    postings = self._postings[expanded]
+                    idf = math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+                    for post_id, frequency in postings.items():
+                        norm = self.k1 * (1 - self.b + self.b * self._doc_lengths[post_id] / avg_length)
+                        term_scores[post_id] += idf * frequency * (self.k1 + 1) / (frequency + norm)
+                if scores is None:
+                    scores = term_scores
+                else:
+                    scores = {post_id: score + term_scores[post_id]
+                              for post_id, score in scores.items() if post_id in term_scores}
+                if not scores:
+                    return []
+            if published_only:
+                scores = {post_id: score for post_id, score in scores.items() if self._published[post_id]}
+            # Ties are broken by recency, newest first
+            return sorted(scores, key=lambda post_id: (
+                -scores[post_id],
+                -(self._created[post_id].timestamp() if self._created[post_id] else 0)
+            ))
+
+    def ranked_ids(self, query, published_only, offset, limit):
+        return self._score(query, published_only)[offset:offset + limit]
+
+    def count(self, query, published_only):
+        return len(self._score(query, published_only))
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def _fts5_available():
+    if db.engine.dialect.name != 'sqlite':
+        return False
+    try:
+        sqlite3.connect(':memory:').execute('CREATE VIRTUAL TABLE probe USING fts5(body)')
+    except sqlite3.OperationalError:
+        return False
+    return True
+
+
+def get_search_backend():
+    """Return the configured search backend
+
+    ``SEARCH_BACKEND`` may be ``'fts5'``, ``'python'`` or ``'auto'`` (the
+    default), which uses FTS5 on SQLite and the inverted index elsewhere.
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                choice = current_app.config.get('SEARCH_BACKEND', 'auto')
+                if choice == 'auto':
+                    choice = 'fts5' if _fts5_available() else 'python'
+                if choice == 'fts5':
+                    _backend = FTS5SearchBackend()
+                else:
+                    _backend = InvertedIndexSearchBackend()
+    return _backend
+
+
+def index_post(post):
+    """Add or refresh a committed post in the search index"""
+    get_search_backend().index_post(post)
+    db.session.commit()
+
+
+def remove_post(post_id):
+    """Remove a deleted post from the search index"""
+    get_search_backend().remove_post(post_id)
+    db.session.commit()
@@ -0,0 +1,135 @@
+import threading
+import time
+from collections import namedtuple
+from collections.abc import Sequence
+
+from flask import g, has_app_context, current_app
+from sqlalchemy import func, select
+
+from app import db
+from models import Aggregate, Post, Category, Tag
+from aggregates import count_join
+
+# Lightweight, immutable snapshots of the sidebar data. Templates only need
+# names, slugs and a few display fields, so there is no reason to hand them
+# ORM objects that are bound to a single request's session.
+CategoryItem = namedtuple('CategoryItem', ['id', 'name', 'slug', 'post_count'])
+TagItem = namedtuple('TagItem', ['id', 'name', 'slug', 'post_count'])
+RecentPostItem = namedtuple('RecentPostItem', ['id', 'title', 'slug', 'created_at'])
+SidebarData = namedtuple('SidebarData', ['categories', 'popular_tags', 'recent_posts'])
+
+_lock = threading.Lock()
+_cached = None
+_cached_at = 0.0
+
+
+def sidebar_queries():
+    """The category, popular tag and recent post statements behind the sidebar"""
+    # Categories with their published post counts, maintained in aggregates
+    categories = select(
+        Category.id, Category.name, Category.slug, func.coalesce(Aggregate.value, 0)
+    ).outerjoin(
+        Aggregate, count_join('category', Category.id, published=True)
+    ).order_by(Category.id)
+
+    # Popular tags (those associated with most posts, drafts included)
+    tag_count = func.sum(Aggregate.value)
+    popular_tags = select(
+        Tag.id, Tag.name, Tag.slug, tag_count
+    ).join(Aggregate, count_join('tag', Tag.id)).group_by(
+        Tag.id, Tag.name, Tag.slug
+    ).having(tag_count > 0).order_by(tag_count.desc()).limit(10)
+
+    # Recent published posts for footer or sidebar
+    recent_posts = select(
+        Post.id, Post.title, Post.slug, Post.created_at
+    ).filter(Post.published == True).order_by(Post.created_at.desc()).limit(5)
+
+    return categories, popular_tags, recent_posts
+
+
+def make_sidebar_data(category_rows, tag_rows, recent_rows):
+    """Build a SidebarData snapshot from the rows of ``sidebar_queries()``"""
+    return SidebarData(
+        categories=tuple(CategoryItem(*row) for row in category_rows),
+        popular_tags=tuple(TagItem(*row) for row in tag_rows),
+        recent_posts=tuple(RecentPostItem(*row) for row in recent_rows),
+    )
+
+
+def load_sidebar_data():
+    """Query the database for the sidebar data and return a SidebarData snapshot"""
+    return make_sidebar_data(*(db.session.execute(query).all() for query in sidebar_queries()))
+
+
+def cached_sidebar_data():
+    """The process-wide snapshot if it is still fresh, else None"""
+    ttl = current_app.config.get('SIDEBAR_CACHE_TTL', 300)
+    if _cached is None or ttl <= 0 or time.monotonic() - _cached_at > ttl:
+        return None
+    return _cached
+
+
+def remember_sidebar_data(data):
+    """Share a freshly loaded snapshot with later requests"""
+    global _cached, _cached_at
+    with _lock:
+        _cached, _cached_at = data, time.monotonic()
+
+
+def get_sidebar_data():
+    """Return the sidebar data, served from the request and process caches
+
+    The snapshot is memoised on ``g`` for the rest of the request and shared
+    across requests and threads for ``SIDEBAR_CACHE_TTL`` seconds. Set the TTL
+    to 0 to disable the process-wide cache.
+    """
+    if 'sidebar_data' in g:
+        return g.sidebar_data
+
+    data = cached_sidebar_data()
+    if data is None:
+        data = load_sidebar_data()
+        remember_sidebar_data(data)
+
+    g.sidebar_data = data
+    return data
+
+
+class DeferredSidebarItems(Sequence):
+    """One sidebar list, loaded the first time a template uses it
+
+    Pages that don't show the sidebar never load it, and streamed pages (see
+    streaming.py) load it only when rendering reaches it.
+    """
+
+    def __init__(self, field):
+        self._field = field
+
+    def _items(self):
+        return getattr(get_sidebar_data(), self._field)
+
+    def __getitem__(self, index):
+        return self._items()[index]
+
+    def __len__(self):
+        return len(self._items())
+
+    def __iter__(self):
+        return iter(self._items())
+
+    def __bool__(self):
+        return bool(self._items())
+
+
+def invalidate_sidebar():
+    """Drop the cached sidebar data after a write that changes it
+
+    Only this process' cache is cleared; other workers pick up the change when
+    their TTL expires.
+    """
+    global _cached
+    with _lock:
+        _cached = None
+    if has_app_context():
+        g.pop('sidebar_data', None)
@@ -0,0 +1,223 @@
+import glob
+import gzip
+import hashlib
+import os
+import threading
+import zlib
+from datetime import timezone
+from urllib.parse import quote
+
+from flask import current_app, request, send_file, stream_with_context, url_for
+from markupsafe import escape
+from sqlalchemy import func
+
+from app import db
+from models import Category, Post, Tag, post_tags
+
+# The sitemap protocol allows at most 50,000 URLs per file
+MAX_URLS = 50000
+
+SITEMAP_NS = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+
+# URLs written per chunk of the streamed response
+CHUNK_URLS = 500
+
+
+def shard_size():
+    """Posts per shard (``SITEMAP_SHARD_SIZE``), capped at the protocol limit"""
+    return max(1, min(current_app.config.get('SITEMAP_SHARD_SIZE', MAX_URLS), MAX_URLS))
+
+
+def format_lastmod(value):
+    """W3C datetime for a naive UTC timestamp"""
+    return value.replace(microsecond=0, tzinfo=timezone.utc).isoformat()
+
+
+def _shard_expression(size):
+    # Shards are fixed post id ranges, so new posts only ever touch the last
+    # shard and an edit only invalidates the shard holding that post
+    return (Post.id - 1) // size + 1
+
+
+def post_shards():
+    """``[(shard, post count, newest lastmod)]`` for shards with published posts"""
+    shard = _shard_expression(shard_size())
+    return db.session.query(
+        shard, func.count(Post.id), func.max(func.coalesce(Post.updated_at, Post.created_at))
+    ).filter(Post.published == True).group_by(shard).order_by(shard).all()
+
+
+def _shard_filter(shard):
+    size = shard_size()
+    return (Post.published == True, Post.id > (shard - 1) * size, Post.id <= shard * size)
+
+
+def shard_version(shard):
+    """``(post count, newest lastmod)`` of one shard; changes whenever its posts do"""
+    return db.session.query(
+        func.count(Post.id), func.max(func.coalesce(Post.updated_at, Post.created_at))
+    ).filter(*_shard_filter(shard)).one()
+
+
+def _post_shard_xml(shard):
+    """Yield the XML of a post shard in chunks, reading only slugs and dates"""
+    yield f'<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="{SITEMAP_NS}">\n'
+    # Build one URL and substitute slugs instead of calling url_for per post
+    placeholder = 'SLUG'
+    post_url = url_for('post', slug=placeholder, _external=True)
+    rows = db.session.query(Post.slug, Post.updated_at, Post.created_at).filter(
+        *_shard_filter(shard)).order_by(Post.id).yield_per(CHUNK_URLS)
+    chunk = []
+    for slug, updated_at, created_at in rows:
+        loc = escape(post_url.replace(placeholder, quote(slug)))
+        chunk.append(
+            f'  <url>\n    <loc>{loc}</loc>\n'
+            f'    <lastmod>{format_lastmod(updated_at or created_at)}</lastmod>\n'
+            '    <changefreq>monthly</changefreq>\n    <priority>0.9</priority>\n  </url>\n'
+        )
+        if len(chunk) >= CHUNK_URLS:
+            yield ''.join(chunk)
+            chunk = []
+    chunk.append('</urlset>\n')
+    yield ''.join(chunk)
+
+
+def _cache_directory():
+    directory = current_app.config.get('SITEMAP_CACHE_DIR') or os.path.join(
+        current_app.instance_path, 'sitemaps')
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def _stream_and_store(chunks, path, gzip_client):
+    """Yield ``chunks`` to the client while writing them gzipped to ``path``
+
+    The file only appears once the whole shard has been written, so an
+    interrupted response never leaves a truncated shard in the cache.
+    """
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # 31: gzip container
+    complete = False
+    try:
+        with open(tmp_path, 'wb') as out:
+            for chunk in chunks:
+                data = chunk.encode('utf-8')
+                compressed = compressor.compress(data)
+                out.write(compressed)
+                if not gzip_client:
+                    yield data
+                elif compressed:
+                    yield compressed
+            tail = compressor.flush()
+            out.write(tail)
+            if gzip_client:
+                yield tail
+        os.replace(tmp_path, path)
+        complete = True
+    finally:
+        if not complete and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _read_gzip(path):
+    with gzip.open(path, 'rb') as f:
+        yield from iter(lambda: f.read(64 * 1024), b'')
+
+
+def post_shard_response(shard, count, lastmod):
+    """Serve a post shard from the cache, or stream and cache it
+
+    Cached shards are stored gzipped under a name that includes the shard's
+    version, so a shard is regenerated only after posts in its id range are
+    added, edited, unpublished or deleted.
+    """
+    version = hashlib.md5(f'{shard_size()}:{count}:{lastmod.isoformat()}'.encode()).hexdigest()[:12]
+    directory = _cache_directory()
+    path = os.path.join(directory, f'posts-{shard}-{version}.xml.gz')
+    gzip_client = bool(request.accept_encodings['gzip'])
+
+    if os.path.exists(path):
+        if gzip_client:
+            response = send_file(path, mimetype='application/xml', conditional=True)
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            response = current_app.response_class(_read_gzip(path), mimetype='application/xml')
+    else:
+        for stale in glob.glob(os.path.join(directory, f'posts-{shard}-*.xml.gz')):
+            try:
+                os.remove(stale)
+            except OSError:
+                pass
+        response = current_app.response_class(
+            stream_with_context(_stream_and_store(_post_shard_xml(shard), path, gzip_client)),
+            mimetype='application/xml')
+        if gzip_client:
+            # Flask-Compress leaves responses with a Content-Encoding alone,
+            # so the shard streams instead of being buffered for compression
+            response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def page_entries():
+    """Entries for the pages sitemap: static pages, categories and tags
+
+    Categories and tags carry the date of their newest published post.
+    """
+    pages = []
+    for rule in current_app.url_map.iter_rules():
+        # Only include GET routes that don't require parameters and aren't admin routes
+        if ('GET' in rule.methods and
+            len(rule.arguments) == 0 and
+            not rule.rule.startswith('/admin') and
+            not rule.rule.startswith('/static') and
+            not rule.rule.startswith('/login') and
+            'sitemap' not in rule.endpoint):
+            pages.append({
+                'loc': url_for(rule.endpoint, _external=True),
+                'lastmod': None,
+                'changefreq': 'weekly',
+                'priority': '0.8'
+            })
+
+    newest = func.max(func.coalesce(Post.updated_at, Post.created_at))
+    categories = db.session.query(Category.slug, newest).outerjoin(
+        Post, (Post.category_id == Category.id) & (Post.published == True)
+    ).group_by(Category.id, Category.slug).order_by(Category.id)
+    for slug, lastmod in categories:
+        pages.append({
+            'loc': url_for('category', slug=slug, _external=True),
+            'lastmod': lastmod and format_lastmod(lastmod),
+            'changefreq': 'weekly',
+            'priority': '0.8'
+        })
+
+    tags = db.session.query(Tag.slug, newest).outerjoin(
+        post_tags, post_tags.c.tag_id == Tag.id
+    ).outerjoin(
+        Post, (Post.id == post_tags.c.post_id) & (Post.published == True)
+    ).group_by(Tag.id, Tag.slug).order_by(Tag.id)
+    for slug, lastmod in tags:
+        pages.append({
+            'loc': url_for('tag', slug=slug, _external=True),
+            'lastmod': lastmod and format_lastmod(lastmod),
+            'changefreq': 'weekly',
+            'priority': '0.7'
+        })
+    return pages
+
+
+def render_index(shards):
+    """The sitemap index: the pages sitemap followed by every post shard"""
+    newest = max((lastmod for _, _, lastmod in shards), default=None)
+    entries = [(url_for('sitemap_pages', _external=True), newest)]
+    entries += [(url_for('sitemap_posts', shard=shard, _external=True), lastmod)
+                for shard, _, lastmod in shards]
+    parts = [f'<?xml version="1.0" encoding="UTF-8"?>\n<sitemapindex xmlns="{SITEMAP_NS}">\n']
+    for loc, lastmod in entries:
+        parts.append(f'  <sitemap>\n    <loc>{escape(loc)}</loc>\n')
+        if lastmod is not None:
+            parts.append(f'    <lastmod>{format_lastmod(lastmod)}</lastmod>\n')
+        parts.append('  </sitemap>\n')
+    parts.append('</sitemapindex>\n')
+    return ''.join(parts)
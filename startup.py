@@ -0,0 +1,37 @@
+"""How long each phase of loading the app took in this process.
+
+app.py is split into phases (imports, config, extensions, views, commands)
+and marks the end of each one here. The phases are printed when
+STARTUP_LOG is set, exported on /metrics and measured in a fresh process
+by `flask startup-report`. For a per-module breakdown of the import phases
+run ``python -X importtime -c 'import app'``.
+
+This module must stay free of imports beyond the standard library: app.py
+imports it first so that importing Flask and the extensions is timed too.
+"""
+import time
+
+# End of the previous phase (the first one starts when app.py begins)
+_previous = time.perf_counter()
+_phases = []
+
+
+def mark(phase):
+    """End ``phase``, which ran since the previous mark"""
+    global _previous
+    now = time.perf_counter()
+    _phases.append((phase, now - _previous))
+    _previous = now
+
+
+def phases():
+    """``[(phase, seconds), ...]`` in the order they ran"""
+    return list(_phases)
+
+
+def report(timings=None):
+    """One line with the total and each phase, e.g. for the server log"""
+    timings = phases() if timings is None else timings
+    total = sum(seconds for _, seconds in timings)
+    return f'Started in {total * 1000:.0f} ms (' + ', '.join(
+        f'{phase} {seconds * 1000:.0f} ms' for phase, seconds in timings) + ')'
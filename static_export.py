@@ -0,0 +1,294 @@
+import gzip
+import json
+import os
+import shutil
+from collections import defaultdict
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import select
+
+from app import app, db
+from models import Category, Post, RelatedPost, Tag, post_tags
+from sidebar import load_sidebar_data
+import http_cache
+import sitemaps
+
+# Written next to the exported pages; describes what they were rendered from
+MANIFEST_NAME = '.export-manifest.json'
+
+# Related posts shown on an article page (see routes.post)
+RELATED_SHOWN = 2
+
+# Units of work: each renders one page, or one listing with its numbered pages
+INDEX = ('index',)
+ABOUT = ('about',)
+SITEMAPS = ('sitemaps',)
+ROBOTS = ('robots',)
+
+
+def output_dir():
+    """Export directory (``STATIC_EXPORT_DIR``, defaults to instance/export)"""
+    return current_app.config.get('STATIC_EXPORT_DIR') or os.path.join(current_app.instance_path, 'export')
+
+
+def page_file(path, page=1):
+    """File a URL path is exported to
+
+    Pages become ``<path>/index.html``; page N of a listing is exported to
+    ``<path>/page/N/index.html``, so the front server maps ``?page=N`` there.
+    Files with an extension (sitemaps, robots.txt) keep their name.
+    """
+    path = path.strip('/')
+    if os.path.splitext(path)[1]:
+        return path
+    parts = [path] if path else []
+    if page > 1:
+        parts += ['page', str(page)]
+    return '/'.join(parts + ['index.html'])
+
+
+def _write(root, relative, data):
+    target = os.path.join(root, *relative.split('/'))
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp_path = f'{target}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, target)
+
+
+def _fetch(client, path, base_url, query_string=None):
+    # A fresh app context per page, so nothing on ``g`` carries over
+    with app.app_context():
+        response = client.get(path, base_url=base_url, query_string=query_string)
+    data = response.get_data()
+    if response.headers.get('Content-Encoding') == 'gzip':
+        data = gzip.decompress(data)
+    return response.status_code, data
+
+
+def _listing_path(unit):
+    return '/' if unit == INDEX else f'/{unit[0]}/{unit[1]}'
+
+
+def export_unit(unit, root, base_url):
+    """Render one unit of work into ``root``
+
+    Returns:
+        The files written, relative to ``root``
+    """
+    client = app.test_client()
+    written = []
+    kind = unit[0]
+    if kind == 'post' or unit in (ABOUT, ROBOTS):
+        path = {'post': lambda: f'/post/{unit[1]}', 'about': lambda: '/about', 'robots': lambda: '/robots.txt'}[kind]()
+        status, data = _fetch(client, path, base_url)
+        if status == 200:
+            _write(root, page_file(path), data)
+            written.append(page_file(path))
+    elif unit == SITEMAPS:
+        paths = ['/sitemap.xml', '/sitemap-pages.xml']
+        with app.app_context():
+            paths += [f'/sitemap-posts-{shard}.xml' for shard, _, _ in sitemaps.post_shards()]
+        for path in paths:
+            status, data = _fetch(client, path, base_url)
+            if status == 200:
+                _write(root, page_file(path), data)
+                written.append(page_file(path))
+    else:
+        # A listing: page 1 plus the numbered pages it links to
+        path = _listing_path(unit)
+        shallow = app.config.get('PAGINATION_SHALLOW_PAGES', 5)
+        page = 1
+        while page <= shallow:
+            status, data = _fetch(client, path, base_url, {'page': page} if page > 1 else None)
+            if status != 200:
+                break
+            _write(root, page_file(path, page), data)
+            written.append(page_file(path, page))
+            page += 1
+        # Drop numbered pages the listing no longer has
+        pages_dir = os.path.join(root, *page_file(path, 2).split('/')[:-2])
+        if os.path.isdir(pages_dir):
+            for name in os.listdir(pages_dir):
+                if not name.isdigit() or int(name) >= page:
+                    shutil.rmtree(os.path.join(pages_dir, name), ignore_errors=True)
+    return written
+
+
+def _init_worker():
+    # Pool processes must not share the parent's database connections
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+
+def _post_states():
+    """``{post id: state}`` for every post, describing what its pages show"""
+    tags = defaultdict(list)
+    for post_id, tag_id in db.session.execute(select(post_tags.c.post_id, post_tags.c.tag_id)):
+        tags[post_id].append(tag_id)
+    related = defaultdict(list)
+    rows = db.session.execute(
+        select(RelatedPost.post_id, RelatedPost.related_id).join(Post, Post.id == RelatedPost.related_id)
+        .where(Post.published == True).order_by(RelatedPost.post_id, RelatedPost.score.desc()))
+    for post_id, related_id in rows:
+        if len(related[post_id]) < RELATED_SHOWN:
+            related[post_id].append(related_id)
+    states = {}
+    for row in db.session.query(Post.id, Post.slug, Post.published, Post.category_id, Post.updated_at):
+        states[str(row.id)] = {
+            'slug': row.slug,
+            'published': bool(row.published),
+            'category_id': row.category_id,
+            'tags': sorted(tags[row.id]),
+            'related': related[row.id],
+            'updated_at': row.updated_at.isoformat() if row.updated_at else None,
+        }
+    return states
+
+
+def _taxonomy():
+    """Category and tag ids mapped to their slugs and names"""
+    return {
+        'category': {str(id): [slug, name] for id, slug, name in db.session.query(Category.id, Category.slug, Category.name)},
+        'tag': {str(id): [slug, name] for id, slug, name in db.session.query(Tag.id, Tag.slug, Tag.name)},
+    }
+
+
+def _snapshot():
+    return {
+        'sidebar': http_cache.digest(load_sidebar_data()),
+        'taxonomy': _taxonomy(),
+        'posts': _post_states(),
+    }
+
+
+def _all_units(snapshot):
+    units = [INDEX, ABOUT, SITEMAPS, ROBOTS]
+    units += [('post', state['slug']) for state in snapshot['posts'].values() if state['published']]
+    units += [('category', slug) for slug, _ in snapshot['taxonomy']['category'].values()]
+    units += [('tag', slug) for slug, _ in snapshot['taxonomy']['tag'].values()]
+    return units
+
+
+def affected_units(old, new):
+    """What to re-render after the posts changed from ``old`` to ``new``
+
+    Follows what the views render: an article shows its category, tags and
+    related posts; listings show their posts' cards. Every page carries the
+    sidebar, so a sidebar, category or tag change returns None (export all).
+
+    Returns:
+        ``(units, stale files)``, or None when everything must be exported
+    """
+    if old['sidebar'] != new['sidebar'] or old['taxonomy'] != new['taxonomy']:
+        return None
+    def public(state):
+        return state is not None and state['published']
+
+    # Drafts appear on no public page, so only changes to published posts count
+    changed = {post_id for post_id in set(old['posts']) | set(new['posts'])
+               if old['posts'].get(post_id) != new['posts'].get(post_id)
+               and (public(old['posts'].get(post_id)) or public(new['posts'].get(post_id)))}
+    if not changed:
+        return set(), set()
+
+    categories = new['taxonomy']['category']
+    tags = new['taxonomy']['tag']
+    units = {INDEX, SITEMAPS}
+    stale = set()
+    for post_id in changed:
+        before, after = old['posts'].get(post_id), new['posts'].get(post_id)
+        for state in (before, after):
+            if state is None:
+                continue
+            if state['category_id'] is not None and str(state['category_id']) in categories:
+                units.add(('category', categories[str(state['category_id'])][0]))
+            units.update(('tag', tags[str(tag_id)][0]) for tag_id in state['tags'] if str(tag_id) in tags)
+        if public(after):
+            units.add(('post', after['slug']))
+        if public(before) and (not public(after) or after['slug'] != before['slug']):
+            stale.add(page_file(f"/post/{before['slug']}"))
+
+    # Articles whose related posts include a changed post, before or after
+    for snapshot in (old, new):
+        for post_id, state in snapshot['posts'].items():
+            current = new['posts'].get(post_id)
+            if public(current) and changed.intersection(map(str, state['related'])):
+                units.add(('post', current['slug']))
+    return units, stale
+
+
+def _load_manifest(root):
+    try:
+        with open(os.path.join(root, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def export_site(root=None, base_url=None, processes=None, incremental=False, log=print):
+    """Pre-render the public pages into ``root`` for a front server to serve
+
+    A full export renders every page on a pool of processes. With
+    ``incremental`` only the pages affected by posts changed since the last
+    export are rendered (see ``affected_units``), falling back to a full
+    export when there is no previous one or the change touches every page.
+
+    Returns:
+        The number of files written
+    """
+    root = root or output_dir()
+    base_url = base_url or current_app.config.get('STATIC_EXPORT_BASE_URL') or 'http://localhost/'
+    snapshot = _snapshot()
+
+    plan = None
+    previous = _load_manifest(root) if incremental else None
+    if previous is not None:
+        plan = affected_units(previous, snapshot)
+        if plan is None:
+            log('Sidebar, categories or tags changed; exporting everything.')
+
+    if plan is not None:
+        units, stale = plan
+        for relative in stale:
+            target = os.path.join(root, *relative.split('/'))
+            if os.path.exists(target):
+                os.remove(target)
+                log(f'Removed {relative}')
+        written = [relative for unit in sorted(units) for relative in export_unit(unit, root, base_url)]
+        snapshot['exported_at'] = datetime.utcnow().isoformat()
+        _write(root, MANIFEST_NAME, json.dumps(snapshot).encode('utf-8'))
+    else:
+        written = _full_export(root, base_url, snapshot, processes or os.cpu_count() or 1)
+    log(f'Exported {len(written)} file(s) to {root}.')
+    return len(written)
+
+
+def _full_export(root, base_url, snapshot, processes):
+    """Render everything into a staging directory, then swap it in
+
+    The front server keeps serving the previous export until the swap.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    root = root.rstrip(os.sep)
+    staging, previous = root + '.new', root + '.old'
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    units = _all_units(snapshot)
+    written = []
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker) as pool:
+        chunksize = max(1, len(units) // (processes * 4))
+        for files in pool.map(export_unit, units, [staging] * len(units), [base_url] * len(units),
+                              chunksize=chunksize):
+            written.extend(files)
+
+    snapshot['exported_at'] = datetime.utcnow().isoformat()
+    _write(staging, MANIFEST_NAME, json.dumps(snapshot).encode('utf-8'))
+    shutil.rmtree(previous, ignore_errors=True)
+    if os.path.isdir(root):
+        os.replace(root, previous)
+    os.replace(staging, root)
+    shutil.rmtree(previous, ignore_errors=True)
+    return written
@@ -0,0 +1,78 @@
+"""Streamed rendering of long pages (opt-in with ``STREAM_TEMPLATES``).
+
+``render_template`` builds the whole page before the first byte is sent.
+Views that call ``render_page`` instead have the template rendered with
+Jinja's ``generate`` and sent in parts: templates mark where a part ends
+with ``{{ stream_flush() }}`` (after ``</head>``, after the main content),
+so the browser gets the head and the article while the rest is rendered.
+The sidebar is deferred too: it is loaded once rendering reaches it (see
+``sidebar.DeferredSidebarItems``).
+
+A page is only streamed when nothing must happen after its headers are
+sent: it is rendered in full when the page cache is storing it, when a
+flash message is pending (showing it writes to the session) and for other
+methods than GET. Pages served by asgi.py are always rendered in full.
+"""
+from flask import current_app, g, request, session, stream_template, render_template
+from flask_login import current_user
+from markupsafe import Markup
+
+from app import app
+
+# Where a part of a streamed page ends; never part of the output
+FLUSH_MARKER = '\x00stream-flush\x00'
+
+
+@app.template_global()
+def stream_flush():
+    """End the current part of a streamed page (renders nothing otherwise)"""
+    return Markup(FLUSH_MARKER) if g.get('streamed_page') else ''
+
+
+def _can_stream():
+    return (
+        current_app.config.get('STREAM_TEMPLATES')
+        and request.method == 'GET'
+        and 'page_cache_tags' not in g
+        and '_flashes' not in session
+    )
+
+
+def _parts(chunks):
+    """Join Jinja's many small chunks into the parts between flush markers"""
+    buffer = []
+    try:
+        for chunk in chunks:
+            if FLUSH_MARKER not in chunk:
+                buffer.append(chunk)
+                continue
+            *ended, rest = chunk.split(FLUSH_MARKER)
+            for piece in ended:
+                buffer.append(piece)
+                part = ''.join(buffer)
+                if part:
+                    yield part
+                buffer = []
+            buffer.append(rest)
+        part = ''.join(buffer)
+        if part:
+            yield part
+    finally:
+        # Closing the template stream ends the request context it keeps
+        chunks.close()
+
+
+def render_page(template_name, **context):
+    """``render_template``, or a streamed response when the page may be streamed
+
+    Returns:
+        The rendered page, as a string or a streamed response
+    """
+    if not _can_stream():
+        return render_template(template_name, **context)
+    # Load the user now: Flask-Login may write to the session, which can't
+    # change once the headers are sent
+    current_user._get_current_object()
+    g.streamed_page = True
+    return current_app.response_class(_parts(stream_template(template_name, **context)),
+                                      mimetype='text/html')
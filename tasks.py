@@ -0,0 +1,243 @@
+import json
+import os
+import time
+import traceback
+from datetime import datetime, timedelta
+
+from flask import current_app, g, has_request_context
+from sqlalchemy import inspect, update
+
+from app import app, db
+from models import Job
+
+# kind -> (handler, on_failure)
+HANDLERS = {}
+
+# File in the instance folder that `flask worker` touches while it runs
+HEARTBEAT_FILE = 'worker.heartbeat'
+
+
+def task(kind, on_failure=None):
+    """Register a function as the handler for jobs of ``kind``
+
+    Handlers receive the job payload as keyword arguments. ``on_failure``
+    is called with the same arguments once the job has used up its retries.
+    """
+    def decorator(f):
+        HANDLERS[kind] = (f, on_failure)
+        return f
+    return decorator
+
+
+def enqueue(kind, max_attempts=3, **payload):
+    """Queue a job in the current transaction
+
+    The job becomes visible to the worker when the caller commits, so it is
+    never picked up for rows that were rolled back. With ``TASK_QUEUE_EAGER``
+    the job runs immediately in this process instead (handy without a
+    worker, e.g. in development), inside a savepoint so a failing job
+    doesn't undo the caller's changes. When no worker is running (see
+    ``worker_alive``), a job queued during a request runs at the end of that
+    request unless a worker claims it first.
+    """
+    job = Job(kind=kind, payload=json.dumps(payload), max_attempts=max_attempts)
+    db.session.add(job)
+    if current_app.config.get('TASK_QUEUE_EAGER'):
+        handler, on_failure = HANDLERS[kind]
+        job.attempts = 1
+        try:
+            with db.session.begin_nested():
+                handler(**payload)
+        except Exception:
+            job.status = 'failed'
+            job.last_error = traceback.format_exc()
+            if on_failure is not None:
+                on_failure(**payload)
+        else:
+            job.status = 'done'
+        job.finished_at = datetime.utcnow()
+    elif has_request_context() and not worker_alive():
+        g.setdefault('unclaimed_jobs', []).append(job)
+    return job
+
+
+def _heartbeat_path():
+    return os.path.join(current_app.instance_path, HEARTBEAT_FILE)
+
+
+def beat():
+    """Record that a worker is running"""
+    path = _heartbeat_path()
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, 'a').close()
+
+
+def worker_alive():
+    """Whether a worker beat within the last ``TASK_WORKER_TIMEOUT`` seconds"""
+    try:
+        last = os.path.getmtime(_heartbeat_path())
+    except OSError:
+        return False
+    return time.time() - last <= current_app.config.get('TASK_WORKER_TIMEOUT', 30)
+
+
+@app.teardown_request
+def run_unclaimed_jobs(exc):
+    """Run the jobs this request queued while no worker was running
+
+    Claiming is the same conditional UPDATE the worker uses, so a worker
+    that started meanwhile never runs them twice. Jobs of a rolled-back
+    transaction were never stored and are skipped.
+    """
+    jobs = g.pop('unclaimed_jobs', None)
+    if not jobs or exc is not None:
+        return
+    db.session.rollback()
+    for job in jobs:
+        identity = inspect(job).identity
+        if identity is None:
+            continue
+        claimed = db.session.execute(
+            update(Job).where(Job.id == identity[0], Job.status == 'queued').values(
+                status='running', attempts=Job.attempts + 1, started_at=datetime.utcnow())
+        ).rowcount
+        db.session.commit()
+        if claimed:
+            try:
+                run_job(identity[0])
+            except Exception:
+                db.session.rollback()
+                current_app.logger.exception('Job %s failed to run inline', identity[0])
+
+
+def _execute(job):
+    """Run a claimed job and record the outcome, retrying with backoff"""
+    handler, on_failure = HANDLERS[job.kind]
+    payload = json.loads(job.payload or '{}')
+    try:
+        handler(**payload)
+    except Exception:
+        db.session.rollback()
+        job = db.session.get(Job, job.id)
+        job.last_error = traceback.format_exc()
+        if job.attempts >= job.max_attempts:
+            job.status = 'failed'
+            job.finished_at = datetime.utcnow()
+            if on_failure is not None:
+                on_failure(**payload)
+        else:
+            # Exponential backoff: 30s, 60s, 120s, ...
+            delay = current_app.config.get('TASK_RETRY_DELAY', 30) * 2 ** (job.attempts - 1)
+            job.status = 'queued'
+            job.run_after = datetime.utcnow() + timedelta(seconds=delay)
+        db.session.commit()
+        return False
+    job.status = 'done'
+    job.finished_at = datetime.utcnow()
+    job.last_error = None
+    db.session.commit()
+    return True
+
+
+def claim_next():
+    """Atomically move the oldest runnable job to 'running' and return its id
+
+    Claiming is a conditional UPDATE, so several worker processes (or
+    hosts sharing the database) never run the same job twice.
+    """
+    now = datetime.utcnow()
+    while True:
+        job_id = db.session.query(Job.id).filter(
+            Job.status == 'queued', Job.run_after <= now
+        ).order_by(Job.id).limit(1).scalar()
+        if job_id is None:
+            db.session.rollback()
+            return None
+        claimed = db.session.execute(
+            update(Job).where(Job.id == job_id, Job.status == 'queued').values(
+                status='running', attempts=Job.attempts + 1, started_at=now)
+        ).rowcount
+        db.session.commit()
+        if claimed:
+            return job_id
+
+
+def run_job(job_id):
+    """Run one claimed job; used in worker child processes"""
+    job = db.session.get(Job, job_id)
+    if job is None or job.status != 'running':
+        return False
+    return _execute(job)
+
+
+def requeue_stale(timeout):
+    """Return 'running' jobs older than ``timeout`` seconds to the queue
+
+    Covers jobs whose worker died mid-run.
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=timeout)
+    count = db.session.execute(
+        update(Job).where(Job.status == 'running', Job.started_at < cutoff).values(status='queued')
+    ).rowcount
+    db.session.commit()
+    return count
+
+
+def _init_child():
+    # Each pool process gets its own app context and database connections
+    from app import app
+    app.app_context().push()
+    db.engine.dispose(close=False)
+
+
+def _run_in_child(job_id):
+    ok = run_job(job_id)
+    db.session.remove()
+    return ok
+
+
+def run_worker(processes=None, poll_interval=1.0, once=False, log=print):
+    """Claim queued jobs and run them on a pool of worker processes
+
+    Args:
+        processes: Pool size (defaults to the CPU count)
+        poll_interval: Seconds to sleep when the queue is empty
+        once: Exit as soon as the queue is drained
+        log: Callable used for progress messages
+    """
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+    processes = processes or os.cpu_count() or 1
+    beat()
+    stale = requeue_stale(current_app.config.get('TASK_STALE_AFTER', 600))
+    if stale:
+        log(f'Requeued {stale} stale job(s)')
+
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_child) as pool:
+        running = {}
+        while True:
+            beat()
+            while len(running) < processes:
+                job_id = claim_next()
+                if job_id is None:
+                    break
+                running[pool.submit(_run_in_child, job_id)] = job_id
+
+            if not running:
+                if once:
+                    return
+                time.sleep(poll_interval)
+                continue
+
+            done, _ = wait(running, timeout=poll_interval, return_when=FIRST_COMPLETED)
+            for future in done:
+                job_id = running.pop(future)
+                try:
+                    ok = future.result()
+                except Exception as e:
+                    ok = False
+                    log(f'Job {job_id} crashed the worker process: {e}')
+                log(f"Job {job_id} {'done' if ok else 'errored'}")
@@ -0,0 +1,59 @@
+"""Test setup: the app on a throwaway SQLite database seeded with a few posts.
+
+app.py reads its configuration from the environment when it is imported,
+so the environment is set here, before any test module imports it. Caches
+that would hide a query are turned off.
+"""
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATABASE_DIR = tempfile.mkdtemp()
+
+os.environ.update(
+    DATABASE_URL=f"sqlite:///{os.path.join(DATABASE_DIR, 'test.db')}",
+    SEARCH_BACKEND='fts5',
+    PAGE_CACHE_ENABLED='False',
+    SIDEBAR_CACHE_TTL='0',
+    PAGINATION_COUNT_TTL='0',
+    USER_CACHE_TTL='0',
+    METRICS_ENABLED='False',
+    TASK_QUEUE_EAGER='False',
+    STREAM_TEMPLATES='False',
+)
+sys.path.insert(0, ROOT)
+
+from app import app, db  # noqa: E402
+from models import Category, Post, Tag, User  # noqa: E402
+
+# More than fit on a listing page
+POSTS = 24
+
+
+@pytest.fixture(scope='session')
+def seeded():
+    """Seed the database once; returns the admin's user id"""
+    app.config['WTF_CSRF_ENABLED'] = False
+    with app.app_context():
+        app.test_cli_runner().invoke(args=['init-db'])
+        author = User(username='writer', email='writer@example.com', password_hash='-')
+        db.session.add(author)
+        categories = Category.query.order_by(Category.id).all()
+        tags = Tag.query.order_by(Tag.id).all()
+        for i in range(POSTS):
+            post = Post(title=f'Post {i}', slug=f'post-{i}', summary=f'Summary {i}',
+                        content=f'<p>Writing flask apps, part {i}</p>', published=True,
+                        author=author, category=categories[i % 2])
+            post.tags = tags[:i % len(tags) + 1]
+            db.session.add(post)
+        db.session.commit()
+        admin_id = User.query.filter_by(username='admin').one().id
+        db.session.remove()
+    yield admin_id
+    with app.app_context():
+        db.engine.dispose()
+    shutil.rmtree(DATABASE_DIR, ignore_errors=True)
@@ -0,0 +1,69 @@
+"""asgi.py serves the public pages as coroutines; they must match the Flask app's."""
+import asyncio
+
+import pytest
+
+pytest.importorskip('aiosqlite')
+
+import asgi  # noqa: E402
+from app import app  # noqa: E402
+
+PAGES = ['/', '/?page=2', '/post/post-5', '/category/technology', '/tag/python']
+
+
+async def _get(path, headers=()):
+    """``(status, headers, body)`` of a GET through the ASGI application"""
+    path, _, query = path.partition('?')
+    scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query.encode(),
+             'headers': [(name.encode(), value.encode()) for name, value in headers],
+             'server': ('localhost', 80), 'scheme': 'http', 'http_version': '1.1'}
+    messages = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    await asgi.application(scope, receive, send)
+    return (sent[0]['status'], {name.decode(): value.decode() for name, value in sent[0]['headers']},
+            b''.join(message.get('body', b'') for message in sent[1:]))
+
+
+def _serve_async(paths, headers=()):
+    async def get_all():
+        try:
+            return [await _get(path, headers) for path in paths]
+        finally:
+            # The engine's connections belong to this event loop
+            await asgi._engine.dispose()
+            asgi._engine = asgi._sessions = None
+
+    return asyncio.run(get_all())
+
+
+def test_async_pages_match_sync_pages(seeded, monkeypatch):
+    monkeypatch.setattr(asgi, '_call_wsgi', lambda *args: pytest.fail('served by the WSGI fallback'))
+    client = app.test_client()
+
+    for path, (status, headers, body) in zip(PAGES, _serve_async(PAGES)):
+        expected = client.get(path)
+        assert status == expected.status_code == 200, path
+        assert headers.get('etag') == expected.headers.get('ETag'), path
+        assert body == expected.get_data(), path
+
+
+def test_async_pages_answer_conditional_requests(seeded):
+    etag = app.test_client().get('/post/post-5').headers['ETag']
+
+    [(status, _, body)] = _serve_async(['/post/post-5'], headers=[('if-none-match', etag)])
+
+    assert status == 304
+    assert body == b''
+
+
+def test_async_missing_pages_are_404(seeded):
+    statuses = [status for status, _, _ in _serve_async(['/post/nope', '/category/nope', '/?page=99'])]
+
+    assert statuses == [404, 404, 404]
@@ -0,0 +1,16 @@
+"""Image URLs in the page head."""
+import pytest
+
+from app import app
+from images import absolute_url
+
+
+@pytest.mark.parametrize('src, expected', [
+    ('/static/uploads/a.png', 'https://blog.example/static/uploads/a.png'),
+    ('static/uploads/a.png', 'https://blog.example/static/uploads/a.png'),
+    ('//cdn.example/a.png', 'https://cdn.example/a.png'),
+    ('http://elsewhere.example/a.png', 'http://elsewhere.example/a.png'),
+])
+def test_absolute_url(src, expected):
+    with app.test_request_context('/post/a-post', base_url='https://blog.example'):
+        assert absolute_url(src) == expected
@@ -0,0 +1,43 @@
+"""Admin writes evict the cached pages they change, and only those."""
+import pytest
+
+import page_cache
+from app import app
+from models import Post
+
+
+@pytest.fixture
+def invalidated(monkeypatch):
+    tags = set()
+    monkeypatch.setattr(page_cache, 'invalidate', lambda *args: tags.update(args))
+    return tags
+
+
+def _admin(admin_id):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(admin_id)
+        session['_fresh'] = True
+    return client
+
+
+def test_edit_outside_the_sidebar_keeps_listings(seeded, invalidated):
+    with app.app_context():
+        post = Post.query.filter_by(slug='post-0').one()
+        form = {'title': post.title, 'content': post.content, 'summary': 'A new summary',
+                'category_id': str(post.category_id), 'tags': [str(tag.id) for tag in post.tags],
+                'published': 'y'}
+        post_id = post.id
+
+    response = _admin(seeded).post(f'/admin/edit-post/{post_id}', data=form)
+
+    assert response.status_code == 302
+    assert f'post:{post_id}' in invalidated
+    assert 'sidebar' not in invalidated
+
+
+def test_sidebar_change_evicts_listings(seeded, invalidated):
+    response = _admin(seeded).post('/admin/new-category', data={'name': 'Gardening'})
+
+    assert response.status_code == 302
+    assert 'sidebar' in invalidated
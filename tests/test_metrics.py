@@ -0,0 +1,27 @@
+"""/metrics answers scrapers in plain text, whoever asks."""
+from app import app
+from models import User
+
+
+def test_metrics_need_credentials(seeded, monkeypatch):
+    monkeypatch.setitem(app.config, 'METRICS_TOKEN', 'secret')
+    client = app.test_client()
+
+    anonymous = client.get('/metrics')
+    wrong_token = client.get('/metrics', headers={'Authorization': 'Bearer wrong'})
+    scraper = client.get('/metrics', headers={'Authorization': 'Bearer secret'})
+
+    assert (anonymous.status_code, anonymous.mimetype) == (401, 'text/plain')
+    assert (wrong_token.status_code, wrong_token.mimetype) == (403, 'text/plain')
+    assert scraper.status_code == 200
+
+
+def test_forbidden_page_renders(seeded):
+    client = app.test_client()
+    with app.app_context():
+        writer_id = User.query.filter_by(username='writer').one().id
+    with client.session_transaction() as session:
+        session['_user_id'] = str(writer_id)
+        session['_fresh'] = True
+
+    assert client.get('/admin/posts').status_code == 403
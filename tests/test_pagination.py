@@ -0,0 +1,16 @@
+"""Listings number their first pages and reach the rest by cursor."""
+import re
+
+from app import app
+
+
+def test_deep_pages_are_only_reached_by_cursor(seeded, monkeypatch):
+    monkeypatch.setitem(app.config, 'PAGINATION_SHALLOW_PAGES', 2)
+    client = app.test_client()
+
+    assert client.get('/?page=3').status_code == 404
+
+    page = client.get('/?page=2')
+    assert page.status_code == 200
+    cursor = re.search(r'cursor=([\w-]+)', page.get_data(as_text=True)).group(1)
+    assert client.get(f'/?cursor={cursor}').status_code == 200
@@ -0,0 +1,60 @@
+"""Statements per page, so an N+1 query fails here instead of in production.
+
+Counts the statements each page sends on the seeded database (see
+conftest.py: each post has an author, a category and tags) with a
+``before_cursor_execute`` listener. Caches that would hide a query are off,
+so the counts are those of a cold request.
+"""
+import pytest
+from sqlalchemy import event
+
+from app import app, db
+
+# Most statements each page may send: what it sends today plus two, fewer
+# than the posts on a page, so loading a relation per post fails
+CEILINGS = {
+    '/': 7,
+    '/post/post-5': 5,
+    '/category/technology': 10,
+    '/tag/python': 9,
+    '/search?q=flask': 9,
+    '/admin/posts': 5,
+}
+
+
+@pytest.fixture
+def statements():
+    executed = []
+
+    def count(conn, cursor, statement, *args):
+        executed.append(statement)
+
+    with app.app_context():
+        engines = list(db.engines.values())
+    for engine in engines:
+        event.listen(engine, 'before_cursor_execute', count)
+    yield executed
+    for engine in engines:
+        event.remove(engine, 'before_cursor_execute', count)
+
+
+def _client(admin_id=None):
+    client = app.test_client()
+    if admin_id is not None:
+        with client.session_transaction() as session:
+            session['_user_id'] = str(admin_id)
+            session['_fresh'] = True
+    return client
+
+
+@pytest.mark.parametrize('path', sorted(CEILINGS))
+def test_statements_per_page(seeded, statements, path):
+    client = _client(seeded if path.startswith('/admin') else None)
+    # The first request creates what is created lazily (e.g. the FTS table)
+    assert client.get(path).status_code == 200
+    statements.clear()
+
+    response = client.get(path)
+
+    assert response.status_code == 200
+    assert len(statements) <= CEILINGS[path], '\n'.join(statements)